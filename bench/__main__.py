@@ -0,0 +1,286 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import json
+import logging
+import sys
+from argparse import ArgumentParser, Namespace
+from crypt import METHOD_SHA512, crypt, mksalt
+from pathlib import Path
+from random import Random
+from os import getpid, sysconf
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from secrets import token_bytes
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List
+
+from aiohttp import FormData
+from aiohttp.test_utils import TestClient, TestServer
+
+from oceanfile.main import _create_app
+
+log = logging.getLogger('bench')
+
+_USER = 'bench'
+_PASSWORD = 'bench'
+
+
+def _read_proc_io() -> Dict[str, int]:
+    """ Returns counters of read and write syscalls and bytes of this process. """
+    counters = {}
+    with open('/proc/self/io') as io_file:
+        for line in io_file:
+            name, value = line.split(':')
+            counters[name] = int(value)
+    return counters
+
+
+def _get_children_cpu() -> float:
+    """
+    Returns CPU time of all descendant processes, in seconds. Workers of process pools are children
+    of the forkserver and are running while measured, so they are found in /proc, and the time
+    of the exited ones is counted by their parents or by getrusage() if they are waited here.
+    """
+    parents = {}
+    times = {}
+    for stat_path in Path('/proc').glob('[0-9]*/stat'):
+        try:
+            data = stat_path.read_text()
+        except OSError:
+            # Exited meanwhile.
+            continue
+        # Name of the process in parentheses can contain spaces.
+        fields = data[data.rindex(')') + 2:].split()
+        pid = int(stat_path.parent.name)
+        parents[pid] = int(fields[1])
+        # Own and waited children user and system times, in clock ticks.
+        times[pid] = sum(int(value) for value in fields[11:15])
+    descendants = {getpid()}
+    added = True
+    while added:
+        added = False
+        for pid, parent in parents.items():
+            if parent in descendants and pid not in descendants:
+                descendants.add(pid)
+                added = True
+    descendants.remove(getpid())
+    usage = getrusage(RUSAGE_CHILDREN)
+    return sum(times[pid] for pid in descendants) / sysconf('SC_CLK_TCK') + usage.ru_utime + usage.ru_stime
+
+
+def _generate_share(root: Path, args: Namespace) -> List[str]:
+    """ Creates the tree of directories with files and returns paths of directories relative to the share. """
+    rnd = Random(args.seed)
+    dirs = ['/']
+    level = ['/']
+    for _ in range(args.depth):
+        next_level = []
+        for parent in level:
+            for index in range(args.fanout):
+                next_level.append(f'{parent}d{index:03}/')
+        level = next_level
+        dirs.extend(level)
+    for dir_name in dirs:
+        dir_path = root / dir_name.removeprefix('/')
+        dir_path.mkdir(exist_ok=True)
+        for index in range(args.files):
+            (dir_path / f'f{index:05}.bin').write_bytes(rnd.randbytes(args.file_size))
+    return dirs
+
+
+def _make_settings(work_dir: Path, args: Namespace) -> Dict[str, Any]:
+    settings = {
+        'server': {'listen': '127.0.0.1', 'port': 0, 'max-upload-size': 1 << 40},
+        'share': {'name': 'bench', 'path': str(work_dir / 'share')},
+        'sessions': {'ttl': 86400, 'cache': str(work_dir / 'sessions.json')},
+        'watcher': {'mode': args.watcher},
+        'durability': {'mode': args.durability},
+        'fileops': {'tasks': str(work_dir / 'tasks')},
+        'users': {_USER: {'email': 'bench@localhost', 'password_hash': crypt(_PASSWORD, mksalt(METHOD_SHA512))}},
+    }
+    if args.metrics == 'on':
+        # Requests are measured only if metrics are served.
+        settings['metrics'] = {'allow': ['127.0.0.1']}
+    return settings
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def _run_scenario(name: str, operation: Callable[[int], Awaitable[None]], count: int, concurrency: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors = 0
+    next_index = iter(range(count))
+
+    async def worker():
+        nonlocal errors
+        for index in next_index:
+            start_time = perf_counter()
+            try:
+                await operation(index)
+            except Exception as error:
+                errors += 1
+                log.debug('Operation %s #%d failed: %s.', name, index, error)
+            latencies.append(perf_counter() - start_time)
+
+    usage_before = getrusage(RUSAGE_SELF)
+    children_cpu_before = _get_children_cpu()
+    io_before = _read_proc_io()
+    start_time = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = perf_counter() - start_time
+    usage_after = getrusage(RUSAGE_SELF)
+    children_cpu_after = _get_children_cpu()
+    io_after = _read_proc_io()
+
+    latencies.sort()
+    return dict(
+        scenario=name,
+        requests=count,
+        errors=errors,
+        concurrency=concurrency,
+        seconds=round(elapsed, 6),
+        throughput=round(count / elapsed, 2) if elapsed else 0.0,
+        p50_ms=round(_percentile(latencies, 0.5) * 1000, 3),
+        p99_ms=round(_percentile(latencies, 0.99) * 1000, 3),
+        cpu_seconds=round(usage_after.ru_utime + usage_after.ru_stime - usage_before.ru_utime - usage_before.ru_stime, 6),
+        # Password hashes and thumbnails are made by process pools.
+        children_cpu_seconds=round(children_cpu_after - children_cpu_before, 6),
+        max_rss_kb=usage_after.ru_maxrss,
+        read_syscalls=io_after['syscr'] - io_before['syscr'],
+        write_syscalls=io_after['syscw'] - io_before['syscw'],
+        read_bytes=io_after['read_bytes'] - io_before['read_bytes'],
+        write_bytes=io_after['write_bytes'] - io_before['write_bytes'],
+    )
+
+
+async def _bench(work_dir: Path, args: Namespace) -> Dict[str, Any]:
+    share_path = work_dir / 'share'
+    share_path.mkdir()
+    start_time = perf_counter()
+    dirs = _generate_share(share_path, args)
+    generate_time = perf_counter() - start_time
+
+    app = _create_app(_make_settings(work_dir, args), lambda: None, link=None, tickets_key=token_bytes(32))
+    rnd = Random(args.seed)
+    payload = rnd.randbytes(args.upload_size)
+    results = []
+
+    async with TestClient(TestServer(app, host='127.0.0.1')) as client:
+        sessions = app['sessions']
+        tokens = [await sessions.add(_USER) for _ in range(args.tokens)]
+
+        def auth_headers(index: int) -> Dict[str, str]:
+            return {'Authorization': f'Token {tokens[index % len(tokens)]}'}
+
+        async def auth(unused_index: int):
+            async with client.post('/api2/auth-token/', data=dict(username=_USER, password=_PASSWORD)) as response:
+                response.raise_for_status()
+                await response.read()
+
+        async def listing(index: int):
+            dir_name = dirs[rnd.randrange(len(dirs))]
+            async with client.get('/api2/repos/bench/dir/', params=dict(p=dir_name), headers=auth_headers(index)) as response:
+                response.raise_for_status()
+                await response.read()
+
+        async def mkdir(index: int):
+            dir_name = f'{dirs[rnd.randrange(len(dirs))]}new{index:06}'
+            params = dict(p=dir_name)
+            async with client.post('/api2/repos/bench/dir/', params=params, data=dict(operation='mkdir'), headers=auth_headers(index)) as response:
+                response.raise_for_status()
+                await response.read()
+
+        async def upload(index: int):
+            form = FormData()
+            form.add_field('parent_dir', '/')
+            form.add_field('file', payload, filename=f'up{index:06}.bin', content_type='application/octet-stream')
+            params = dict(path=dirs[rnd.randrange(len(dirs))])
+            async with client.post('/self/upload', params=params, data=form, headers=auth_headers(index)) as response:
+                response.raise_for_status()
+                await response.read()
+
+        # Weights of operations in the mixed scenario.
+        mix = [listing] * 16 + [upload] * 2 + [mkdir] + [auth]
+
+        async def mixed(index: int):
+            await rnd.choice(mix)(index)
+
+        scenarios = dict(auth=auth, listing=listing, mkdir=mkdir, upload=upload, mixed=mixed)
+        for name in args.scenarios:
+            log.info('Running scenario %s.', name)
+            results.append(await _run_scenario(name, scenarios[name], args.requests, args.concurrency))
+
+    return dict(
+        python=sys.version.split()[0],
+        parameters=dict(
+            fanout=args.fanout,
+            depth=args.depth,
+            files=args.files,
+            file_size=args.file_size,
+            dirs=len(dirs),
+            tokens=args.tokens,
+            upload_size=args.upload_size,
+            seed=args.seed,
+            watcher=args.watcher,
+            durability=args.durability,
+            metrics=args.metrics,
+        ),
+        generate_seconds=round(generate_time, 6),
+        results=results,
+    )
+
+
+def main():
+    parser = ArgumentParser(prog='python -m bench', description='Benchmark of oceanfile API running in-process on localhost.')
+    parser.add_argument('--fanout', type=int, default=8, help='Number of subdirectories of every directory.')
+    parser.add_argument('--depth', type=int, default=2, help='Depth of the directories tree.')
+    parser.add_argument('--files', type=int, default=50, help='Number of files in every directory.')
+    parser.add_argument('--file-size', type=int, default=4096, help='Size of generated files, in bytes.')
+    parser.add_argument('--tokens', type=int, default=1000, help='Number of authorized sessions.')
+    parser.add_argument('--upload-size', type=int, default=1024 * 1024, help='Size of uploaded files, in bytes.')
+    parser.add_argument('--requests', type=int, default=2000, help='Number of requests in every scenario.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of concurrent requests.')
+    parser.add_argument('--scenarios', nargs='+', default=['auth', 'listing', 'mkdir', 'upload', 'mixed'],
+                        choices=['auth', 'listing', 'mkdir', 'upload', 'mixed'], help='Scenarios to run.')
+    parser.add_argument('--watcher', default='inotify', choices=['inotify', 'poll', 'off'], help='Share watcher mode.')
+    parser.add_argument('--durability', default='strict', choices=['strict', 'batched', 'relaxed'], help='Durability mode of saved files.')
+    parser.add_argument('--metrics', default='off', choices=['on', 'off'], help='Record metrics of requests, to compare the overhead.')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of generated data and requests.')
+    parser.add_argument('--work-dir', type=Path, help='Directory for the share, temporary one by default.')
+    parser.add_argument('-o', '--output', type=Path, help='Path to JSON results, stdout by default.')
+    parser.add_argument('-d', '--debug', action='store_true', help='Enable debug mode.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    log.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    with TemporaryDirectory(prefix='oceanfile-bench-', dir=args.work_dir) as work_dir:
+        report = asyncio.run(_bench(Path(work_dir), args))
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        args.output.write_text(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
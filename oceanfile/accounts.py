@@ -14,27 +14,105 @@
 """
 
 import logging
-from crypt import crypt
-from hmac import compare_digest
-from typing import Any, Dict
+from asyncio import get_running_loop
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from crypt import METHOD_SHA512, crypt, mksalt
+from hashlib import sha256
+from hmac import compare_digest, new as hmac_new
+from multiprocessing import get_context
+from secrets import token_bytes
+from time import monotonic
+from typing import Any, Dict, Tuple
+
+from aiohttp.web import HTTPServiceUnavailable
 
 from oceanfile.errors import UserNotFound
+from oceanfile.metrics import Histogram
 
 log = logging.getLogger(__name__)
 
+_verify_duration = Histogram('oceanfile_password_verify_seconds', 'Time of verifying password hashes.')
+
+
+def _verify(password: str, password_hash: str) -> Tuple[bool, float]:
+    """ Returns whether the password is valid and how long the check took. """
+    start_time = monotonic()
+    is_valid = compare_digest(crypt(password, password_hash), password_hash)
+    return is_valid, monotonic() - start_time
+
 
 class UserAccounts:
     def __init__(self, settings: Dict[str, Any]):
         self.__users: Dict[str, Dict[str, str]] = settings['users']
+        section: Dict[str, Any] = settings.get('auth', {})
+        # Hashing is CPU bound and holds GIL, so it's done by processes, their number limits how many cores logins can take.
+        self.__workers: int = section.get('hash-workers', 2)
+        self.__executor: ProcessPoolExecutor | None = None
+        # Logins over this number of waiting hashes are rejected instead of being queued.
+        self.__max_pending: int = section.get('max-pending', 32)
+        self.__retry_after: int = section.get('retry-after', 5)
+        self.__pending = 0
+        self.__cache_ttl: int = section.get('cache-ttl', 300)
+        self.__cache_size: int = section.get('cache-size', 1024)
+        self.__cache: OrderedDict[Tuple[str, bytes], float] = OrderedDict()
+        # Passwords are never kept in memory, only their digests with the key known to this process.
+        self.__cache_key = token_bytes(32)
+        # Unknown users are checked against this hash to take the same time as existing ones.
+        self.__dummy_hash = crypt(token_bytes(16).hex(), mksalt(METHOD_SHA512))
+
+    async def start(self):
+        # Forking of the running server is not safe because of its threads.
+        self.__executor = ProcessPoolExecutor(max_workers=self.__workers, mp_context=get_context('forkserver'))
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown(cancel_futures=True)
+
+    def __get_cache_key(self, name: str, password: str, password_hash: str) -> Tuple[str, bytes]:
+        creds = f'{name}\0{password}\0{password_hash}'.encode(encoding='utf-8', errors='surrogateescape')
+        return name, hmac_new(self.__cache_key, creds, sha256).digest()
 
-    def check(self, name: str, password: str) -> bool:
+    def __is_cached(self, key: Tuple[str, bytes]) -> bool:
+        deadline = self.__cache.get(key)
+        if deadline is None:
+            return False
+        if monotonic() >= deadline:
+            del self.__cache[key]
+            return False
+        self.__cache.move_to_end(key)
+        return True
+
+    def __add_to_cache(self, key: Tuple[str, bytes]):
+        self.__cache[key] = monotonic() + self.__cache_ttl
+        self.__cache.move_to_end(key)
+        while len(self.__cache) > self.__cache_size:
+            self.__cache.popitem(last=False)
+
+    async def check(self, name: str, password: str) -> bool:
         user = self.__users.get(name)
+        password_hash = self.__dummy_hash if user is None else user['password_hash']
+        key = self.__get_cache_key(name, password, password_hash)
+        if user is not None and self.__is_cached(key):
+            log.debug('User %r authorized successfully using cache.', name)
+            return True
+
+        if self.__pending >= self.__max_pending:
+            log.warning('Login of user %r rejected: %d hashes are waiting.', name, self.__pending)
+            raise HTTPServiceUnavailable(headers={'Retry-After': str(self.__retry_after)})
+        self.__pending += 1
+        try:
+            is_valid, duration = await get_running_loop().run_in_executor(self.__executor, _verify, password, password_hash)
+        finally:
+            self.__pending -= 1
+        _verify_duration.observe(duration)
         if user is None:
             log.debug('User %r is not found.', name)
             return False
-        password_hash = user['password_hash']
-        is_valid = compare_digest(crypt(password, password_hash), password_hash)
+
         log.debug('User %r authorized successfully? %s.', name, is_valid)
+        if is_valid:
+            self.__add_to_cache(key)
         return is_valid
 
     def get_email(self, name: str) -> str:
@@ -0,0 +1,118 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import Condition, get_running_loop, wait_for
+from contextlib import asynccontextmanager
+from os import statvfs
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict
+
+from aiohttp.web import HTTPInsufficientStorage, HTTPServiceUnavailable
+
+from oceanfile.metrics import Counter, Gauge
+
+log = logging.getLogger(__name__)
+
+_uploads_in_flight = Gauge('oceanfile_uploads_in_flight', 'Number of uploads being received.')
+_upload_bytes_in_flight = Gauge('oceanfile_upload_bytes_in_flight', 'Number of bytes reserved by uploads being received.')
+_uploads_waiting = Gauge('oceanfile_uploads_waiting', 'Number of uploads waiting to be admitted.')
+_uploads_rejected = Counter('oceanfile_uploads_rejected_total', 'Number of rejected uploads.', ('reason',))
+
+
+def _get_free_space(path: Path) -> int:
+    info = statvfs(path)
+    return info.f_frsize * info.f_bavail
+
+
+class UploadAdmission:
+    """
+    Limits the number of uploads received at once, globally and per user, and the number of bytes
+    they are going to write. Uploads over the limits wait in a short queue for a while and then are
+    rejected with 503 and Retry-After, so the server stays responsive to listings and logins.
+    Uploads are also rejected with 507 when free space of the share would go below the limit.
+    """
+
+    def __init__(self, root: Path, settings: Dict[str, Any]):
+        section: Dict[str, Any] = settings.get('uploads', {})
+        self.__root = root
+        self.__max_uploads: int = section.get('max-uploads', 16)
+        self.__max_user_uploads: int = section.get('max-user-uploads', 4)
+        self.__max_bytes: int = section.get('max-bytes', 4 * 1024 * 1024 * 1024)
+        self.__max_queue: int = section.get('max-queue', 64)
+        self.__queue_timeout: float = section.get('queue-timeout', 30)
+        self.__retry_after: int = section.get('retry-after', 30)
+        self.__min_free_space: int = section.get('min-free-space', 1024 * 1024 * 1024)
+        self.__uploads = 0
+        self.__user_uploads: Dict[str, int] = dict()
+        self.__bytes = 0
+        self.__waiting = 0
+        self.__condition = Condition()
+
+    def __can_start(self, user: str, size: int) -> bool:
+        if self.__uploads >= self.__max_uploads or self.__user_uploads.get(user, 0) >= self.__max_user_uploads:
+            return False
+        # Upload bigger than the limit is started when nothing else is uploaded.
+        return self.__bytes == 0 or self.__bytes + size <= self.__max_bytes
+
+    def __reject(self, reason: str, user: str) -> HTTPServiceUnavailable:
+        log.warning('Upload of user %r rejected: %s.', user, reason)
+        _uploads_rejected.inc(labels=(reason,))
+        return HTTPServiceUnavailable(headers={'Retry-After': str(self.__retry_after)})
+
+    @asynccontextmanager
+    async def admit(self, user: str, size: int | None) -> AsyncIterator[None]:
+        """ Waits until the upload of the size, unknown if None, can be received. """
+        if size is None:
+            # Body is sent by chunks, so its share of the limit is reserved.
+            size = self.__max_bytes // self.__max_uploads
+
+        free_space = await get_running_loop().run_in_executor(None, _get_free_space, self.__root)
+        if free_space - self.__bytes - size < self.__min_free_space:
+            log.error('Upload of user %r rejected: %d bytes of free space left.', user, free_space)
+            _uploads_rejected.inc(labels=('space',))
+            raise HTTPInsufficientStorage()
+
+        async with self.__condition:
+            if not self.__can_start(user, size):
+                if self.__waiting >= self.__max_queue:
+                    raise self.__reject('queue is full', user)
+                self.__waiting += 1
+                _uploads_waiting.inc()
+                try:
+                    await wait_for(self.__condition.wait_for(lambda: self.__can_start(user, size)), self.__queue_timeout)
+                except TimeoutError:
+                    raise self.__reject('waited too long', user)
+                finally:
+                    self.__waiting -= 1
+                    _uploads_waiting.dec()
+            self.__add(user, 1, size)
+
+        try:
+            yield
+        finally:
+            async with self.__condition:
+                self.__add(user, -1, -size)
+                self.__condition.notify_all()
+
+    def __add(self, user: str, count: int, size: int):
+        self.__uploads += count
+        self.__bytes += size
+        if user_uploads := self.__user_uploads.get(user, 0) + count:
+            self.__user_uploads[user] = user_uploads
+        else:
+            del self.__user_uploads[user]
+        _uploads_in_flight.set(self.__uploads)
+        _upload_bytes_in_flight.set(self.__bytes)
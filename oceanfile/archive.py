@@ -0,0 +1,168 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import AbstractEventLoop, Queue, get_running_loop, run_coroutine_threadsafe
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from errno import ELOOP
+from os import O_CLOEXEC, O_NOFOLLOW, O_RDONLY, open as os_open, scandir
+from pathlib import Path
+from shutil import copyfileobj
+from threading import Event
+from typing import Any, AsyncIterator, Dict, Iterator, List, Tuple
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+log = logging.getLogger(__name__)
+
+# Archive is sent by chunks of this size.
+_CHUNK_SIZE = 64 * 1024
+# Number of chunks made ahead of sending, so the client read rate limits the archiving.
+_QUEUE_SIZE = 8
+# Files are read by blocks of this size.
+_READ_SIZE = 1024 * 1024
+
+# Files of these types are compressed already, so they are always stored.
+_COMPRESSED_SUFFIXES = frozenset((
+    '.7z', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jpeg', '.jpg', '.m4a', '.mkv', '.mov',
+    '.mp3', '.mp4', '.ogg', '.opus', '.png', '.rar', '.webm', '.webp', '.xlsx', '.xz', '.zip', '.zst',
+))
+
+
+class _Aborted(Exception):
+    pass
+
+
+class _QueueWriter:
+    """ Unseekable file passing the written data to the event loop by chunks. """
+
+    def __init__(self, loop: AbstractEventLoop, queue: Queue, stopped: Event):
+        self.__loop = loop
+        self.__queue = queue
+        self.__stopped = stopped
+        self.__buffer = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self.__buffer += data
+        if len(self.__buffer) >= _CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.__buffer:
+            chunk, self.__buffer = bytes(self.__buffer), bytearray()
+            self.put(chunk)
+
+    def put(self, item: bytes | Exception | None):
+        if self.__stopped.is_set():
+            raise _Aborted()
+        run_coroutine_threadsafe(self.__queue.put(item), self.__loop).result()
+
+
+def _iter_tree(path: Path, arcname: str) -> Iterator[Tuple[Path, str, bool]]:
+    """ Yields paths, names in the archive and directory flags of the tree entries except hidden ones and symlinks. """
+    if path.is_symlink():
+        # Symlinks can point out of the share.
+        return
+    if not path.is_dir():
+        yield path, arcname, False
+        return
+    yield path, f'{arcname}/', True
+    try:
+        with scandir(path) as dir_entries:
+            entries = sorted(
+                (entry.name, entry.is_dir(follow_symlinks=False))
+                for entry in dir_entries
+                if not entry.name.startswith('.') and not entry.is_symlink()
+            )
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for name, is_dir in entries:
+        if is_dir:
+            yield from _iter_tree(path / name, f'{arcname}/{name}')
+        else:
+            yield path / name, f'{arcname}/{name}', False
+
+
+class DirArchiver:
+    """
+    Makes ZIP archives of directories on the fly. Archive is written by zipfile in a thread to
+    an unseekable file, so sizes and checksums follow the data in data descriptors and ZIP64
+    records are used for big files and archives. Nothing is kept on disk and only a few chunks
+    of the archive are kept in memory.
+    """
+
+    def __init__(self, settings: Dict[str, Any]):
+        section: Dict[str, Any] = settings.get('zip', {})
+        self.__compress: bool = section.get('compress', False)
+        # Each archive being sent takes a thread for all the time of sending.
+        self.__executor = ThreadPoolExecutor(max_workers=section.get('workers', 4), thread_name_prefix='zip')
+
+    def close(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+    def __write(self, writer: _QueueWriter, paths: List[Tuple[Path, str]]):
+        try:
+            with ZipFile(writer, mode='w', allowZip64=True, strict_timestamps=False) as archive:
+                for root_path, root_name in paths:
+                    for path, arcname, is_dir in _iter_tree(root_path, root_name):
+                        try:
+                            self.__add(archive, path, arcname, is_dir)
+                        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                            # Removed while archiving.
+                            continue
+                        except OSError as error:
+                            if error.errno != ELOOP:
+                                raise
+                            log.warning("Symlink '%s' is skipped in archive.", path)
+            writer.flush()
+            writer.put(None)
+        except _Aborted:
+            return
+        except Exception as error:
+            with suppress(_Aborted):
+                writer.put(error)
+
+    def __add(self, archive: ZipFile, path: Path, arcname: str, is_dir: bool):
+        info = ZipInfo.from_file(path, arcname, strict_timestamps=False)
+        if is_dir:
+            archive.writestr(info, b'')
+            return
+        if self.__compress and path.suffix.lower() not in _COMPRESSED_SUFFIXES:
+            info.compress_type = ZIP_DEFLATED
+        else:
+            info.compress_type = ZIP_STORED
+        # File replaced by a symlink after the scan is not followed.
+        with open(os_open(path, O_RDONLY | O_NOFOLLOW | O_CLOEXEC), mode='rb') as src_file, archive.open(info, mode='w') as dst_file:
+            copyfileobj(src_file, dst_file, _READ_SIZE)
+
+    async def stream(self, paths: List[Tuple[Path, str]]) -> AsyncIterator[bytes]:
+        """ Yields ZIP archive of the files and directories, given by paths and their names in the archive. """
+        loop = get_running_loop()
+        queue: Queue[bytes | Exception | None] = Queue(maxsize=_QUEUE_SIZE)
+        stopped = Event()
+        writer = _QueueWriter(loop, queue, stopped)
+        archiver = loop.run_in_executor(self.__executor, self.__write, writer, paths)
+        try:
+            while (item := await queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stopped.set()
+            # Writer waiting for free space in the queue is released.
+            while not queue.empty():
+                queue.get_nowait()
+            await archiver
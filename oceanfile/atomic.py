@@ -13,33 +13,227 @@
     If not, see <https://www.gnu.org/licenses/>.
 """
 
-from contextlib import contextmanager
-from os import O_CLOEXEC, O_DIRECTORY, O_RDONLY, close as os_close, fchmod, fdatasync, open as os_open
+import logging
+from asyncio import CancelledError, Task, create_task, get_running_loop, sleep as async_sleep
+from contextlib import contextmanager, suppress
+from ctypes import CDLL, c_int, get_errno
+from ctypes.util import find_library
+from os import O_CLOEXEC, O_DIRECTORY, O_RDONLY, close as os_close, fchmod, fdatasync, open as os_open, strerror, sync
 from pathlib import Path
 from tempfile import mkstemp
+from threading import Condition
+from time import sleep
+from typing import IO, Any, Dict
+
+log = logging.getLogger(__name__)
+
+# Durability policies by roots, files outside of them are saved in strict mode.
+_policies: Dict[Path, 'Durability'] = dict()
+
+
+def _sync_dir(dir_path: Path):
+    dir_fd = os_open(dir_path, O_RDONLY | O_CLOEXEC | O_DIRECTORY)
+    try:
+        fdatasync(dir_fd)
+    finally:
+        os_close(dir_fd)
+
+
+def _get_policy(path: Path) -> 'Durability | None':
+    for root, policy in _policies.items():
+        if path.is_relative_to(root):
+            return policy
+    return None
+
+
+def _sync_parent(path: Path):
+    """ Syncs the directory after the file in it is replaced. """
+    if (policy := _get_policy(path)) is None:
+        _sync_dir(path.parent)
+    else:
+        policy.sync_dir(path.parent)
+
+
+def atomic_replace(tmp_path: Path, path: Path):
+    """ Replaces the file with the temporary one which is already written and closed. """
+    tmp_fd = os_open(tmp_path, O_RDONLY | O_CLOEXEC)
+    try:
+        # Data is synced in any mode, otherwise a crash can leave the renamed file empty.
+        fdatasync(tmp_fd)
+    finally:
+        os_close(tmp_fd)
+    tmp_path.replace(path)
+    _sync_parent(path)
+
+
+class _DirSync:
+    """ Sync of the directory shared by concurrent saves to it. """
+
+    def __init__(self):
+        self.requested = 0
+        self.done = 0
+        self.running = False
+
+
+class Durability:
+    """
+    Policy of flushing files saved under the root to the disk, files are replaced atomically in any mode.
+    In strict mode data of each file and its directory are synced on every save. In batched mode
+    saves to the same directory made within a short window share a single sync of the directory.
+    In relaxed mode data of each file is synced but its directory is not, the whole file system
+    is synced periodically, so files saved after the last sync can be missing after a crash, and
+    the previous versions of files are there instead.
+    """
+
+    def __init__(self, root: Path, settings: Dict[str, Any]):
+        section: Dict[str, Any] = settings.get('durability', {})
+        self.__root = root
+        # One of: strict, batched, relaxed.
+        self.__mode: str = section.get('mode', 'strict')
+        if self.__mode not in ('strict', 'batched', 'relaxed'):
+            raise ValueError(f'Unknown durability mode {self.__mode!r}.')
+        self.__sync_window: float = section.get('sync-window', 0.002)
+        self.__sync_interval: float = section.get('sync-interval', 5)
+        self.__condition = Condition()
+        self.__dirs: Dict[Path, _DirSync] = dict()
+        self.__task: Task | None = None
+        self.__syncfs = None
+
+    async def start(self):
+        _policies[self.__root] = self
+        if self.__mode == 'relaxed':
+            try:
+                self.__syncfs = CDLL(find_library('c'), use_errno=True).syncfs
+                self.__syncfs.argtypes = (c_int,)
+            except AttributeError:
+                log.warning('syncfs(2) is not available, all file systems are synced.')
+            self.__task = create_task(self.__sync_loop())
+        log.info("Files are saved to '%s' in %s durability mode.", self.__root, self.__mode)
+
+    async def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            with suppress(CancelledError):
+                await self.__task
+            await get_running_loop().run_in_executor(None, self.__sync_fs)
+        if _policies.get(self.__root) is self:
+            del _policies[self.__root]
+
+    def __sync_fs(self):
+        if self.__syncfs is None:
+            sync()
+            return
+        root_fd = os_open(self.__root, O_RDONLY | O_CLOEXEC | O_DIRECTORY)
+        try:
+            if self.__syncfs(root_fd) < 0:
+                errno = get_errno()
+                raise OSError(errno, strerror(errno), str(self.__root))
+        finally:
+            os_close(root_fd)
+
+    async def __sync_loop(self):
+        loop = get_running_loop()
+        while True:
+            await async_sleep(self.__sync_interval)
+            try:
+                await loop.run_in_executor(None, self.__sync_fs)
+            except OSError as error:
+                log.error("Unable to sync file system of '%s': %s.", self.__root, error)
+
+    def sync_dir(self, dir_path: Path):
+        if self.__mode == 'relaxed':
+            return
+        if self.__mode != 'batched':
+            _sync_dir(dir_path)
+            return
+        with self.__condition:
+            state = self.__dirs.setdefault(dir_path, _DirSync())
+            state.requested += 1
+            ticket = state.requested
+            while state.running and state.done < ticket:
+                self.__condition.wait()
+            if state.done >= ticket:
+                # Synced by another thread after this save.
+                return
+            state.running = True
+        # This thread syncs the directory for itself and for all saves requested meanwhile.
+        target = 0
+        try:
+            sleep(self.__sync_window)
+            with self.__condition:
+                target = state.requested
+            _sync_dir(dir_path)
+        except BaseException:
+            target = 0
+            raise
+        finally:
+            with self.__condition:
+                state.running = False
+                state.done = max(state.done, target)
+                if state.done == state.requested and self.__dirs.get(dir_path) is state:
+                    del self.__dirs[dir_path]
+                self.__condition.notify_all()
+
+
+class AtomicFile:
+    """
+    Temporary file next to the target one which replaces it on commit. Target which is a symlink
+    is replaced by the file itself, the file it points to is never written.
+    All methods are blocking so run them in executor when called from coroutines.
+    """
+
+    def __init__(self, path: Path, *, text: bool = True, perms: int = 0o644):
+        self.path = path.parent.resolve() / path.name
+        # http://bugs.python.org/issue21579
+        self.__fd, tmp_name = mkstemp(dir=self.path.parent, text=text, prefix=f'{self.path.name}.')
+        self.__tmp_path = Path(tmp_name)
+        try:
+            fchmod(self.__fd, perms)
+            self.file: IO = open(self.__fd, mode='wt' if text else 'wb', closefd=False)
+        except BaseException:
+            self.__tmp_path.unlink()
+            os_close(self.__fd)
+            raise
+
+    def write(self, data: str | bytes) -> int:
+        return self.file.write(data)
+
+    def fileno(self) -> int:
+        """ Flushes written data and returns descriptor of the temporary file. """
+        self.file.flush()
+        return self.__fd
+
+    def commit(self):
+        try:
+            self.file.flush()
+            fdatasync(self.__fd)
+            self.__tmp_path.replace(self.path)
+        except BaseException:
+            self.discard()
+            raise
+        self.__close()
+        _sync_parent(self.path)
+
+    def discard(self):
+        self.__tmp_path.unlink(missing_ok=True)
+        self.__close()
+
+    def __close(self):
+        if self.__fd < 0:
+            return
+        try:
+            self.file.close()
+        finally:
+            os_close(self.__fd)
+            self.__fd = -1
 
 
 @contextmanager
 def atomic_save(path: Path, *, text: bool = True, perms: int = 0o644):
-    file_path = path.resolve()
-    work_dir = file_path.parent
-    # http://bugs.python.org/issue21579
-    tmp_fd, tmp_name = mkstemp(dir=work_dir, text=text, prefix=f'{file_path.name}.')
-    tmp_path = Path(tmp_name)
+    atomic_file = AtomicFile(path, text=text, perms=perms)
     try:
-        fchmod(tmp_fd, perms)
-        with open(tmp_fd, mode='wt' if text else 'wb', closefd=False) as tmp_file:
-            yield tmp_file
-            tmp_file.flush()
-            fdatasync(tmp_fd)
-        tmp_path.replace(file_path)
+        yield atomic_file.file
     except BaseException:
-        tmp_path.unlink()
+        atomic_file.discard()
         raise
-    finally:
-        os_close(tmp_fd)
-    dir_fd = os_open(work_dir, O_RDONLY | O_CLOEXEC | O_DIRECTORY)
-    try:
-        fdatasync(dir_fd)
-    finally:
-        os_close(dir_fd)
+    atomic_file.commit()
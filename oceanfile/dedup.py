@@ -0,0 +1,262 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import sqlite3
+from asyncio import CancelledError, Task, create_task, get_running_loop, sleep
+from contextlib import contextmanager, suppress
+from fcntl import LOCK_EX, LOCK_SH, flock, ioctl
+from os import O_CLOEXEC, O_CREAT, O_EXCL, O_RDONLY, O_RDWR, O_WRONLY, close as os_close, link, open as os_open
+from pathlib import Path
+from secrets import token_hex
+from threading import Lock
+from typing import Any, Dict
+
+from oceanfile.atomic import AtomicFile, atomic_replace
+
+log = logging.getLogger(__name__)
+
+# See ioctl_ficlone(2).
+_FICLONE = 0x40049409
+
+
+def _clone(src_path: Path, dst_fd: int):
+    src_fd = os_open(src_path, O_RDONLY | O_CLOEXEC)
+    try:
+        ioctl(dst_fd, _FICLONE, src_fd)
+    finally:
+        os_close(src_fd)
+
+
+@contextmanager
+def _locked(lock_path: Path, operation: int):
+    # Lock is taken on its own descriptor, so threads of the same process exclude each other too.
+    lock_fd = os_open(lock_path, O_RDWR | O_CREAT | O_CLOEXEC, 0o600)
+    try:
+        flock(lock_fd, operation)
+        yield
+    finally:
+        os_close(lock_fd)
+
+
+class DedupStore:
+    """
+    Uploaded files with the same content share the data on disk. The first copy of the content
+    is cloned into the store as a blob named by its SHA-256 hash, the next copies are made as
+    reflinks or, if it's configured, hardlinks of that blob. The index of blobs keeps their size
+    and mtime to find the blobs which are changed in place and can not be used anymore, and the
+    files made from them to find the blobs which are not used by any file and collect them.
+    Blobs are used under the shared lock of the store and collected under the exclusive one,
+    so several server processes can share the store.
+    All methods except start and close are blocking so run them in executor when called from coroutines.
+    """
+
+    def __init__(self, root: Path, settings: Dict[str, Any]):
+        section: Dict[str, Any] | None = settings.get('dedup')
+        self.__root = root
+        self.__enabled = section is not None
+        if section is None:
+            section = dict()
+        self.__path = Path(section.get('store', './blobs')).resolve()
+        self.__lock_path = self.__path / '.lock'
+        # One of: reflink, hardlink.
+        self.__mode: str = section.get('mode', 'reflink')
+        self.__gc_interval: float = section.get('gc-interval', 3600)
+        self.__db: sqlite3.Connection | None = None
+        self.__lock = Lock()
+        self.__task: Task | None = None
+
+    def is_enabled(self) -> bool:
+        return self.__enabled
+
+    async def start(self):
+        if not self.__enabled:
+            return
+        await get_running_loop().run_in_executor(None, self.__open)
+        if self.__enabled:
+            self.__task = create_task(self.__gc_loop())
+
+    async def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            with suppress(CancelledError):
+                await self.__task
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+
+    def __open(self):
+        if self.__mode not in ('reflink', 'hardlink'):
+            raise ValueError(f'Unknown deduplication mode {self.__mode!r}.')
+        self.__path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if self.__path.stat().st_dev != self.__root.stat().st_dev:
+            log.error("Blobs store '%s' is not on the share filesystem, deduplication is disabled.", self.__path)
+            self.__enabled = False
+            return
+        if self.__mode == 'reflink' and not self.__can_clone():
+            log.error("Filesystem of blobs store '%s' does not support reflinks, deduplication is disabled.", self.__path)
+            self.__enabled = False
+            return
+        self.__db = sqlite3.connect(self.__path / 'index.db', isolation_level=None, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)')
+        # Files made from blobs, the file is replaced by another one when its inode is changed.
+        self.__db.execute('CREATE TABLE IF NOT EXISTS refs (path TEXT PRIMARY KEY, digest TEXT, ino INTEGER)')
+        self.__db.execute('CREATE INDEX IF NOT EXISTS refs_digest ON refs (digest)')
+        count, size = self.__db.execute('SELECT COUNT(*), TOTAL(size) FROM blobs').fetchone()
+        log.info("Using blobs store '%s' (%s), %d blobs, %d bytes.", self.__path, self.__mode, count, size)
+
+    def __can_clone(self) -> bool:
+        probe_path = self.__path / f'.probe.{token_hex(8)}'
+        probe_path.write_bytes(b'probe')
+        try:
+            with probe_path.with_suffix('.clone').open('wb') as clone_file:
+                _clone(probe_path, clone_file.fileno())
+        except OSError:
+            return False
+        finally:
+            probe_path.unlink()
+            probe_path.with_suffix('.clone').unlink(missing_ok=True)
+        return True
+
+    async def __gc_loop(self):
+        loop = get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.__collect)
+            except (OSError, sqlite3.Error) as error:
+                log.error("Unable to collect unused blobs of store '%s': %s.", self.__path, error)
+            await sleep(self.__gc_interval)
+
+    def __is_used(self, digest: str, blob_path: Path) -> bool:
+        if self.__mode == 'hardlink':
+            return blob_path.stat().st_nlink >= 2
+        with self.__lock:
+            refs = self.__db.execute('SELECT path, ino FROM refs WHERE digest = ?', (digest,)).fetchall()
+        is_used = False
+        for path, ino in refs:
+            try:
+                is_alive = Path(path).stat().st_ino == ino
+            except (FileNotFoundError, NotADirectoryError):
+                is_alive = False
+            if is_alive:
+                is_used = True
+            else:
+                with self.__lock:
+                    self.__db.execute('DELETE FROM refs WHERE path = ? AND ino = ?', (path, ino))
+        return is_used
+
+    def __collect(self):
+        """ Removes blobs which are not used by any file anymore. """
+        count = 0
+        with _locked(self.__lock_path, LOCK_EX):
+            with self.__lock:
+                digests = [digest for digest, in self.__db.execute('SELECT digest FROM blobs').fetchall()]
+            for digest in digests:
+                blob_path = self.__get_blob_path(digest)
+                try:
+                    is_used = self.__is_used(digest, blob_path)
+                except FileNotFoundError:
+                    is_used = False
+                if not is_used:
+                    self.__remove(digest)
+                    count += 1
+        log.debug("%d unused blobs of %d removed from store '%s'.", count, len(digests), self.__path)
+
+    def __get_blob_path(self, digest: str) -> Path:
+        return self.__path / digest[:2] / digest
+
+    def __remove(self, digest: str):
+        self.__get_blob_path(digest).unlink(missing_ok=True)
+        with self.__lock:
+            self.__db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+            self.__db.execute('DELETE FROM refs WHERE digest = ?', (digest,))
+
+    def __find(self, digest: str, size: int) -> Path | None:
+        with self.__lock:
+            row = self.__db.execute('SELECT size, mtime FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+        blob_path = self.__get_blob_path(digest)
+        try:
+            info = blob_path.stat()
+        except FileNotFoundError:
+            info = None
+        if info is None or (info.st_size, info.st_mtime_ns) != row or info.st_size != size:
+            log.warning("Blob '%s' is changed or removed, dropping it.", blob_path)
+            self.__remove(digest)
+            return None
+        return blob_path
+
+    def __add_ref(self, path: Path, digest: str):
+        if self.__mode == 'hardlink':
+            # Links of the blob are counted by the filesystem.
+            return
+        with self.__lock:
+            self.__db.execute('INSERT OR REPLACE INTO refs VALUES (?, ?, ?)', (str(path), digest, path.stat().st_ino))
+
+    def __add(self, path: Path, digest: str):
+        blob_path = self.__get_blob_path(digest)
+        blob_path.parent.mkdir(exist_ok=True)
+        tmp_path = blob_path.with_name(f'{digest}.{token_hex(8)}')
+        if self.__mode == 'hardlink':
+            link(path, tmp_path)
+        else:
+            tmp_fd = os_open(tmp_path, O_WRONLY | O_CREAT | O_EXCL | O_CLOEXEC, 0o600)
+            try:
+                _clone(path, tmp_fd)
+            finally:
+                os_close(tmp_fd)
+        tmp_path.replace(blob_path)
+        info = blob_path.stat()
+        with self.__lock:
+            self.__db.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)', (digest, info.st_size, info.st_mtime_ns))
+        self.__add_ref(path, digest)
+
+    def commit(self, atomic_file: AtomicFile, digest: str, size: int):
+        """ Commits the uploaded file using the stored blob with the same content if there is one. """
+        with _locked(self.__lock_path, LOCK_SH):
+            if (blob_path := self.__find(digest, size)) is None:
+                atomic_file.commit()
+                try:
+                    self.__add(atomic_file.path, digest)
+                except OSError as error:
+                    log.error("Unable to add '%s' to blobs store: %s.", atomic_file.path, error)
+                return
+
+            if self.__mode == 'hardlink':
+                link_path = atomic_file.path.with_name(f'.{atomic_file.path.name}.{token_hex(8)}.link')
+                try:
+                    link(blob_path, link_path)
+                    atomic_replace(link_path, atomic_file.path)
+                except BaseException:
+                    atomic_file.discard()
+                    raise
+                finally:
+                    # Rename does nothing when the file is already a link of the blob.
+                    link_path.unlink(missing_ok=True)
+            else:
+                # Received data is dropped without being synced, the file is made of the blob only.
+                clone_file = AtomicFile(atomic_file.path, text=False)
+                try:
+                    _clone(blob_path, clone_file.fileno())
+                    clone_file.commit()
+                except BaseException:
+                    clone_file.discard()
+                    atomic_file.discard()
+                    raise
+            atomic_file.discard()
+            self.__add_ref(atomic_file.path, digest)
+        log.info("File '%s' is deduplicated with blob '%s'.", atomic_file.path, blob_path)
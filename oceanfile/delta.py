@@ -0,0 +1,162 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import get_running_loop
+from collections import OrderedDict
+from errno import EINVAL, ENOSYS, EOPNOTSUPP, EXDEV
+from hashlib import sha1
+from io import SEEK_END
+from json import dumps as json_dumps
+from os import O_CLOEXEC, O_RDONLY, close as os_close, copy_file_range, fstat, open as os_open, pread
+from pathlib import Path
+from stat import S_ISREG
+from time import monotonic
+from typing import Any, Dict, List, Tuple
+from zlib import adler32
+
+from oceanfile.atomic import AtomicFile
+from oceanfile.oid import get_entry_oid
+
+log = logging.getLogger(__name__)
+
+# Unchanged ranges are copied by parts of this size when copy_file_range(2) is not supported.
+_COPY_SIZE = 1024 * 1024
+
+# Device, inode, modification time and size of a file.
+_FileKey = Tuple[int, int, int, int]
+
+
+def _get_file_key(path: Path) -> _FileKey | None:
+    try:
+        info = path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not S_ISREG(info.st_mode):
+        return None
+    return info.st_dev, info.st_ino, info.st_mtime_ns, info.st_size
+
+
+def _compute_blocks(path: Path, block_size: int) -> Tuple[_FileKey, bytes] | None:
+    blocks = []
+    try:
+        with path.open('rb') as src_file:
+            info = fstat(src_file.fileno())
+            while block := src_file.read(block_size):
+                blocks.append([adler32(block), sha1(block).hexdigest()])
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return None
+    body = json_dumps(dict(oid=get_entry_oid(info), size=info.st_size, block_size=block_size, blocks=blocks)).encode()
+    return (info.st_dev, info.st_ino, info.st_mtime_ns, info.st_size), body
+
+
+class BlockLists:
+    """
+    Lists of file blocks checksums serialized to JSON for delta uploads. Every block has Adler-32
+    checksum, the rolling one to find the block at any offset of the changed file, and SHA-1 hash.
+    The lists are cached by device, inode, modification time and size of the file.
+    """
+
+    def __init__(self, settings: Dict[str, Any]):
+        section: Dict[str, Any] = settings.get('delta', {})
+        self.__block_size: int = section.get('block-size', 1024 * 1024)
+        self.__max_size: int = section.get('cache-size', 16 * 1024 * 1024)
+        self.__cache: OrderedDict[_FileKey, bytes] = OrderedDict()
+        self.__size = 0
+
+    async def get(self, path: Path) -> bytes | None:
+        loop = get_running_loop()
+        if (key := await loop.run_in_executor(None, _get_file_key, path)) is None:
+            return None
+
+        if (body := self.__cache.get(key)) is not None:
+            self.__cache.move_to_end(key)
+            log.debug("Blocks of '%s' are found in cache.", path)
+            return body
+
+        start_time = monotonic()
+        if (result := await loop.run_in_executor(None, _compute_blocks, path, self.__block_size)) is None:
+            return None
+        key, body = result
+        log.debug("Blocks of '%s' computed in %.3fs, size %d.", path, monotonic() - start_time, key[-1])
+        self.__put(key, body)
+        return body
+
+    def __put(self, key: _FileKey, body: bytes):
+        if key in self.__cache or len(body) > self.__max_size:
+            return
+        self.__cache[key] = body
+        self.__size += len(body)
+        while self.__size > self.__max_size:
+            _, evicted = self.__cache.popitem(last=False)
+            self.__size -= len(evicted)
+
+
+def parse_ops(raw_ops: Any, base_size: int) -> List[Tuple[str, int, int]]:
+    """
+    Checks operations of the delta and returns them as (kind, offset, size) tuples.
+    Operations are ["copy", offset, size] to copy the range of the base file
+    and ["data", size] to take the next bytes of the request data.
+    """
+    if not isinstance(raw_ops, list):
+        raise ValueError('operations are not a list')
+    ops = []
+    for raw_op in raw_ops:
+        match raw_op:
+            case ['copy', int(offset), int(size)] if offset >= 0 and size > 0 and offset + size <= base_size:
+                ops.append(('copy', offset, size))
+            case ['data', int(size)] if size > 0:
+                ops.append(('data', 0, size))
+            case _:
+                raise ValueError(f'invalid operation {raw_op!r}')
+    return ops
+
+
+class DeltaBase:
+    """ Base version of the file opened to copy unchanged ranges from. """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.__fd = os_open(path, O_RDONLY | O_CLOEXEC)
+        info = fstat(self.__fd)
+        self.oid = get_entry_oid(info)
+        self.size = info.st_size
+
+    def copy(self, dst_file: AtomicFile, offset: int, size: int):
+        """ Appends the range to the file, sharing the data with the base if the filesystem can do it. """
+        dst_fd = dst_file.fileno()
+        use_copy_range = True
+        while size > 0:
+            if use_copy_range:
+                try:
+                    copied = copy_file_range(self.__fd, dst_fd, size, offset)
+                except OSError as error:
+                    if error.errno not in (EINVAL, ENOSYS, EOPNOTSUPP, EXDEV):
+                        raise
+                    use_copy_range = False
+                    continue
+            else:
+                data = pread(self.__fd, min(size, _COPY_SIZE), offset)
+                dst_file.write(data)
+                copied = len(data)
+            if copied == 0:
+                raise OSError(f"base file '{self.path}' is truncated")
+            offset += copied
+            size -= copied
+        # Position of the buffered file follows the descriptor one.
+        dst_file.file.seek(0, SEEK_END)
+
+    def close(self):
+        os_close(self.__fd)
@@ -20,3 +20,15 @@ class UserNotFound(Exception):
 
 class SessionNotFound(Exception):
     """ User session is not found in sessions cache. """
+
+
+class UploadOffsetMismatch(Exception):
+    """ Uploaded chunk does not continue partially uploaded file. """
+
+    def __init__(self, offset: int):
+        super().__init__(offset)
+        self.offset = offset
+
+
+class UploadInProgress(Exception):
+    """ Another chunk of the file is being uploaded right now. """
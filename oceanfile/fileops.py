@@ -0,0 +1,295 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import re
+from asyncio import CancelledError, Task, create_task, get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from dataclasses import asdict, dataclass
+from errno import EINVAL, ENOSYS, EOPNOTSUPP, EXDEV
+from fcntl import ioctl
+from io import BufferedReader, BufferedWriter
+from json import JSONDecodeError, dumps as json_dumps, loads as json_loads
+from functools import partial
+from os import copy_file_range, fstat, scandir, utime
+from pathlib import Path
+from shutil import copyfileobj, rmtree
+from time import monotonic, time
+from typing import Any, Callable, Dict, List, Set
+from uuid import uuid4
+
+from oceanfile.atomic import AtomicFile, atomic_save
+
+log = logging.getLogger(__name__)
+
+# See ioctl_ficlone(2).
+_FICLONE = 0x40049409
+# Errors of clone and copy_file_range(2) meaning that the filesystem can not do it.
+_UNSUPPORTED_ERRORS = (EINVAL, ENOSYS, EOPNOTSUPP, EXDEV)
+# Files are copied by blocks of this size when the filesystem can not share their data.
+_COPY_SIZE = 1024 * 1024
+# Progress of a task is saved not more often than this interval, in seconds.
+_PROGRESS_INTERVAL = 0.5
+# Finished tasks are forgotten after this time, in seconds.
+_TASK_TTL = 86400
+
+_TASK_ID_RE = re.compile(r'[0-9a-f]{32}')
+
+
+@dataclass
+class TaskProgress:
+    total: int
+    done: int = 0
+    finished: bool = False
+    failed_reason: str = ''
+
+
+def _get_free_path(dst_dir: Path, name: str) -> Path:
+    """ Returns path in the directory for the entry, adding a number to the name if it's taken. """
+    path = dst_dir / name
+    stem, suffix = (name, '') if path.is_dir() else (path.stem, path.suffix)
+    number = 1
+    while path.exists() or path.is_symlink():
+        path = dst_dir / f'{stem} ({number}){suffix}'
+        number += 1
+    return path
+
+
+def _count_files(path: Path) -> int:
+    if path.is_symlink() or not path.is_dir():
+        return 1
+    count = 0
+    with scandir(path) as dir_entries:
+        for entry in dir_entries:
+            if not entry.name.startswith('.') and not entry.is_symlink():
+                count += _count_files(Path(entry.path))
+    return count
+
+
+def _copy_data(src_file: BufferedReader, dst_file: AtomicFile | BufferedWriter):
+    """ Copies the file sharing its data by reflink or copy_file_range(2) if the filesystem can do it. """
+    src_fd = src_file.fileno()
+    dst_fd = dst_file.fileno()
+    try:
+        ioctl(dst_fd, _FICLONE, src_fd)
+        return
+    except OSError as error:
+        if error.errno not in _UNSUPPORTED_ERRORS:
+            raise
+    size = fstat(src_fd).st_size
+    offset = 0
+    try:
+        while offset < size and (copied := copy_file_range(src_fd, dst_fd, size - offset, offset)):
+            offset += copied
+        return
+    except OSError as error:
+        if error.errno not in _UNSUPPORTED_ERRORS or offset:
+            raise
+    copyfileobj(src_file, dst_file.file if isinstance(dst_file, AtomicFile) else dst_file, _COPY_SIZE)
+
+
+def _copy_file(src_path: Path, dst_path: Path, *, atomic: bool):
+    """ Copies the file with its modification time, atomically and durably if requested. """
+    with src_path.open('rb') as src_file:
+        info = fstat(src_file.fileno())
+        if not atomic:
+            with dst_path.open('xb') as dst_file:
+                _copy_data(src_file, dst_file)
+                dst_file.flush()
+                utime(dst_file.fileno(), ns=(info.st_atime_ns, info.st_mtime_ns))
+            return
+        atomic_file = AtomicFile(dst_path, text=False)
+        try:
+            _copy_data(src_file, atomic_file)
+            utime(atomic_file.fileno(), ns=(info.st_atime_ns, info.st_mtime_ns))
+            atomic_file.commit()
+        except BaseException:
+            atomic_file.discard()
+            raise
+
+
+def _copy_tree(src_path: Path, dst_path: Path, progress: Callable[[], None], *, atomic: bool = True):
+    if src_path.is_symlink() or not src_path.is_dir():
+        _copy_file(src_path, dst_path, atomic=atomic)
+        progress()
+        return
+    dst_path.mkdir(mode=0o755)
+    with scandir(src_path) as dir_entries:
+        # Nested symlinks are skipped, they can point outside of the share.
+        entries = sorted(entry.name for entry in dir_entries if not entry.name.startswith('.') and not entry.is_symlink())
+    for name in entries:
+        # Interrupted copy leaves an incomplete tree anyway, so files of the new directory
+        # are written in place without syncing every one of them.
+        _copy_tree(src_path / name, dst_path / name, progress, atomic=False)
+
+
+def _check_destination(src_path: Path, dst_dir: Path):
+    if dst_dir == src_path or src_path in dst_dir.parents:
+        raise ValueError(f"directory '{src_path}' can not be put into itself")
+
+
+def _copy(src_path: Path, dst_dir: Path, progress: Callable[[], None]):
+    _check_destination(src_path, dst_dir)
+    _copy_tree(src_path, _get_free_path(dst_dir, src_path.name), progress)
+
+
+def _move(src_path: Path, dst_dir: Path, progress: Callable[[], None]):
+    _check_destination(src_path, dst_dir)
+    if src_path.parent != dst_dir:
+        dst_path = _get_free_path(dst_dir, src_path.name)
+        try:
+            src_path.rename(dst_path)
+        except OSError as error:
+            if error.errno != EXDEV:
+                raise
+            # Share spans several filesystems.
+            _copy_tree(src_path, dst_path, lambda: None)
+            _remove(src_path)
+    progress()
+
+
+def _remove(path: Path):
+    if path.is_symlink() or not path.is_dir():
+        path.unlink()
+    else:
+        rmtree(path)
+
+
+def _delete(path: Path, unused_dst_dir: None, progress: Callable[[], None]):
+    _remove(path)
+    progress()
+
+
+_OPERATIONS: Dict[str, Callable[[Path, Path, Callable[[], None]], None]] = dict(copy=_copy, move=_move)
+
+
+class FileOperations:
+    """
+    Copying, moving and deleting files and directories of the share. Moves are made by rename(2),
+    copies share the data by reflink or copy_file_range(2) when the filesystem can do it.
+    Long operations run as tasks in background, their progress is kept in files, so it can be
+    queried from any worker. Parent directories of changed entries are passed to the listener.
+    """
+
+    def __init__(self, settings: Dict[str, Any], changed: Callable[[Path | None], None]):
+        section: Dict[str, Any] = settings.get('fileops', {})
+        self.__tasks_path = Path(section.get('tasks', './tasks')).resolve()
+        self.__executor = ThreadPoolExecutor(max_workers=section.get('workers', 2), thread_name_prefix='fileops')
+        self.__changed = changed
+        self.__tasks: Set[Task] = set()
+
+    async def start(self):
+        await get_running_loop().run_in_executor(self.__executor, self.__purge_tasks)
+
+    async def close(self):
+        for task in list(self.__tasks):
+            task.cancel()
+            with suppress(CancelledError):
+                await task
+        self.__executor.shutdown()
+
+    def __purge_tasks(self):
+        if not self.__tasks_path.is_dir():
+            return
+        deadline = time() - _TASK_TTL
+        for path in self.__tasks_path.glob('*.json'):
+            with suppress(FileNotFoundError):
+                if path.stat().st_mtime < deadline:
+                    path.unlink()
+
+    def __notify(self, paths: List[Path], dst_dir: Path | None):
+        for dir_path in sorted({path.parent for path in paths} | ({dst_dir} if dst_dir is not None else set())):
+            self.__changed(dir_path)
+
+    async def delete(self, paths: List[Path]):
+        try:
+            await get_running_loop().run_in_executor(self.__executor, self.__run, _delete, paths, None, None)
+        finally:
+            self.__notify(paths, None)
+        log.info('Deleted %d entries.', len(paths))
+
+    async def transfer(self, operation: str, paths: List[Path], dst_dir: Path):
+        """ Copies or moves the entries into the directory. """
+        try:
+            await get_running_loop().run_in_executor(self.__executor, self.__run, _OPERATIONS[operation], paths, dst_dir, None)
+        finally:
+            self.__notify(paths, dst_dir)
+        log.info("Made %s of %d entries to '%s'.", operation, len(paths), dst_dir)
+
+    def start_transfer(self, operation: str, paths: List[Path], dst_dir: Path) -> str:
+        """ Starts copying or moving the entries in background and returns ID of the task. """
+        task_id = uuid4().hex
+        task = create_task(self.__transfer_task(task_id, operation, paths, dst_dir))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        log.info("Task %s of %s of %d entries to '%s' started.", task_id, operation, len(paths), dst_dir)
+        return task_id
+
+    async def __transfer_task(self, task_id: str, operation: str, paths: List[Path], dst_dir: Path):
+        loop = get_running_loop()
+        progress_path = self.__tasks_path / f'{task_id}.json'
+        progress = TaskProgress(total=0)
+        # Directory is created by the first task only.
+        await loop.run_in_executor(self.__executor, partial(self.__tasks_path.mkdir, mode=0o700, parents=True, exist_ok=True))
+        await loop.run_in_executor(self.__executor, self.__save_progress, progress_path, progress)
+        try:
+            await loop.run_in_executor(self.__executor, self.__run, _OPERATIONS[operation], paths, dst_dir, progress_path)
+        except Exception:
+            log.exception('Task %s failed.', task_id)
+        finally:
+            self.__notify(paths, dst_dir)
+        log.info('Task %s finished.', task_id)
+
+    def __run(self, operation: Callable, paths: List[Path], dst_dir: Path | None, progress_path: Path | None):
+        if progress_path is None:
+            for path in paths:
+                operation(path, dst_dir, lambda: None)
+            return
+
+        progress = TaskProgress(total=sum(map(_count_files, paths)) if operation is _copy else len(paths))
+        saved_time = 0.0
+
+        def update():
+            nonlocal saved_time
+            progress.done += 1
+            if monotonic() - saved_time >= _PROGRESS_INTERVAL:
+                self.__save_progress(progress_path, progress)
+                saved_time = monotonic()
+
+        try:
+            for path in paths:
+                operation(path, dst_dir, update)
+        except Exception as error:
+            progress.failed_reason = str(error)
+            raise
+        finally:
+            progress.finished = True
+            self.__save_progress(progress_path, progress)
+
+    @staticmethod
+    def __save_progress(path: Path, progress: TaskProgress):
+        with atomic_save(path) as progress_file:
+            progress_file.write(json_dumps(asdict(progress)))
+
+    async def get_progress(self, task_id: str) -> TaskProgress | None:
+        if _TASK_ID_RE.fullmatch(task_id) is None:
+            return None
+        path = self.__tasks_path / f'{task_id}.json'
+        try:
+            data = await get_running_loop().run_in_executor(None, path.read_text)
+            return TaskProgress(**json_loads(data))
+        except (FileNotFoundError, JSONDecodeError, TypeError):
+            return None
@@ -18,7 +18,7 @@ from typing import Dict
 
 from aiohttp.web import HTTPUnauthorized, Response, json_response
 
-from oceanfile.handlers.base import BaseHandler
+from oceanfile.handlers.base import BaseHandler, check_authorization
 
 log = logging.getLogger(__name__)
 
@@ -29,15 +29,24 @@ class AuthorizationHandler(BaseHandler):
         creds: Dict[str, str] = dict(await self.request.post())
         log.debug('User credentials: %r.', creds)
 
+        # Raised errors are logged by the middleware to be used with fail2ban.
         if not (name := creds.get('username')):
-            return HTTPUnauthorized()
+            raise HTTPUnauthorized()
 
         if not (password := creds.get('password')):
-            return HTTPUnauthorized()
+            raise HTTPUnauthorized()
 
-        if not self._accounts.check(name, password):
-            return HTTPUnauthorized()
+        if not await self._accounts.check(name, password):
+            raise HTTPUnauthorized()
 
-        token = self._sessions.add(name)
+        token = await self._sessions.add(name)
         log.info('User %r successully authorized and got token %r.', name, token)
         return json_response(dict(token=token))
+
+
+class LogoutDeviceHandler(BaseHandler):
+    @check_authorization
+    async def post(self) -> Response:
+        self._sessions.revoke(self.get_token())
+        log.info('User %r logged out.', self._get_user())
+        return json_response(dict())
@@ -13,13 +13,55 @@
     If not, see <https://www.gnu.org/licenses/>.
 """
 
-from aiohttp.web import HTTPUnauthorized, View
+import logging
+from os import stat_result
+from pathlib import Path
+from stat import S_ISREG
+
+from aiohttp.web import HTTPBadRequest, HTTPUnauthorized, View
 
 from oceanfile.accounts import UserAccounts
 from oceanfile.sessions import AuthSessions
+from oceanfile.settings import ShareSettings
+
+log = logging.getLogger(__name__)
+
+
+def get_share_path(settings: ShareSettings, path: str, *, follow: bool = True) -> Path:
+    """
+    Returns the path in the share, the request is rejected if it points outside of the share.
+    Symlinks are followed for the check, the last one only if follow is set, so the entry
+    which is a symlink itself can be removed or moved, but it's not the share root then.
+    """
+    if '..' in path:
+        log.error("Path '%s' contains trash.", path)
+        raise HTTPBadRequest()
+    # Several leading slashes would make the path absolute.
+    share_path = settings.path / path.lstrip('/')
+    if follow:
+        is_inside = share_path.resolve().is_relative_to(settings.path)
+    else:
+        is_inside = share_path != settings.path and (share_path.parent.resolve() / share_path.name).is_relative_to(settings.path)
+    if not is_inside:
+        log.error("Path '%s' is outside of the share.", path)
+        raise HTTPBadRequest()
+    return share_path
+
+
+def stat_file(path: Path) -> stat_result | None:
+    """ Returns info of the regular file or None if it does not exist. """
+    try:
+        info = path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return info if S_ISREG(info.st_mode) else None
 
 
 class BaseHandler(View):
+    # Only upload and download links carry the token in the query, other requests must not
+    # accept it there, so it does not leak to logs and referrers.
+    _TOKEN_IN_QUERY = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._accounts: UserAccounts = self.request.app['accounts']
@@ -27,6 +69,9 @@ class BaseHandler(View):
 
     def get_token(self) -> str:
         header: str = self.request.headers.get('Authorization', '')
+        if not header and self._TOKEN_IN_QUERY and (token := self.request.query.get('token')):
+            return token
+
         if ' ' not in header:
             raise HTTPUnauthorized()
 
@@ -37,6 +82,9 @@ class BaseHandler(View):
         return token
 
     def _get_user(self) -> str:
+        # User is known already when the request is authorized.
+        if (user := self.request.get('user')) is not None:
+            return user
         return self._sessions.get_user(self.get_token())
 
 
@@ -44,8 +92,8 @@ def check_authorization(handler_method):
     async def wrapper(self: BaseHandler, *args, **kwargs):
         token = self.get_token()
         sessions: AuthSessions = self.request.app['sessions']
-        if not sessions.check(token):
+        if (user := await sessions.authorize(token)) is None:
             raise HTTPUnauthorized()
-        sessions.update(token)
+        self.request['user'] = user
         return await handler_method(self, *args, **kwargs)
     return wrapper
@@ -0,0 +1,179 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import get_running_loop
+from functools import partial
+from json import JSONDecodeError, loads as json_loads
+from typing import Any, List, Tuple
+
+from aiohttp import BodyPartReader, MultipartReader
+from aiohttp.web import (
+    HTTPBadRequest,
+    HTTPNotFound,
+    HTTPPreconditionFailed,
+    HTTPRequestEntityTooLarge,
+    Response,
+)
+
+from oceanfile.admission import UploadAdmission
+from oceanfile.atomic import AtomicFile
+from oceanfile.delta import BlockLists, DeltaBase, parse_ops
+from oceanfile.handlers.base import BaseHandler, check_authorization, get_share_path
+from oceanfile.handlers.upload import uploaded_bytes
+from oceanfile.oid import get_entry_oid
+from oceanfile.settings import ShareSettings
+from oceanfile.thumbnails import Thumbnails
+from oceanfile.watcher import ShareWatcher
+
+log = logging.getLogger(__name__)
+
+# Data is written to disk by chunks of this size to keep the number of executor calls low.
+_CHUNK_SIZE = 1024 * 1024
+
+
+class _DataReader:
+    """ Reads the data part by any sizes, aiohttp reads chunks not shorter than the boundary only. """
+
+    def __init__(self, part: BodyPartReader):
+        self.__part = part
+        self.__buffer = b''
+        self.__offset = 0
+
+    async def read(self, size: int) -> bytes:
+        """ Returns at most size bytes, nothing at the end of the part. """
+        if self.__offset == len(self.__buffer):
+            self.__buffer = await self.__part.read_chunk(_CHUNK_SIZE)
+            self.__offset = 0
+        chunk = self.__buffer[self.__offset:self.__offset + size]
+        self.__offset += len(chunk)
+        return chunk
+
+
+async def _receive_exactly(reader: _DataReader, dst_file: AtomicFile, size: int):
+    loop = get_running_loop()
+    while size > 0:
+        if not (chunk := await reader.read(min(size, _CHUNK_SIZE))):
+            log.error("Delta data of '%s' is incomplete.", dst_file.path)
+            raise HTTPBadRequest()
+        size -= len(chunk)
+        uploaded_bytes.inc(len(chunk))
+        await loop.run_in_executor(None, dst_file.write, chunk)
+
+
+class FileDeltaHandler(BaseHandler):
+    """
+    Delta uploads of changed files. GET returns checksums of the file blocks, POST takes
+    a multipart request with the "delta" JSON part {"base": oid, "ops": [...]} and the "data"
+    part with the new bytes, and rebuilds the file copying unchanged ranges from the base.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__settings: ShareSettings = self.request.app['share_settings']
+        self.__block_lists: BlockLists = self.request.app['block_lists']
+        self.__max_size = self.request.app['server_settings'].max_upload_size
+        self.__watcher: ShareWatcher = self.request.app['watcher']
+        self.__thumbnails: Thumbnails = self.request.app['thumbnails']
+        self.__admission: UploadAdmission = self.request.app['admission']
+
+    @check_authorization
+    async def get(self) -> Response:
+        path: str = self.request.query['p']
+        file_path = get_share_path(self.__settings, path)
+        if (body := await self.__block_lists.get(file_path)) is None:
+            log.error("File '%s' is not found.", file_path)
+            return HTTPNotFound()
+        return Response(body=body, content_type='application/json')
+
+    @check_authorization
+    async def post(self) -> Response:
+        if 'multipart/form-data' not in self.request.content_type:
+            log.error('Unexpected Content-Type %r.', self.request.content_type)
+            return HTTPBadRequest()
+
+        path: str = self.request.query['p']
+        file_path = get_share_path(self.__settings, path)
+
+        reader = await self.request.multipart()
+        part = await reader.next()
+        if not isinstance(part, BodyPartReader) or part.name != 'delta':
+            log.error('Delta is not found in the request.')
+            return HTTPBadRequest()
+        try:
+            delta: Any = json_loads(await part.read())
+        except (JSONDecodeError, UnicodeDecodeError) as error:
+            log.error('Invalid delta: %s.', error)
+            return HTTPBadRequest()
+        if not isinstance(delta, dict) or not isinstance(delta.get('base'), str):
+            log.error('Base of the delta is not set.')
+            return HTTPBadRequest()
+
+        loop = get_running_loop()
+        try:
+            base = await loop.run_in_executor(None, DeltaBase, file_path)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            log.error("File '%s' is not found.", file_path)
+            return HTTPNotFound()
+
+        try:
+            if base.oid != delta['base']:
+                log.error("File '%s' is changed since version '%s'.", file_path, delta['base'])
+                return HTTPPreconditionFailed()
+            try:
+                ops = parse_ops(delta.get('ops'), base.size)
+            except ValueError as error:
+                log.error("Invalid delta of '%s': %s.", file_path, error)
+                return HTTPBadRequest()
+            size = sum(op_size for _, _, op_size in ops)
+            if size > self.__max_size:
+                log.error("File '%s' exceeds upload size limit %d.", file_path, self.__max_size)
+                return HTTPRequestEntityTooLarge(max_size=self.__max_size, actual_size=size)
+            # Rebuilt file takes the space, the request itself is much smaller for a small delta.
+            async with self.__admission.admit(self._get_user(), size):
+                await self.__rebuild(reader, base, ops)
+        finally:
+            base.close()
+
+        self.__watcher.changed(file_path.parent)
+        self.__thumbnails.prewarm(file_path)
+        copied = sum(op_size for kind, _, op_size in ops if kind == 'copy')
+        log.info("File '%s' updated by delta, size %d, %d bytes reused.", file_path, size, copied)
+        return Response(text=get_entry_oid(await loop.run_in_executor(None, file_path.stat)))
+
+    async def __rebuild(self, reader: MultipartReader, base: DeltaBase, ops: List[Tuple[str, int, int]]):
+        loop = get_running_loop()
+        data_reader = None
+        if any(kind == 'data' for kind, _, _ in ops):
+            data_part = await reader.next()
+            if not isinstance(data_part, BodyPartReader) or data_part.name != 'data':
+                log.error("Data of the delta of '%s' is not found.", base.path)
+                raise HTTPBadRequest()
+            data_reader = _DataReader(data_part)
+
+        atomic_file = await loop.run_in_executor(None, partial(AtomicFile, base.path, text=False))
+        try:
+            for kind, offset, size in ops:
+                if kind == 'copy':
+                    await loop.run_in_executor(None, base.copy, atomic_file, offset, size)
+                else:
+                    await _receive_exactly(data_reader, atomic_file, size)
+            if data_reader is not None and await data_reader.read(1):
+                log.error("Data of the delta of '%s' is too long.", base.path)
+                raise HTTPBadRequest()
+            await loop.run_in_executor(None, atomic_file.commit)
+        except BaseException:
+            atomic_file.discard()
+            raise
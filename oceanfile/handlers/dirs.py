@@ -14,65 +14,121 @@
 """
 
 import logging
+from asyncio import get_running_loop
 from pathlib import Path
-from typing import Any, Dict
+from typing import AsyncIterator, Dict
 
-from aiohttp.web import HTTPBadRequest, HTTPNotFound, Response, json_response
+from aiohttp.web import HTTPBadRequest, HTTPConflict, HTTPForbidden, HTTPNotFound, HTTPNotModified, Response, StreamResponse, json_response
+from multidict import MultiMapping
 
-from oceanfile.handlers.base import BaseHandler, check_authorization
-from oceanfile.oid import create_oid
+from oceanfile.handlers.base import BaseHandler, check_authorization, get_share_path
+from oceanfile.listing import DirListings, get_entry_info, stream_dir
+from oceanfile.replies import ReplyEncoder, json_reply
 from oceanfile.settings import ShareSettings
+from oceanfile.watcher import ShareWatcher
 
 log = logging.getLogger(__name__)
 
+_ENTRY_TYPES = {'d': 'dir', 'f': 'file'}
+
+
+def _get_int_param(query: MultiMapping[str], name: str, default: int) -> int:
+    value = query.get(name)
+    if value is None:
+        return default
+    # Other Unicode digits like superscripts are not accepted by int().
+    if not (value.isascii() and value.isdigit()):
+        log.error('Invalid %s %r.', name, value)
+        raise HTTPBadRequest()
+    return int(value)
+
 
 class ManageDirsHandler(BaseHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.__settings: ShareSettings = self.request.app['share_settings']
-
-    @staticmethod
-    def __get_info(obj_path: Path) -> Dict[str, Any] | None:
-        name = obj_path.name
-        if name.startswith('.'):
-            # Skip hidden files.
-            return None
-
-        if obj_path.is_dir():
-            obj_info = dict(type='dir', size=None)
-        elif obj_path.is_file():
-            obj_info = dict(type='file', size=obj_path.stat().st_size)
-        else:
-            log.warning("Unsupported FS object '%s'.", obj_path)
-            return None
-
-        return dict(
-            id=create_oid(),
-            mtime=int(obj_path.stat().st_mtime),
-            name=name,
-            permission='rw',
-            **obj_info,
-        )
+        self.__listings: DirListings = self.request.app['listings']
+        self.__encoder: ReplyEncoder = self.request.app['encoder']
+        self.__watcher: ShareWatcher = self.request.app['watcher']
 
     @check_authorization
     async def get(self) -> Response:
         path: str = self.request.query['p']
-        dir_path = self.__settings.path / path.removeprefix('/')
-        if '..' in path:
-            log.error("Path '%s' contains trash.", path)
-            return HTTPBadRequest()
-
-        if not dir_path.is_dir():
+        dir_path = get_share_path(self.__settings, path)
+
+        if self.request.query.get('recursive') == '1':
+            # Type of entries to list: d - directories, f - files, all by default.
+            entry_type = _ENTRY_TYPES.get(self.request.query.get('t', ''))
+            log.debug("Listing tree of directory '%s', type %r.", dir_path, entry_type)
+            return await self.__stream(dir_path, self.__listings.walk(dir_path, '/' + path.strip('/'), entry_type))
+
+        if self.request.query.get('stream') == '1':
+            log.debug("Streaming listing of directory '%s'.", dir_path)
+            return await self.__stream(dir_path, stream_dir(dir_path))
+
+        offset = _get_int_param(self.request.query, 'offset', 0)
+        limit = _get_int_param(self.request.query, 'limit', 0)
+
+        try:
+            listing = await self.__listings.get(dir_path)
+        except PermissionError:
+            log.error("Directory '%s' is not readable.", dir_path)
+            return HTTPForbidden()
+        if listing is None:
             log.error("Directory '%s' is not found.", dir_path)
             return HTTPNotFound()
 
-        dir_entries = [
-            entry for path in dir_path.glob('*')
-            if (entry := self.__get_info(path)) is not None
-        ]
-        log.debug("Listing directory '%s', entries: %r", dir_path, dir_entries[:8])
-
-        return json_response(dir_entries, headers={'oid': create_oid()})
+        headers = {'oid': listing.oid, 'ETag': f'"{listing.oid}"'}
+        if self.request.query.get('oid') == listing.oid:
+            log.debug("Directory '%s' is not changed.", dir_path)
+            return json_response('uptodate', headers=headers)
+        if any(etag.value == listing.oid for etag in self.request.if_none_match or ()):
+            log.debug("Directory '%s' is not changed.", dir_path)
+            return HTTPNotModified(headers=headers)
+
+        if offset or limit:
+            # Entries are sorted by name, so the pages are stable while the directory is not changed.
+            headers['X-Total-Count'] = str(listing.count)
+            body = listing.get_page(offset, limit or listing.count)
+            log.debug("Listing directory '%s' from %d, limit %d.", dir_path, offset, limit)
+            if (encoding := self.__encoder.get_encoding(self.request, len(body))) is not None:
+                loop = get_running_loop()
+                body = await loop.run_in_executor(None, self.__encoder.compress, body, encoding)
+            return json_reply(body, encoding=encoding, headers=headers)
+
+        log.debug("Listing directory '%s'.", dir_path)
+        body = listing.body
+        if (encoding := self.__encoder.get_encoding(self.request, len(body))) is not None:
+            body = await self.__listings.get_encoded(dir_path, listing, encoding, self.__encoder.compress)
+        return json_reply(body, encoding=encoding, headers=headers)
+
+    async def __stream(self, dir_path: Path, chunks: AsyncIterator[bytes]) -> StreamResponse:
+        try:
+            first_chunk = await anext(chunks)
+        except (FileNotFoundError, NotADirectoryError):
+            log.error("Directory '%s' is not found.", dir_path)
+            return HTTPNotFound()
+        except PermissionError:
+            log.error("Directory '%s' is not readable.", dir_path)
+            return HTTPForbidden()
+
+        response = StreamResponse()
+        response.content_type = 'application/json'
+        if self.__encoder.is_enabled():
+            # Chunks are compressed on the fly.
+            response.enable_compression()
+        await response.prepare(self.request)
+        try:
+            await response.write(first_chunk)
+            async for chunk in chunks:
+                await response.write(chunk)
+        except ConnectionResetError:
+            log.debug("Listing of directory '%s' is interrupted by the client.", dir_path)
+            return response
+        finally:
+            await chunks.aclose()
+        await response.write_eof()
+        return response
 
     @check_authorization
     async def post(self) -> Response:
@@ -83,17 +139,32 @@ class ManageDirsHandler(BaseHandler):
             return HTTPBadRequest()
 
         path: str = self.request.query['p']
-        dir_path = self.__settings.path / path.removeprefix('/')
-
-        if '..' in path:
-            log.error("Path '%s' contains trash", path)
+        dir_path = get_share_path(self.__settings, path)
+
+        try:
+            if dir_path.is_dir():
+                log.debug("Directory '%s' already exist.", dir_path)
+            elif dir_ops.get('create_parents', '').lower() == 'true':
+                # The topmost created directory is the one to report.
+                top_path = dir_path
+                while not top_path.parent.exists():
+                    top_path = top_path.parent
+                dir_path.mkdir(mode=0o755, parents=True)
+                self.__watcher.changed(top_path.parent)
+                log.info("New directory '%s' created with parents.", dir_path)
+            else:
+                dir_path.mkdir(mode=0o755)
+                self.__watcher.changed(dir_path.parent)
+                log.info("New directory '%s' created.", dir_path)
+        except FileExistsError:
+            log.error("Directory '%s' can not be created, file is in the way.", dir_path)
+            return HTTPConflict()
+        except NotADirectoryError:
+            log.error("Directory '%s' can not be created, its parent is a file.", dir_path)
             return HTTPBadRequest()
+        except FileNotFoundError:
+            log.error("Parent of directory '%s' is not found.", dir_path)
+            return HTTPNotFound()
 
-        if dir_path.is_dir():
-            log.debug("Directory '%s' already exist.", dir_path)
-        else:
-            dir_path.mkdir(mode=0o755)
-            log.info("New directory '%s' created.", dir_path)
-
-        dir_info = self.__get_info(dir_path)
+        dir_info = get_entry_info(dir_path.name, dir_path.stat(), True)
         return json_response(dir_info, headers={'oid': dir_info['id']})
@@ -0,0 +1,83 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import get_running_loop
+from os import stat_result
+from pathlib import Path
+from urllib.parse import quote
+
+from aiohttp.abc import AbstractStreamWriter
+from aiohttp.hdrs import IF_RANGE, RANGE
+from aiohttp.web import BaseRequest, FileResponse, HTTPNotFound, Response
+from multidict import CIMultiDict
+from yarl import URL
+
+from oceanfile.handlers.base import BaseHandler, check_authorization, get_share_path, stat_file
+
+log = logging.getLogger(__name__)
+
+DOWNLOAD_URI = '/self/download'
+
+
+class _FileResponse(FileResponse):
+    """
+    FileResponse handles ETag (made of mtime and size), conditional and range requests itself
+    and sends the file using sendfile(2). But If-Range is compared to the modification date only.
+    """
+
+    def __init__(self, path: Path, info: stat_result, **kwargs):
+        super().__init__(path, **kwargs)
+        self.__etag = f'"{info.st_mtime_ns:x}-{info.st_size:x}"'
+
+    async def prepare(self, request: BaseRequest) -> AbstractStreamWriter | None:
+        if_range = request.headers.get(IF_RANGE, '')
+        if RANGE in request.headers and if_range.startswith(('"', 'W/')) and if_range != self.__etag:
+            # File is changed so it's sent entirely.
+            headers = CIMultiDict(request.headers)
+            del headers[RANGE]
+            request = request.clone(headers=headers)
+        return await super().prepare(request)
+
+
+class DownloadLinkHandler(BaseHandler):
+    @check_authorization
+    async def get(self) -> Response:
+        path: str = self.request.query['p']
+        file_path = get_share_path(self.request.app['share_settings'], path)
+        if await get_running_loop().run_in_executor(None, stat_file, file_path) is None:
+            log.error("File '%s' is not found.", file_path)
+            return HTTPNotFound()
+        url = URL.build(scheme='https', authority=self.request.host, path=DOWNLOAD_URI, query=dict(token=self.get_token(), path=path))
+        log.debug("Download file URL '%s' created.", url)
+        return Response(text=f'"{url!s}"', content_type='text/plain')
+
+
+class DownloadFileHandler(BaseHandler):
+    _TOKEN_IN_QUERY = True
+
+    @check_authorization
+    async def get(self) -> Response:
+        path: str = self.request.query['path']
+        file_path = get_share_path(self.request.app['share_settings'], path)
+        if (info := await get_running_loop().run_in_executor(None, stat_file, file_path)) is None:
+            log.error("File '%s' is not found.", file_path)
+            return HTTPNotFound()
+
+        log.debug("Downloading file '%s'.", file_path)
+        return _FileResponse(file_path, info, headers={
+            'Cache-Control': 'private, no-cache',
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(file_path.name)}",
+        })
@@ -0,0 +1,148 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from json import JSONDecodeError
+from pathlib import Path
+from typing import Any, Dict, List
+
+from aiohttp.web import HTTPBadRequest, HTTPNotFound, Response, json_response
+
+from oceanfile.fileops import FileOperations
+from oceanfile.handlers.base import BaseHandler, check_authorization, get_share_path
+from oceanfile.settings import ShareSettings
+
+log = logging.getLogger(__name__)
+
+
+class _BatchHandler(BaseHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._settings: ShareSettings = self.request.app['share_settings']
+        self._fileops: FileOperations = self.request.app['fileops']
+
+    async def _get_body(self) -> Dict[str, Any]:
+        try:
+            body = await self.request.json()
+        except (JSONDecodeError, UnicodeDecodeError) as error:
+            log.error('Invalid batch request: %s.', error)
+            raise HTTPBadRequest()
+        if not isinstance(body, dict):
+            log.error('Invalid batch request %r.', body)
+            raise HTTPBadRequest()
+        return body
+
+    def _get_dir(self, dir_name: Any) -> Path:
+        if not isinstance(dir_name, str):
+            log.error('Invalid directory %r.', dir_name)
+            raise HTTPBadRequest()
+        dir_path = get_share_path(self._settings, dir_name)
+        if not dir_path.is_dir():
+            log.error("Directory '%s' is not found.", dir_path)
+            raise HTTPNotFound()
+        return dir_path
+
+    def _get_paths(self, dir_path: Path, dirents: Any) -> List[Path]:
+        if not isinstance(dirents, list) or not dirents:
+            log.error('Invalid entries %r.', dirents)
+            raise HTTPBadRequest()
+        dir_name = str(dir_path.relative_to(self._settings.path))
+        paths = []
+        for name in dirents:
+            if not isinstance(name, str) or name.strip('/') in ('', '.', '..') or '/' in name.strip('/'):
+                log.error('Invalid entry %r.', name)
+                raise HTTPBadRequest()
+            # Entry itself is not followed if it's a symlink.
+            path = get_share_path(self._settings, f'{dir_name}/{name.strip("/")}', follow=False)
+            if not path.exists() and not path.is_symlink():
+                log.error("Path '%s' is not found.", path)
+                raise HTTPNotFound()
+            paths.append(path)
+        return paths
+
+
+class BatchTransferHandler(_BatchHandler):
+    """ Copies or moves entries, in background if the task is asynchronous. """
+
+    _operation = ''
+    _is_async = False
+
+    @check_authorization
+    async def post(self) -> Response:
+        body = await self._get_body()
+        src_dir = self._get_dir(body.get('src_parent_dir'))
+        dst_dir = self._get_dir(body.get('dst_parent_dir'))
+        paths = self._get_paths(src_dir, body.get('src_dirents'))
+        if self._operation == 'copy':
+            for path in paths:
+                # Content of symlinks pointing outside of the share is not copied into it.
+                get_share_path(self._settings, str(path.relative_to(self._settings.path)))
+        if any(dst_dir == path or path in dst_dir.parents for path in paths):
+            log.error("Directory '%s' is inside of the moved or copied one.", dst_dir)
+            return HTTPBadRequest()
+
+        if self._is_async:
+            task_id = self._fileops.start_transfer(self._operation, paths, dst_dir)
+            return json_response(dict(task_id=task_id))
+        await self._fileops.transfer(self._operation, paths, dst_dir)
+        return json_response(dict(success=True))
+
+
+class SyncBatchCopyHandler(BatchTransferHandler):
+    _operation = 'copy'
+
+
+class SyncBatchMoveHandler(BatchTransferHandler):
+    _operation = 'move'
+
+
+class AsyncBatchCopyHandler(BatchTransferHandler):
+    _operation = 'copy'
+    _is_async = True
+
+
+class AsyncBatchMoveHandler(BatchTransferHandler):
+    _operation = 'move'
+    _is_async = True
+
+
+class BatchDeleteHandler(_BatchHandler):
+    @check_authorization
+    async def delete(self) -> Response:
+        body = await self._get_body()
+        dir_path = self._get_dir(body.get('parent_dir'))
+        paths = self._get_paths(dir_path, body.get('dirents'))
+        await self._fileops.delete(paths)
+        return json_response(dict(success=True))
+
+
+class CopyMoveProgressHandler(BaseHandler):
+    @check_authorization
+    async def get(self) -> Response:
+        fileops: FileOperations = self.request.app['fileops']
+        task_id: str = self.request.query.get('task_id', '')
+        if (progress := await fileops.get_progress(task_id)) is None:
+            log.error('Task %r is not found.', task_id)
+            return HTTPNotFound()
+        return json_response(dict(
+            done=progress.finished,
+            total=progress.total,
+            # Number of already copied or moved files.
+            copied=progress.done,
+            canceled=False,
+            failed=bool(progress.failed_reason),
+            failed_reason=progress.failed_reason,
+            successful=progress.finished and not progress.failed_reason,
+        ))
@@ -13,12 +13,14 @@
     If not, see <https://www.gnu.org/licenses/>.
 """
 
-from aiohttp.web import Response, json_response
+from aiohttp.web import Response
 
 from oceanfile.handlers.base import BaseHandler, check_authorization
-from oceanfile.settings import ServerSettings, ShareSettings
+from oceanfile.replies import ReplyEncoder, json_dumps, json_reply
+from oceanfile.usage import DiskUsage
 
 _SERVER_VERSION = '9.0.4'
+_SERVER_INFO = json_dumps(dict(version=_SERVER_VERSION, features=''))
 
 
 class AccountInfoHandler(BaseHandler):
@@ -26,16 +28,20 @@ class AccountInfoHandler(BaseHandler):
     async def get(self) -> Response:
         name = self._get_user()
         email = self._accounts.get_email(name)
-        settings: ShareSettings = self.request.app['share_settings']
-        return json_response(dict(
+        usage: DiskUsage = self.request.app['usage']
+        encoder: ReplyEncoder = self.request.app['encoder']
+        # Both are unknown until the share is scanned.
+        used = usage.get_usage()
+        total = None if used is None else used + usage.get_free()
+        return encoder.reply(self.request, ('account', name, email, used, total), lambda: dict(
             email=email,
             name=name,
-            total=settings.max_size,
-            usage=0,
+            total=total,
+            usage=used,
         ))
 
 
 class ServerInfoHandler(BaseHandler):
     @check_authorization
     async def get(self) -> Response:
-        return json_response(dict(version=_SERVER_VERSION, features=''))
+        return json_reply(_SERVER_INFO)
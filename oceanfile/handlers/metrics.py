@@ -0,0 +1,35 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+
+from aiohttp.web import HTTPNotFound, Response, View
+
+from oceanfile.metrics import WorkersMetrics
+from oceanfile.settings import MetricsSettings
+
+log = logging.getLogger(__name__)
+
+
+class MetricsHandler(View):
+    async def get(self) -> Response:
+        settings: MetricsSettings = self.request.app['metrics_settings']
+        # Requests passed by a reverse proxy come from its address, so they are refused.
+        is_proxied = 'X-Forwarded-For' in self.request.headers or 'Forwarded' in self.request.headers
+        if not settings.enabled or is_proxied or self.request.remote not in settings.allow:
+            log.debug('Metrics request from %s refused.', self.request.remote)
+            return HTTPNotFound()
+        metrics: WorkersMetrics = self.request.app['metrics']
+        return Response(body=metrics.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
@@ -13,12 +13,13 @@
     If not, see <https://www.gnu.org/licenses/>.
 """
 
-from time import time
-
-from aiohttp.web import Response, json_response
+from aiohttp.web import Response
 
 from oceanfile.handlers.base import BaseHandler, check_authorization
+from oceanfile.replies import ReplyEncoder
 from oceanfile.settings import ShareSettings
+from oceanfile.usage import DiskUsage
+from oceanfile.watcher import ShareWatcher
 
 
 class ReposListHandler(BaseHandler):
@@ -26,18 +27,25 @@ class ReposListHandler(BaseHandler):
     async def get(self) -> Response:
         name = self._get_user()
         settings: ShareSettings = self.request.app['share_settings']
-        return json_response([
+        usage: DiskUsage = self.request.app['usage']
+        watcher: ShareWatcher = self.request.app['watcher']
+        encoder: ReplyEncoder = self.request.app['encoder']
+        mtime = watcher.get_mtime()
+        # It's null until the share is scanned.
+        size = usage.get_usage()
+        # Reply is rebuilt only when the share is changed.
+        return encoder.reply(self.request, ('repos', name, mtime, size), lambda: [
             dict(
                 encrypted=False,
                 id=settings.id,
                 magic='',
-                mtime=int(time() - 60),
+                mtime=mtime,
                 name=settings.name,
                 owner=name,
                 permission='rw',
                 random_key='',
                 root='',
-                size=settings.max_size,
+                size=size,
                 type='repo',
             )
         ])
@@ -0,0 +1,82 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+
+from aiohttp.web import HTTPBadRequest, HTTPNotFound, Response, json_response
+
+from oceanfile.handlers.base import BaseHandler, check_authorization, get_share_path
+from oceanfile.search import MAX_TOTAL, MIN_QUERY_LENGTH, SearchIndex
+from oceanfile.settings import ShareSettings
+
+log = logging.getLogger(__name__)
+
+# Maximum number of results on a page.
+_MAX_PER_PAGE = 100
+
+
+class SearchHandler(BaseHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__settings: ShareSettings = self.request.app['share_settings']
+        self.__index: SearchIndex = self.request.app['search']
+
+    @check_authorization
+    async def get(self) -> Response:
+        if not self.__index.is_enabled():
+            log.error('Search is disabled.')
+            return HTTPNotFound()
+
+        query = self.request.query.get('q', '').strip()
+        page = self.request.query.get('page', '1')
+        per_page = self.request.query.get('per_page', '10')
+        # Other Unicode digits like superscripts are not accepted by int(), long numbers are out of range anyway.
+        is_valid = query and all(value.isascii() and value.isdigit() and len(value) <= 6 for value in (page, per_page))
+        if not is_valid or int(page) < 1 or not 0 < int(per_page) <= _MAX_PER_PAGE:
+            log.error('Invalid search request %r.', self.request.query_string)
+            return HTTPBadRequest()
+        if len(query) < MIN_QUERY_LENGTH:
+            # Such query would be a scan of the whole index.
+            log.error('Search query %r is too short.', query)
+            return HTTPBadRequest()
+
+        repo_id = self.request.query.get('search_repo', 'all')
+        if repo_id not in ('all', self.__settings.id):
+            return json_response(dict(total=0, results=[], has_more=False))
+
+        offset = (int(page) - 1) * int(per_page)
+        if offset >= MAX_TOTAL:
+            log.error('Search results after the first %d are not available.', MAX_TOTAL)
+            return HTTPBadRequest()
+
+        dir_path = get_share_path(self.__settings, self.request.query.get('search_path', '/'))
+        results, total = await self.__index.search(query, dir_path, offset, int(per_page))
+        return json_response(dict(
+            total=total,
+            has_more=offset + len(results) < total,
+            results=[
+                dict(
+                    repo_id=self.__settings.id,
+                    repo_name=self.__settings.name,
+                    name=result.name,
+                    fullpath=f'/{result.path}',
+                    is_dir=result.is_dir,
+                    size=result.size,
+                    last_modified=result.mtime,
+                    content_highlight='',
+                )
+                for result in results
+            ],
+        ))
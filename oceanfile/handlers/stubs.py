@@ -25,13 +25,6 @@ class AvatarInfoHandler(BaseHandler):
         return json_response(None)
 
 
-class ThumbnailHandler(BaseHandler):
-    @check_authorization
-    async def get(self) -> Response:
-        # Thumbnails support is not implemented.
-        return json_response(None)
-
-
 class StarredHandler(BaseHandler):
     @check_authorization
     async def get(self) -> Response:
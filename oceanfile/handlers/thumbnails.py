@@ -0,0 +1,51 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import get_running_loop
+
+from aiohttp.web import FileResponse, HTTPBadRequest, HTTPNotFound, Response, json_response
+
+from oceanfile.handlers.base import BaseHandler, check_authorization, get_share_path, stat_file
+from oceanfile.thumbnails import Thumbnails
+
+log = logging.getLogger(__name__)
+
+_MAX_SIZE = 1024
+
+
+class ThumbnailHandler(BaseHandler):
+    @check_authorization
+    async def get(self) -> Response:
+        thumbnails: Thumbnails = self.request.app['thumbnails']
+        if not thumbnails.is_enabled():
+            return json_response(None)
+
+        path: str = self.request.query['p']
+        size = self.request.query.get('size', '')
+        if not (size.isascii() and size.isdigit()) or not 0 < int(size) <= _MAX_SIZE:
+            log.error('Invalid thumbnail size %r.', size)
+            return HTTPBadRequest()
+
+        file_path = get_share_path(self.request.app['share_settings'], path)
+        if (info := await get_running_loop().run_in_executor(None, stat_file, file_path)) is None:
+            log.error("File '%s' is not found.", file_path)
+            return HTTPNotFound()
+
+        if (thumb_path := await thumbnails.get(file_path, info, int(size))) is None:
+            return HTTPNotFound()
+
+        # URL stays the same when the file changes, so clients revalidate by ETag of the thumbnail.
+        return FileResponse(thumb_path, headers={'Cache-Control': 'private, no-cache'})
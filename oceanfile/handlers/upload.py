@@ -14,51 +14,281 @@
 """
 
 import logging
-from shutil import copyfileobj
+import re
+from asyncio import get_running_loop
+from functools import partial
+from hashlib import sha256
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
 
-from aiohttp.web import FileField, HTTPBadRequest, HTTPNotFound, Response
+from aiohttp import BodyPartReader
+from aiohttp.multipart import content_disposition_filename, parse_content_disposition
+from aiohttp.web import (
+    HTTPBadRequest,
+    HTTPConflict,
+    HTTPNotFound,
+    HTTPRequestEntityTooLarge,
+    HTTPRequestRangeNotSatisfiable,
+    Response,
+    json_response,
+)
 from yarl import URL
 
-from oceanfile.atomic import atomic_save
-from oceanfile.handlers.base import BaseHandler, check_authorization
-from oceanfile.oid import create_oid
-from oceanfile.settings import ShareSettings
+from oceanfile.admission import UploadAdmission
+from oceanfile.atomic import AtomicFile
+from oceanfile.dedup import DedupStore
+from oceanfile.errors import UploadInProgress, UploadOffsetMismatch
+from oceanfile.handlers.base import BaseHandler, check_authorization, get_share_path
+from oceanfile.metrics import Counter
+from oceanfile.oid import get_entry_oid
+from oceanfile.settings import ServerSettings, ShareSettings
+from oceanfile.thumbnails import Thumbnails
+from oceanfile.uploads import PartialUpload
+from oceanfile.watcher import ShareWatcher
 
 log = logging.getLogger(__name__)
 
 UPLOAD_URI = '/self/upload'
 
+# Data is written to disk by chunks of this size to keep the number of executor calls low.
+_CHUNK_SIZE = 1024 * 1024
+
+_CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+
+uploaded_bytes = Counter('oceanfile_upload_bytes_total', 'Number of received bytes of uploaded files.')
+
+
+def _get_file_path(settings: ShareSettings, dir_name: str, file_name: str) -> Path:
+    # File itself is not followed if it's a symlink.
+    path = get_share_path(settings, f'{dir_name}/{file_name.removeprefix("/")}', follow=False)
+    if not path.parent.is_dir():
+        log.error("Directory '%s' is not found.", path)
+        raise HTTPNotFound()
+    return path
+
+
+def _make_upload_path(settings: ShareSettings, dir_name: str, relative_path: str, file_name: str) -> Tuple[Path, Path | None]:
+    """ Returns path of the file uploaded to the directory by the relative path and the topmost directory created for it. """
+    dir_path = get_share_path(settings, dir_name)
+    parts = [part for part in relative_path.split('/') if part]
+    # Hidden names are reserved for partial uploads and temporary files.
+    if any(part.startswith('.') for part in parts) or '/' in file_name.strip('/'):
+        log.error('Relative path %r of %r contains trash.', relative_path, file_name)
+        raise HTTPBadRequest()
+    path = get_share_path(settings, '/'.join([dir_name, *parts, file_name.strip('/')]), follow=False)
+    if not dir_path.is_dir():
+        log.error("Directory '%s' is not found.", dir_path)
+        raise HTTPNotFound()
+    if path.parent.is_dir():
+        return path, None
+    top_path = path.parent
+    while not top_path.parent.exists():
+        top_path = top_path.parent
+    try:
+        path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    except (FileExistsError, NotADirectoryError):
+        log.error("Directory '%s' can not be created, file is in the way.", path.parent)
+        raise HTTPBadRequest()
+    log.info("New directory '%s' created with parents.", path.parent)
+    return path, top_path
+
+
+def _write_data(dst_file: AtomicFile | PartialUpload, data: bytearray, update_hash: Callable[[bytes], None] | None):
+    # Hashing releases GIL, so it's done in the executor along with the writing.
+    if update_hash is not None:
+        update_hash(data)
+    dst_file.write(data)
+
+
+async def _receive_data(
+    read: Callable[[int], Awaitable[bytes]],
+    dst_file: AtomicFile | PartialUpload,
+    max_size: int,
+    update_hash: Callable[[bytes], None] | None = None,
+) -> int:
+    loop = get_running_loop()
+    size = 0
+    buffer = bytearray()
+    while chunk := await read(_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_size:
+            log.error("File '%s' exceeds upload size limit %d.", dst_file.path, max_size)
+            raise HTTPRequestEntityTooLarge(max_size=max_size, actual_size=size)
+        buffer += chunk
+        uploaded_bytes.inc(len(chunk))
+        if len(buffer) >= _CHUNK_SIZE:
+            data, buffer = buffer, bytearray()
+            await loop.run_in_executor(None, _write_data, dst_file, data, update_hash)
+    await loop.run_in_executor(None, _write_data, dst_file, buffer, update_hash)
+    return size
+
+
+async def _receive_file(part: BodyPartReader, path: Path, max_size: int, dedup: DedupStore) -> int:
+    loop = get_running_loop()
+    atomic_file = await loop.run_in_executor(None, partial(AtomicFile, path, text=False))
+    try:
+        if dedup.is_enabled():
+            hasher = sha256()
+            size = await _receive_data(part.read_chunk, atomic_file, max_size, hasher.update)
+            await loop.run_in_executor(None, dedup.commit, atomic_file, hasher.hexdigest(), size)
+        else:
+            size = await _receive_data(part.read_chunk, atomic_file, max_size)
+            await loop.run_in_executor(None, atomic_file.commit)
+    except BaseException:
+        atomic_file.discard()
+        raise
+    return size
+
 
 class UploadLinkHandler(BaseHandler):
     @check_authorization
     async def get(self) -> Response:
         path: str = self.request.query['p']
-        url = URL.build(scheme='https', host=self.request.host, path=UPLOAD_URI, query=dict(token=self.get_token(), path=path))
+        url = URL.build(scheme='https', authority=self.request.host, path=UPLOAD_URI, query=dict(token=self.get_token(), path=path))
         log.debug("Upload file URL '%s' created.", url)
         return Response(text=f'"{url!s}"', content_type='text/plain')
 
 
 class UploadFileHandler(BaseHandler):
+    _TOKEN_IN_QUERY = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__settings: ShareSettings = self.request.app['share_settings']
+        self.__max_size = self.request.app['server_settings'].max_upload_size
+        self.__watcher: ShareWatcher = self.request.app['watcher']
+        self.__dedup: DedupStore = self.request.app['dedup']
+        self.__thumbnails: Thumbnails = self.request.app['thumbnails']
+        self.__admission: UploadAdmission = self.request.app['admission']
+
     @check_authorization
     async def post(self) -> Response:
         if 'multipart/form-data' not in self.request.content_type:
             log.error('Unexpected Content-Type %r.', self.request.content_type)
             return HTTPBadRequest()
 
+        async with self.__admission.admit(self._get_user(), self.request.content_length):
+            return await self.__receive_form()
+
+    async def __receive_form(self) -> Response:
+        """
+        Receives files of the form one by one as they are streamed. File is put into the directory
+        by the relative path given by the field before it, missing directories are created.
+        """
+        loop = get_running_loop()
         dir_name: str = self.request.query.get('path', '')
-        settings: ShareSettings = self.request.app['share_settings']
-        field: FileField = (await self.request.post())['file']
+        relative_path = ''
+        results: List[Dict[str, Any]] = []
+
+        async for part in await self.request.multipart():
+            if not isinstance(part, BodyPartReader):
+                continue
+            if part.name == 'relative_path':
+                relative_path = await part.text()
+                continue
+            if part.name != 'file':
+                # Other form fields are skipped.
+                continue
+
+            if not part.filename:
+                log.error('File name is not set in the upload request.')
+                return HTTPBadRequest()
+
+            if (content_range := self.request.headers.get('Content-Range')) is not None:
+                # Chunk is a part of the single file.
+                path = _get_file_path(self.__settings, dir_name, part.filename)
+                return await self.__receive_chunk(part.read_chunk, path, content_range)
+
+            make_path = partial(_make_upload_path, self.__settings, dir_name, relative_path, part.filename)
+            path, top_path = await loop.run_in_executor(None, make_path)
+            if top_path is not None:
+                self.__watcher.changed(top_path.parent)
+
+            size = await _receive_file(part, path, self.__max_size, self.__dedup)
+            self.__watcher.changed(path.parent)
+            self.__thumbnails.prewarm(path)
+            log.info("File '%s' uploaded, size %d.", path, size)
+            oid = get_entry_oid(await loop.run_in_executor(None, path.stat))
+            results.append(dict(name=path.name, id=oid, size=size))
 
-        path = settings.path / dir_name.removeprefix('/') / field.filename.removeprefix('/')
-        if '..' in str(path):
-            log.error("Path '%s' contains trash.", path)
+        if not results:
+            log.error('File is not found in the upload request.')
             return HTTPBadRequest()
-        if not path.parent.is_dir():
-            log.error("Directory '%s' is not found.", path)
-            return HTTPNotFound()
 
-        with atomic_save(path, text=False) as photo_file:
-            copyfileobj(field.file, photo_file)
+        if len(results) == 1 and self.request.query.get('ret-json') != '1':
+            return Response(text=results[0]['id'])
+        return json_response(results)
 
-        log.info("File '%s' uploaded.", path)
-        return Response(text=create_oid())
+    @check_authorization
+    async def put(self) -> Response:
+        dir_name: str = self.request.query.get('path', '')
+        _, params = parse_content_disposition(self.request.headers.get('Content-Disposition'))
+        if not (file_name := content_disposition_filename(params)):
+            log.error('File name is not set in the chunk upload request.')
+            return HTTPBadRequest()
+
+        if (content_range := self.request.headers.get('Content-Range')) is None:
+            log.error('Content-Range is not set in the chunk upload request.')
+            return HTTPBadRequest()
+
+        path = _get_file_path(self.__settings, dir_name, file_name)
+        async with self.__admission.admit(self._get_user(), self.request.content_length):
+            return await self.__receive_chunk(self.request.content.read, path, content_range)
+
+    async def __receive_chunk(self, read: Callable[[int], Awaitable[bytes]], path: Path, content_range: str) -> Response:
+        if (match := _CONTENT_RANGE_RE.fullmatch(content_range.strip())) is None:
+            log.error('Invalid Content-Range %r.', content_range)
+            return HTTPBadRequest()
+
+        start, end, total = map(int, match.groups())
+        if not start <= end < total:
+            log.error('Invalid Content-Range %r.', content_range)
+            return HTTPBadRequest()
+        if total > self.__max_size:
+            log.error("File '%s' exceeds upload size limit %d.", path, self.__max_size)
+            return HTTPRequestEntityTooLarge(max_size=self.__max_size, actual_size=total)
+
+        loop = get_running_loop()
+        upload = PartialUpload(path, self._get_user())
+        try:
+            await loop.run_in_executor(None, upload.open, start)
+        except UploadInProgress:
+            log.error("Chunk of '%s' is sent while another one is uploaded.", path)
+            return HTTPConflict()
+        except UploadOffsetMismatch as error:
+            log.error("Chunk of '%s' starts at %d but only %d bytes are uploaded.", path, start, error.offset)
+            return HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{error.offset}'})
+
+        try:
+            # Data received before the connection is lost is kept to continue from it later.
+            size = await _receive_data(read, upload, end - start + 1)
+            if size == end - start + 1 and end + 1 == total:
+                # Part file is still locked so no other chunk is written to it meanwhile.
+                await loop.run_in_executor(None, upload.commit)
+        finally:
+            await loop.run_in_executor(None, upload.close)
+
+        if size != end - start + 1:
+            log.error("Chunk of '%s' is incomplete, %d bytes of %d received.", path, size, end - start + 1)
+            return HTTPBadRequest()
+
+        if end + 1 < total:
+            log.debug("Chunk %d-%d of '%s' uploaded.", start, end, path)
+            return json_response(dict(success=True))
+
+        self.__watcher.changed(path.parent)
+        self.__thumbnails.prewarm(path)
+        log.info("File '%s' uploaded by chunks, size %d.", path, total)
+        return Response(text=get_entry_oid(await loop.run_in_executor(None, path.stat)))
+
+
+class UploadedBytesHandler(BaseHandler):
+    @check_authorization
+    async def get(self) -> Response:
+        dir_name: str = self.request.query.get('parent_dir', '')
+        file_name: str = self.request.query['file_name']
+        path = _get_file_path(self.request.app['share_settings'], dir_name, file_name)
+        upload = PartialUpload(path, self._get_user())
+        size = await get_running_loop().run_in_executor(None, upload.get_size)
+        log.debug("File '%s' has %d bytes uploaded.", path, size)
+        return json_response(dict(uploadedBytes=size))
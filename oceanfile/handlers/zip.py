@@ -0,0 +1,115 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from pathlib import Path
+from typing import Any, List, Tuple
+from urllib.parse import quote
+
+from aiohttp.web import HTTPBadRequest, HTTPNotFound, HTTPUnauthorized, Response, StreamResponse, json_response
+
+from oceanfile.archive import DirArchiver
+from oceanfile.handlers.base import BaseHandler, check_authorization, get_share_path
+from oceanfile.settings import ShareSettings
+from oceanfile.tokens import TicketSigner
+
+log = logging.getLogger(__name__)
+
+
+def _is_valid_name(name: Any) -> bool:
+    """ Checks the entry name, empty and special names would archive the parent directory itself. """
+    return isinstance(name, str) and name.strip('/') not in ('', '.', '..') and '/' not in name.strip('/')
+
+
+class ZipTaskHandler(BaseHandler):
+    """
+    Archives are made on the fly while they are downloaded, so the task is not started here.
+    The ZIP token is a short-lived ticket carrying the request itself, signed by the server,
+    so the download is made without the session token.
+    """
+
+    @check_authorization
+    async def get(self) -> Response:
+        parent_dir: str = self.request.query.get('parent_dir', '/')
+        dirents: List[str] = self.request.query.getall('dirents', [])
+        if not dirents:
+            log.error('Nothing to archive in %r.', parent_dir)
+            return HTTPBadRequest()
+        if not all(_is_valid_name(name) for name in dirents):
+            log.error('Invalid entries %r in ZIP request.', dirents)
+            return HTTPBadRequest()
+        # Ticket is not given for paths outside of the share, they are checked again on download.
+        get_share_path(self.request.app['share_settings'], parent_dir)
+        tickets: TicketSigner = self.request.app['tickets']
+        zip_token = tickets.sign(dict(user=self._get_user(), parent_dir=parent_dir, dirents=dirents))
+        log.debug('ZIP task of %r in %r created.', dirents, parent_dir)
+        return json_response(dict(zip_token=zip_token))
+
+
+class ZipProgressHandler(BaseHandler):
+    @check_authorization
+    async def get(self) -> Response:
+        # Archive is ready as soon as it is requested.
+        return json_response(dict(zipped=1, total=1))
+
+
+class ZipDownloadHandler(BaseHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__settings: ShareSettings = self.request.app['share_settings']
+        self.__archiver: DirArchiver = self.request.app['archiver']
+        self.__tickets: TicketSigner = self.request.app['tickets']
+
+    async def get(self) -> StreamResponse:
+        request = self.__tickets.verify(self.request.match_info['zip_token'])
+        if not isinstance(request, dict):
+            log.error('Invalid or expired ZIP token.')
+            raise HTTPUnauthorized()
+        parent_dir, dirents = request.get('parent_dir'), request.get('dirents')
+        if not isinstance(parent_dir, str) or not isinstance(dirents, list) or not dirents:
+            log.error('Invalid ZIP request %r.', request)
+            return HTTPBadRequest()
+
+        parent_path = get_share_path(self.__settings, parent_dir)
+        paths: List[Tuple[Path, str]] = []
+        for name in dirents:
+            if not _is_valid_name(name):
+                log.error('Invalid entry %r in ZIP request.', name)
+                return HTTPBadRequest()
+            path = get_share_path(self.__settings, f'{parent_dir.rstrip("/")}/{name.strip("/")}')
+            if not path.exists():
+                log.error("Path '%s' is not found.", path)
+                return HTTPNotFound()
+            paths.append((path, path.name))
+
+        archive_name = f'{paths[0][1] if len(paths) == 1 else parent_path.name or self.__settings.name}.zip'
+        response = StreamResponse(headers={
+            'Content-Type': 'application/zip',
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(archive_name)}",
+        })
+        chunks = self.__archiver.stream(paths)
+        await response.prepare(self.request)
+        log.debug('Sending archive of %r in %r.', dirents, parent_dir)
+        try:
+            async for chunk in chunks:
+                await response.write(chunk)
+        except ConnectionResetError:
+            log.debug('Sending archive of %r in %r is interrupted by the client.', dirents, parent_dir)
+            return response
+        finally:
+            await chunks.aclose()
+        await response.write_eof()
+        log.info('Archive of %r in %r sent.', dirents, parent_dir)
+        return response
@@ -0,0 +1,333 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from array import array
+from asyncio import FIRST_COMPLETED, Future, Queue, gather, get_running_loop, run_coroutine_threadsafe, wait
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from os import DirEntry, scandir, stat_result
+from pathlib import Path
+from stat import S_ISDIR
+from threading import Event
+from time import monotonic, time_ns
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from oceanfile.metrics import SIZE_BUCKETS, Histogram
+from oceanfile.oid import get_entry_oid, get_listing_oid
+from oceanfile.replies import json_dumps
+
+log = logging.getLogger(__name__)
+
+_scan_duration = Histogram('oceanfile_listing_scan_seconds', 'Time of scanning directories.')
+_listing_size = Histogram('oceanfile_listing_size_bytes', 'Size of directory listings.', buckets=SIZE_BUCKETS)
+
+# Separator of entries in serialized listings.
+_SEPARATOR = b', '
+# Streamed listings are sent by chunks of this size.
+_STREAM_CHUNK_SIZE = 64 * 1024
+# Number of chunks read ahead of sending when a listing is streamed.
+_STREAM_QUEUE_SIZE = 4
+
+
+def get_entry_info(name: str, info: stat_result, is_dir: bool) -> Dict[str, Any]:
+    return dict(
+        id=get_entry_oid(info),
+        mtime=int(info.st_mtime),
+        name=name,
+        permission='rw',
+        type='dir' if is_dir else 'file',
+        size=None if is_dir else info.st_size,
+    )
+
+
+def _get_dir_mtime(dir_path: Path) -> int | None:
+    try:
+        info = dir_path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return info.st_mtime_ns if S_ISDIR(info.st_mode) else None
+
+
+def _iter_dir_entries(dir_entries: Iterable[DirEntry]) -> Iterator[Tuple[DirEntry, Dict[str, Any]]]:
+    for entry in dir_entries:
+        name = entry.name
+        if name.startswith('.'):
+            # Skip hidden files.
+            continue
+        # Type is known from the directory itself and stat is made once and cached by the entry.
+        try:
+            if entry.is_dir():
+                is_dir = True
+            elif entry.is_file():
+                is_dir = False
+            else:
+                log.warning("Unsupported FS object '%s'.", entry.path)
+                continue
+            info = entry.stat()
+        except FileNotFoundError:
+            # Removed while listing or broken symlink.
+            continue
+        yield entry, get_entry_info(name, info, is_dir)
+
+
+def _iter_entries(dir_entries: Iterable[DirEntry]) -> Iterator[Dict[str, Any]]:
+    return (info for unused_entry, info in _iter_dir_entries(dir_entries))
+
+
+def _scan_dir(dir_path: Path, mtime: int) -> Tuple['DirListing', int]:
+    with scandir(dir_path) as dir_entries:
+        entries = sorted(_iter_entries(dir_entries), key=lambda item: item['name'])
+    # Start offsets of entries in the body, the last one is where the next entry would be.
+    starts = array('Q')
+    body = bytearray(b'[')
+    for entry in entries:
+        starts.append(len(body))
+        body += json_dumps(entry)
+        body += _SEPARATOR
+    starts.append(len(body))
+    if entries:
+        del body[-len(_SEPARATOR):]
+    body += b']'
+    body = bytes(body)
+    return DirListing(mtime=mtime, body=body, oid=get_listing_oid(body), starts=starts), len(entries)
+
+
+def _scan_tree_dir(dir_path: Path, parent_dir: str, entry_type: str | None, descend: bool) -> Tuple[bytes, List[Tuple[Path, str]]]:
+    """ Returns serialized entries of the directory of the type if it's given and its subdirectories to walk. """
+    body = bytearray()
+    subdirs = []
+    with scandir(dir_path) as dir_entries:
+        for dir_entry, entry in _iter_dir_entries(dir_entries):
+            name = entry['name']
+            is_dir = entry['type'] == 'dir'
+            # Symlinks are listed but not followed, so there are no loops.
+            if is_dir and descend and not dir_entry.is_symlink():
+                subdirs.append((dir_path / name, f"{parent_dir.rstrip('/')}/{name}"))
+            if entry_type is not None and entry['type'] != entry_type:
+                continue
+            entry['parent_dir'] = parent_dir
+            if body:
+                body += _SEPARATOR
+            body += json_dumps(entry)
+    return bytes(body), subdirs
+
+
+async def walk_tree(dir_path: Path, parent_dir: str, *, entry_type: str | None, max_depth: int, workers: int) -> AsyncIterator[bytes]:
+    """
+    Yields chunks of JSON list of entries of the directory tree with their parent directories,
+    only entries of the type if it's given. Directories are scanned by several threads at once,
+    at most max_depth levels deep, and entries are yielded as their directories are scanned.
+    Subdirectories which can't be read are skipped.
+    """
+    loop = get_running_loop()
+    # Missing or unreadable directory is reported before anything is yielded.
+    body, subdirs = await loop.run_in_executor(None, _scan_tree_dir, dir_path, parent_dir, entry_type, max_depth > 1)
+    dirs = deque((path, parent, 2) for path, parent in subdirs)
+    # Directory scanned by each pending future and its depth.
+    pending: Dict[Future, Tuple[Path, int]] = dict()
+    chunk = bytearray(b'[') + body
+    separator = _SEPARATOR if body else b''
+    try:
+        while dirs or pending:
+            while dirs and len(pending) < workers:
+                path, parent, depth = dirs.popleft()
+                pending[loop.run_in_executor(None, _scan_tree_dir, path, parent, entry_type, depth < max_depth)] = path, depth
+            done, _ = await wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, depth = pending.pop(future)
+                try:
+                    body, subdirs = future.result()
+                except (FileNotFoundError, NotADirectoryError):
+                    # Removed while walking.
+                    continue
+                except OSError as error:
+                    log.error("Directory '%s' is skipped in walk: %s.", path, error)
+                    continue
+                dirs.extend((path, parent, depth + 1) for path, parent in subdirs)
+                if body:
+                    chunk += separator
+                    chunk += body
+                    separator = _SEPARATOR
+            if len(chunk) >= _STREAM_CHUNK_SIZE:
+                yield bytes(chunk)
+                chunk = bytearray()
+        chunk += b']'
+        yield bytes(chunk)
+    finally:
+        for future in pending:
+            future.cancel()
+        await gather(*pending, return_exceptions=True)
+
+
+@dataclass(frozen=True)
+class DirListing:
+    """ Listing of the directory with entries sorted by name. """
+
+    mtime: int
+    body: bytes
+    oid: str
+    starts: array
+    # Body compressed by encodings, added when requested.
+    encoded: Dict[str, bytes] = field(default_factory=dict)
+
+    @property
+    def count(self) -> int:
+        return len(self.starts) - 1
+
+    @property
+    def size(self) -> int:
+        encoded_size = sum(len(data) for data in self.encoded.values())
+        return len(self.body) + self.starts.itemsize * len(self.starts) + encoded_size
+
+    def get_page(self, offset: int, limit: int) -> bytes:
+        """ Returns JSON list of entries from the offset, at most limit of them. """
+        first = min(offset, self.count)
+        last = min(offset + limit, self.count)
+        if first == last:
+            return b'[]'
+        return b'[' + self.body[self.starts[first]:self.starts[last] - len(_SEPARATOR)] + b']'
+
+
+async def stream_dir(dir_path: Path) -> AsyncIterator[bytes]:
+    """
+    Yields the listing of the directory in chunks of JSON as the entries are read, in the order
+    of the directory. Only a few chunks are kept in memory whatever the size of the directory is.
+    """
+    loop = get_running_loop()
+    queue: Queue[bytes | Exception | None] = Queue(maxsize=_STREAM_QUEUE_SIZE)
+    stopped = Event()
+
+    def put(item: bytes | Exception | None):
+        if not stopped.is_set():
+            run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def read_entries():
+        try:
+            with scandir(dir_path) as dir_entries:
+                chunk = bytearray(b'[')
+                separator = b''
+                for entry in _iter_entries(dir_entries):
+                    if stopped.is_set():
+                        return
+                    chunk += separator
+                    chunk += json_dumps(entry)
+                    separator = _SEPARATOR
+                    if len(chunk) >= _STREAM_CHUNK_SIZE:
+                        put(bytes(chunk))
+                        chunk = bytearray()
+                chunk += b']'
+                put(bytes(chunk))
+        except Exception as error:
+            put(error)
+        put(None)
+
+    reader = loop.run_in_executor(None, read_entries)
+    try:
+        while (item := await queue.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        # Reader waiting for free space in the queue is released.
+        while not queue.empty():
+            queue.get_nowait()
+        await reader
+
+
+class DirListings:
+    """
+    Directory listings serialized to JSON and cached by directory path and its modification time.
+    Directory mtime is changed by creating, removing and renaming its entries, so the cache stays
+    valid for uploads done by atomic replace. In-place changes of files are tracked by the share
+    watcher which invalidates listings of their directories. Listing of the directory changed
+    within the mtime granularity before the scan is not cached, since a change right after
+    the scan could keep the same mtime.
+    """
+
+    def __init__(self, settings: Dict[str, Any]):
+        section: Dict[str, Any] = settings.get('listings', {})
+        self.__max_size: int = section.get('cache-size', 64 * 1024 * 1024)
+        self.__tree_depth: int = section.get('tree-depth', 32)
+        self.__tree_workers: int = section.get('tree-workers', 4)
+        self.__mtime_granularity = int(section.get('mtime-granularity', 2) * 1e9)
+        self.__cache: OrderedDict[Path, DirListing] = OrderedDict()
+        self.__size = 0
+
+    def walk(self, dir_path: Path, parent_dir: str, entry_type: str | None) -> AsyncIterator[bytes]:
+        """ Yields chunks of the recursive listing of the directory, it's not cached. """
+        return walk_tree(dir_path, parent_dir, entry_type=entry_type, max_depth=self.__tree_depth, workers=self.__tree_workers)
+
+    async def get(self, dir_path: Path) -> DirListing | None:
+        """ Returns None if the directory is not found, PermissionError is raised if it's not readable. """
+        loop = get_running_loop()
+        if (mtime := await loop.run_in_executor(None, _get_dir_mtime, dir_path)) is None:
+            return None
+
+        listing = self.__cache.get(dir_path)
+        if listing is not None and listing.mtime == mtime:
+            self.__cache.move_to_end(dir_path)
+            log.debug("Directory '%s' listing is found in cache.", dir_path)
+            return listing
+
+        start_time = monotonic()
+        try:
+            listing, count = await loop.run_in_executor(None, _scan_dir, dir_path, mtime)
+        except (FileNotFoundError, NotADirectoryError):
+            # Removed after its mtime is got.
+            return None
+        duration = monotonic() - start_time
+        _scan_duration.observe(duration)
+        _listing_size.observe(len(listing.body))
+        log.debug("Directory '%s' scanned in %.3fs, %d entries.", dir_path, duration, count)
+        if time_ns() - mtime < self.__mtime_granularity:
+            log.debug("Directory '%s' is changed just now, listing is not cached.", dir_path)
+            self.invalidate(dir_path)
+        else:
+            self.__put(dir_path, listing)
+        return listing
+
+    def __put(self, dir_path: Path, listing: DirListing):
+        self.invalidate(dir_path)
+        if listing.size > self.__max_size:
+            return
+        self.__cache[dir_path] = listing
+        self.__size += listing.size
+        self.__evict()
+
+    def __evict(self):
+        while self.__size > self.__max_size:
+            _, evicted = self.__cache.popitem(last=False)
+            self.__size -= evicted.size
+
+    async def get_encoded(self, dir_path: Path, listing: DirListing, encoding: str, compress: Callable[[bytes, str], bytes]) -> bytes:
+        """ Returns the body of the listing compressed by the encoding, it's compressed once and cached with the listing. """
+        if (data := listing.encoded.get(encoding)) is not None:
+            return data
+        data = await get_running_loop().run_in_executor(None, compress, listing.body, encoding)
+        if encoding not in listing.encoded:
+            listing.encoded[encoding] = data
+            if self.__cache.get(dir_path) is listing:
+                self.__size += len(data)
+                self.__evict()
+        return data
+
+    def invalidate(self, dir_path: Path | None):
+        if dir_path is None:
+            self.__cache.clear()
+            self.__size = 0
+        elif (listing := self.__cache.pop(dir_path, None)) is not None:
+            self.__size -= listing.size
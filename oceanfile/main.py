@@ -21,24 +21,81 @@
 
 import logging
 from argparse import ArgumentParser
+from secrets import token_bytes
+from time import perf_counter
+from typing import Any, Callable, Dict
 
-from aiohttp.web import Application, HTTPUnauthorized, Request, Response, middleware, run_app, view
+from aiohttp.web import Application, HTTPException, HTTPUnauthorized, Request, Response, middleware, run_app, view
 from tomli import load as toml_load
 
 from oceanfile.accounts import UserAccounts
+from oceanfile.admission import UploadAdmission
+from oceanfile.archive import DirArchiver
+from oceanfile.atomic import Durability
+from oceanfile.dedup import DedupStore
+from oceanfile.delta import BlockLists
 from oceanfile.errors import SessionNotFound, UserNotFound
-from oceanfile.handlers.auth import AuthorizationHandler
+from oceanfile.fileops import FileOperations
+from oceanfile.handlers.auth import AuthorizationHandler, LogoutDeviceHandler
+from oceanfile.handlers.delta import FileDeltaHandler
 from oceanfile.handlers.dirs import ManageDirsHandler
+from oceanfile.handlers.fileops import (
+    AsyncBatchCopyHandler,
+    AsyncBatchMoveHandler,
+    BatchDeleteHandler,
+    CopyMoveProgressHandler,
+    SyncBatchCopyHandler,
+    SyncBatchMoveHandler,
+)
+from oceanfile.handlers.download import DOWNLOAD_URI, DownloadFileHandler, DownloadLinkHandler
 from oceanfile.handlers.info import AccountInfoHandler, ServerInfoHandler
+from oceanfile.handlers.metrics import MetricsHandler
 from oceanfile.handlers.repos import ReposListHandler
-from oceanfile.handlers.stubs import AvatarInfoHandler, StarredHandler, ThumbnailHandler
-from oceanfile.handlers.upload import UPLOAD_URI, UploadFileHandler, UploadLinkHandler
+from oceanfile.handlers.search import SearchHandler
+from oceanfile.handlers.stubs import AvatarInfoHandler, StarredHandler
+from oceanfile.handlers.thumbnails import ThumbnailHandler
+from oceanfile.handlers.upload import UPLOAD_URI, UploadFileHandler, UploadLinkHandler, UploadedBytesHandler
+from oceanfile.handlers.zip import ZipDownloadHandler, ZipProgressHandler, ZipTaskHandler
+from oceanfile.listing import DirListings
+from oceanfile.metrics import Counter, Gauge, Histogram, LoopLagMonitor, WorkersMetrics
 from oceanfile.notify import notify_start
+from oceanfile.replies import ReplyEncoder
+from oceanfile.search import SearchIndex
 from oceanfile.sessions import AuthSessions
-from oceanfile.settings import ServerSettings, ShareSettings
+from oceanfile.settings import MetricsSettings, ServerSettings, ShareSettings
+from oceanfile.thumbnails import Thumbnails
+from oceanfile.tokens import TicketSigner
+from oceanfile.uploads import PartUploadsSweeper
+from oceanfile.usage import DiskUsage
+from oceanfile.watcher import ShareWatcher
+from oceanfile.workers import WorkersLink, run_workers
 
 log = logging.getLogger(__name__)
 
+_requests = Counter('oceanfile_requests_total', 'Number of handled requests.', ('route', 'method', 'status'))
+_requests_in_flight = Gauge('oceanfile_requests_in_flight', 'Number of requests being handled.', ('route',))
+_request_duration = Histogram('oceanfile_request_duration_seconds', 'Time of handling requests.', ('route',))
+
+
+@middleware
+async def _metrics_factory(request: Request, handler) -> Response:
+    resource = request.match_info.route.resource
+    route = ('unknown',) if resource is None else (resource.canonical,)
+    _requests_in_flight.inc(labels=route)
+    start_time = perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except HTTPException as error:
+        status = error.status
+        raise
+    finally:
+        _request_duration.observe(perf_counter() - start_time, route)
+        _requests_in_flight.dec(labels=route)
+        _requests.inc(labels=(*route, request.method, str(status)))
+
 
 @middleware
 async def _errors_handling_factory(request: Request, handler) -> Response:
@@ -50,11 +107,183 @@ async def _errors_handling_factory(request: Request, handler) -> Response:
         return error
 
 
+def _create_app(settings: Dict[str, Any], ready: Callable[[], None], *, link: WorkersLink | None, tickets_key: bytes) -> Application:
+    auth_sessions = AuthSessions(settings, shared=link is not None)
+    dir_archiver = DirArchiver(settings)
+    ticket_signer = TicketSigner(tickets_key, settings.get('zip', {}).get('ticket-ttl', 60))
+    block_lists = BlockLists(settings)
+    dir_listings = DirListings(settings)
+    reply_encoder = ReplyEncoder(settings)
+    loop_lag_monitor = LoopLagMonitor()
+    user_accounts = UserAccounts(settings)
+    share_settings = ShareSettings.load(settings)
+    server_settings = ServerSettings.load(settings)
+    metrics_settings = MetricsSettings.load(settings)
+    workers_metrics = WorkersMetrics(settings, link)
+    dedup_store = DedupStore(share_settings.path, settings)
+    durability = Durability(share_settings.path, settings)
+    disk_usage = DiskUsage(share_settings.path, settings, link)
+    search_index = SearchIndex(share_settings.path, settings, link)
+    upload_admission = UploadAdmission(share_settings.path, settings)
+    thumbnails = Thumbnails(share_settings.path, settings, link)
+    parts_sweeper = PartUploadsSweeper(share_settings.path, settings, link)
+    share_watcher = ShareWatcher(share_settings.path, settings, link)
+    share_watcher.add_listener(dir_listings.invalidate)
+    share_watcher.add_listener(disk_usage.changed)
+    share_watcher.add_listener(search_index.changed)
+    file_operations = FileOperations(settings, share_watcher.changed)
+
+    # Requests are not measured if metrics are not served.
+    middlewares = [_metrics_factory, _errors_handling_factory] if metrics_settings.enabled else [_errors_handling_factory]
+    app = Application(middlewares=middlewares, client_max_size=server_settings.max_upload_size)
+    app.router.add_routes([
+        view('/api/v2.1/query-copy-move-progress/', CopyMoveProgressHandler),
+        view('/api/v2.1/query-zip-progress/', ZipProgressHandler),
+        view('/api/v2.1/repos/async-batch-copy-item/', AsyncBatchCopyHandler),
+        view('/api/v2.1/repos/async-batch-move-item/', AsyncBatchMoveHandler),
+        view('/api/v2.1/repos/batch-delete-item/', BatchDeleteHandler),
+        view('/api/v2.1/repos/sync-batch-copy-item/', SyncBatchCopyHandler),
+        view('/api/v2.1/repos/sync-batch-move-item/', SyncBatchMoveHandler),
+        view('/api/v2.1/starred-items/', StarredHandler),
+        view('/api2/account/info/', AccountInfoHandler),
+        view('/api2/auth-token/', AuthorizationHandler),
+        view('/api2/logout-device/', LogoutDeviceHandler),
+        view('/api2/repos/', ReposListHandler),
+        view('/api2/search/', SearchHandler),
+        view('/api2/server-info/', ServerInfoHandler),
+        view('/metrics', MetricsHandler),
+        view(DOWNLOAD_URI, DownloadFileHandler),
+        view(UPLOAD_URI, UploadFileHandler),
+        view(r'/api/v2.1/repos/{repo_id:[^/]+}/file-uploaded-bytes/', UploadedBytesHandler),
+        view(r'/api/v2.1/repos/{repo_id:[^/]+}/zip-task/', ZipTaskHandler),
+        view(r'/api2/avatars/user/{email:[^/]+}/resized/{size:\d+}', AvatarInfoHandler),
+        view(r'/api2/repos/{repo_id:[^/]+}/dir/', ManageDirsHandler),
+        view(r'/api2/repos/{repo_id:[^/]+}/file/', DownloadLinkHandler),
+        view(r'/api2/repos/{repo_id:[^/]+}/file/delta/', FileDeltaHandler),
+        view(r'/api2/repos/{repo_id:[^/]+}/thumbnail/', ThumbnailHandler),
+        view(r'/api2/repos/{repo_id:[^/]+}/upload-link/', UploadLinkHandler),
+        view(r'/seafhttp/zip/{zip_token:[^/]+}', ZipDownloadHandler),
+    ])
+
+    app['accounts'] = user_accounts
+    app['admission'] = upload_admission
+    app['archiver'] = dir_archiver
+    app['tickets'] = ticket_signer
+    app['block_lists'] = block_lists
+    app['dedup'] = dedup_store
+    app['encoder'] = reply_encoder
+    app['fileops'] = file_operations
+    app['listings'] = dir_listings
+    app['metrics'] = workers_metrics
+    app['metrics_settings'] = metrics_settings
+    app['search'] = search_index
+    app['sessions'] = auth_sessions
+    app['share_settings'] = share_settings
+    app['thumbnails'] = thumbnails
+    app['usage'] = disk_usage
+    app['watcher'] = share_watcher
+    app['server_settings'] = server_settings
+
+    async def ready_ctx(unused_app):
+        ready()
+        yield
+
+    async def accounts_ctx(unused_app):
+        await user_accounts.start()
+        yield
+        user_accounts.close()
+
+    async def archiver_ctx(unused_app):
+        yield
+        dir_archiver.close()
+
+    async def dedup_ctx(unused_app):
+        await dedup_store.start()
+        yield
+        await dedup_store.close()
+
+    async def durability_ctx(unused_app):
+        await durability.start()
+        yield
+        await durability.close()
+
+    async def fileops_ctx(unused_app):
+        await file_operations.start()
+        yield
+        await file_operations.close()
+
+    async def link_ctx(unused_app):
+        await link.start()
+        yield
+        await link.close()
+
+    async def loop_lag_ctx(unused_app):
+        await loop_lag_monitor.start()
+        yield
+        await loop_lag_monitor.close()
+
+    async def metrics_ctx(unused_app):
+        await workers_metrics.start()
+        yield
+        await workers_metrics.close()
+
+    async def parts_sweeper_ctx(unused_app):
+        await parts_sweeper.start()
+        yield
+        await parts_sweeper.close()
+
+    async def search_ctx(unused_app):
+        await search_index.start()
+        yield
+        await search_index.close()
+
+    async def sessions_ctx(unused_app):
+        await auth_sessions.start()
+        yield
+        await auth_sessions.close()
+
+    async def thumbnails_ctx(unused_app):
+        await thumbnails.start()
+        yield
+        await thumbnails.close()
+
+    async def usage_ctx(unused_app):
+        await disk_usage.start()
+        yield
+        await disk_usage.close()
+
+    async def watcher_ctx(unused_app):
+        await share_watcher.start()
+        yield
+        await share_watcher.close()
+
+    # Policy is set first and removed last, after all the files are saved.
+    app.cleanup_ctx.append(durability_ctx)
+    app.cleanup_ctx.append(accounts_ctx)
+    app.cleanup_ctx.append(archiver_ctx)
+    app.cleanup_ctx.append(dedup_ctx)
+    app.cleanup_ctx.append(fileops_ctx)
+    if link is not None:
+        app.cleanup_ctx.append(link_ctx)
+    app.cleanup_ctx.append(loop_lag_ctx)
+    app.cleanup_ctx.append(metrics_ctx)
+    app.cleanup_ctx.append(parts_sweeper_ctx)
+    app.cleanup_ctx.append(search_ctx)
+    app.cleanup_ctx.append(sessions_ctx)
+    app.cleanup_ctx.append(thumbnails_ctx)
+    app.cleanup_ctx.append(usage_ctx)
+    app.cleanup_ctx.append(watcher_ctx)
+    app.cleanup_ctx.append(ready_ctx)
+
+    return app
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument('-c', '--config', required=True, help='Path to config file.')
     parser.add_argument('-d', '--debug', action='store_true', help='Enable debug mode.')
     parser.add_argument('-a', '--debug-access', action='store_true', help='Debug all requests.')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of server processes.')
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
@@ -64,8 +293,6 @@ def main():
     with open(args.config, mode='rb') as config_file:
         settings = toml_load(config_file)
 
-    auth_sessions = AuthSessions(settings)
-    user_accounts = UserAccounts(settings)
     share_settings = ShareSettings.load(settings)
     server_settings = ServerSettings.load(settings)
 
@@ -77,30 +304,19 @@ def main():
         log.error('%s.', msg)
         raise RuntimeError(f'{msg}:')
 
-    app = Application(middlewares=[_errors_handling_factory], client_max_size=server_settings.max_upload_size)
-    app.router.add_routes([
-        view('/api/v2.1/starred-items/', StarredHandler),
-        view('/api2/account/info/', AccountInfoHandler),
-        view('/api2/auth-token/', AuthorizationHandler),
-        view('/api2/repos/', ReposListHandler),
-        view('/api2/server-info/', ServerInfoHandler),
-        view(UPLOAD_URI, UploadFileHandler),
-        view(r'/api2/avatars/user/{email:[^/]+}/resized/{size:\d+}', AvatarInfoHandler),
-        view(r'/api2/repos/{repo_id:[^/]+}/dir/', ManageDirsHandler),
-        view(r'/api2/repos/{repo_id:[^/]+}/thumbnail/', ThumbnailHandler),
-        view(r'/api2/repos/{repo_id:[^/]+}/upload-link/', UploadLinkHandler),
-    ])
-
-    app['accounts'] = user_accounts
-    app['sessions'] = auth_sessions
-    app['share_settings'] = share_settings
-    app['server_settings'] = server_settings
+    # Tickets are checked by any worker, so the key is made before forking.
+    tickets_key = token_bytes(32)
+    if args.workers > 1:
+        # Values published by the primary worker, usage is negative until the share is scanned.
+        link = WorkersLink(dict(usage=-1, mtime=0), args.workers)
 
-    async def notify_start_ctx(unused_app):
-        notify_start()
-        yield
+        def run_worker(index: int, ready: Callable[[], None]):
+            link.set_worker(index)
+            app = _create_app(settings, ready, link=link, tickets_key=tickets_key)
+            run_app(app, host=server_settings.listen, port=server_settings.port, reuse_port=True, print=None)
 
-    app.cleanup_ctx.append(notify_start_ctx)
-
-    run_app(app, host=server_settings.listen, port=server_settings.port, print=None)
+        run_workers(args.workers, run_worker)
+    else:
+        app = _create_app(settings, notify_start, link=None, tickets_key=tickets_key)
+        run_app(app, host=server_settings.listen, port=server_settings.port, print=None)
     log.info('Shutting down.')
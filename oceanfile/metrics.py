@@ -0,0 +1,238 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import CancelledError, Task, create_task, sleep
+from bisect import bisect_left
+from contextlib import suppress
+from time import monotonic
+from typing import Any, Dict, List, Tuple
+
+from oceanfile.workers import WorkersLink
+
+log = logging.getLogger(__name__)
+
+# Latency buckets, in seconds.
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Size buckets, in bytes.
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_registry: List['_Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    """
+    Metrics are updated from the event loop thread only, so they are plain Python values
+    without locks. Labels are passed as a tuple of values in the order of label names.
+    Values are dumped as JSON lists to be passed between workers and rendered from the dumps.
+    """
+
+    kind = ''
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        _registry.append(self)
+
+    def dump(self) -> List[list]:
+        raise NotImplementedError
+
+    def render(self, dumps: Dict[str, List[list]]) -> List[str]:
+        """ Renders the dumps by workers, the worker label is added if its value is not empty. """
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for worker, values in dumps.items():
+            names = (*self.label_names, 'worker') if worker else self.label_names
+            for labels, value in values:
+                lines.extend(self._render_value(names, (*labels, worker) if worker else tuple(labels), value))
+        return lines
+
+    def _render_value(self, names: Tuple[str, ...], labels: Tuple[str, ...], value: Any) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, value: float = 1, labels: Tuple[str, ...] = ()):
+        self.__values[labels] = self.__values.get(labels, 0) + value
+
+    def dump(self) -> List[list]:
+        return [[labels, value] for labels, value in self.__values.items()]
+
+    def _render_value(self, names: Tuple[str, ...], labels: Tuple[str, ...], value: Any) -> List[str]:
+        return [f'{self.name}{_format_labels(names, labels)} {value}']
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, labels: Tuple[str, ...] = ()):
+        self.__values[labels] = value
+
+    def inc(self, value: float = 1, labels: Tuple[str, ...] = ()):
+        self.__values[labels] = self.__values.get(labels, 0) + value
+
+    def dec(self, value: float = 1, labels: Tuple[str, ...] = ()):
+        self.__values[labels] = self.__values.get(labels, 0) - value
+
+    def dump(self) -> List[list]:
+        return [[labels, value] for labels, value in self.__values.items()]
+
+    def _render_value(self, names: Tuple[str, ...], labels: Tuple[str, ...], value: Any) -> List[str]:
+        return [f'{self.name}{_format_labels(names, labels)} {value}']
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = TIME_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__buckets = buckets
+        # Counts of values in every bucket (not cumulative, the last one is +Inf) and sum of values.
+        self.__values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, labels: Tuple[str, ...] = ()):
+        if (counts_and_sum := self.__values.get(labels)) is None:
+            counts_and_sum = self.__values[labels] = ([0] * (len(self.__buckets) + 1), [0.0])
+        counts, total = counts_and_sum
+        counts[bisect_left(self.__buckets, value)] += 1
+        total[0] += value
+
+    def dump(self) -> List[list]:
+        return [[labels, [counts, total[0]]] for labels, (counts, total) in self.__values.items()]
+
+    def _render_value(self, names: Tuple[str, ...], labels: Tuple[str, ...], value: Any) -> List[str]:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.__buckets, '+Inf'), counts):
+            cumulative += count
+            bucket_labels = _format_labels(names, labels, f'le="{bound}"')
+            lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(names, labels)} {total}')
+        lines.append(f'{self.name}_count{_format_labels(names, labels)} {cumulative}')
+        return lines
+
+
+def dump() -> Dict[str, List[list]]:
+    """ Returns values of all metrics by their names. """
+    return {metric.name: metric.dump() for metric in _registry}
+
+
+def render(workers: Dict[str, Dict[str, List[list]]] | None = None) -> str:
+    """
+    Returns all metrics in Prometheus text format. If dumps of the workers are given,
+    their values are labeled by worker, otherwise values of this process are returned as is.
+    """
+    if workers is None:
+        workers = {'': dump()}
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render({worker: values.get(metric.name, []) for worker, values in workers.items()}))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+_loop_lag = Histogram('oceanfile_event_loop_lag_seconds', 'Delay of event loop wakeups.')
+
+
+class LoopLagMonitor:
+    """ Measures how late the event loop wakes up a sleeping task. """
+
+    def __init__(self, interval: float = 0.5):
+        self.__interval = interval
+        self.__task: Task | None = None
+
+    async def start(self):
+        self.__task = create_task(self.__run())
+
+    async def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            with suppress(CancelledError):
+                await self.__task
+
+    async def __run(self):
+        while True:
+            start_time = monotonic()
+            await sleep(self.__interval)
+            _loop_lag.observe(max(0.0, monotonic() - start_time - self.__interval))
+
+
+class WorkersMetrics:
+    """
+    Metrics of all forked workers, any of them can accept the scrape. Every worker sends dumps
+    of its metrics to the primary worker periodically, which passes them to other workers,
+    so metrics of other workers are late by the interval. Values are labeled by worker index,
+    because workers are restarted separately and their counters can't be just summed up.
+    """
+
+    def __init__(self, settings: Dict[str, Any], link: WorkersLink | None = None):
+        section: Dict[str, Any] | None = settings.get('metrics')
+        self.__interval: float = (section or {}).get('exchange-interval', 5)
+        # Metrics are not exchanged if they are not served.
+        self.__link = None if section is None else link
+        self.__dumps: Dict[str, Dict[str, List[list]]] = dict()
+        self.__task: Task | None = None
+        if self.__link is not None:
+            self.__link.add_handler('metrics', self.__received)
+
+    def render(self) -> str:
+        if self.__link is None:
+            return render()
+        dumps = {**self.__dumps, str(self.__link.index): dump()}
+        return render(dict(sorted(dumps.items(), key=lambda item: int(item[0]))))
+
+    def __received(self, data: Any):
+        worker, values = data
+        if worker != str(self.__link.index):
+            self.__dumps[worker] = values
+        if self.__link.is_primary:
+            self.__link.publish('metrics', data)
+
+    async def start(self):
+        if self.__link is not None:
+            self.__task = create_task(self.__run())
+
+    async def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            with suppress(CancelledError):
+                await self.__task
+
+    async def __run(self):
+        while True:
+            self.__link.send('metrics', [str(self.__link.index), dump()])
+            await sleep(self.__interval)
@@ -13,13 +13,18 @@
     If not, see <https://www.gnu.org/licenses/>.
 """
 
-from uuid import uuid4
+from hashlib import sha1
+from os import stat_result
 
 
-def create_oid() -> str:
+def get_entry_oid(info: stat_result) -> str:
     """
-    As I found it's better when OID is random. Because when it's static it takes too much time
-    to update directories list on the mobile device. As an alternative it's a good idea to create
-    OID from a directory name using hashing function like MD5.
+    OID of a file or a directory is changed together with its inode, size or modification time.
+    Directory mtime reflects changes of its entries only, so the OID of its listing is used by
+    the clients to find out if the directory content is changed.
     """
-    return str(uuid4())
+    return sha1(f'{info.st_ino}:{info.st_size}:{info.st_mtime_ns}'.encode()).hexdigest()
+
+
+def get_listing_oid(listing: bytes) -> str:
+    return sha1(listing).hexdigest()
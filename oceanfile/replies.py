@@ -0,0 +1,137 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import zlib
+from collections import OrderedDict
+from gzip import compress as gzip_compress
+from json import dumps as std_json_dumps
+from typing import Any, Callable, Dict, Hashable, Mapping
+
+from aiohttp.web import Request, Response
+
+log = logging.getLogger(__name__)
+
+try:
+    # This dependency is optional.
+    from orjson import dumps as fast_json_dumps
+except ImportError:
+    fast_json_dumps = None
+
+try:
+    # This dependency is optional.
+    from brotli import compress as brotli_compress
+except ImportError:
+    brotli_compress = None
+
+# Encodings in order of preference.
+_ENCODINGS = ('br', 'gzip', 'deflate')
+# Number of cached replies.
+_CACHE_SIZE = 1024
+
+
+def json_dumps(data: Any) -> bytes:
+    if fast_json_dumps is not None:
+        try:
+            return fast_json_dumps(data)
+        except TypeError:
+            # Names of files undecodable as UTF-8 contain surrogates which are escaped by the standard module only.
+            pass
+    return std_json_dumps(data).encode()
+
+
+def json_reply(body: bytes, *, encoding: str | None = None, headers: Mapping[str, str] | None = None) -> Response:
+    """ Returns the reply with JSON body, already compressed by the encoding if it's given. """
+    reply_headers = {'Vary': 'Accept-Encoding'}
+    if headers:
+        reply_headers.update(headers)
+    if encoding is not None:
+        reply_headers['Content-Encoding'] = encoding
+    return Response(body=body, content_type='application/json', headers=reply_headers)
+
+
+def _get_accepted(request: Request) -> Dict[str, float]:
+    accepted = dict()
+    for item in request.headers.get('Accept-Encoding', '').lower().split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        accepted[name.strip()] = quality
+    return accepted
+
+
+class ReplyEncoder:
+    """
+    Serializes and compresses replies. Replies which depend on a few values only are kept
+    serialized by the key made of these values, so they are rebuilt only when the values change.
+    """
+
+    def __init__(self, settings: Dict[str, Any]):
+        section: Dict[str, Any] = settings.get('compression', {})
+        self.__min_size: int = section.get('min-size', 1024)
+        self.__level: int = section.get('level', 6)
+        self.__encoders: Dict[str, Callable[[bytes], bytes]] = dict(
+            gzip=lambda data: gzip_compress(data, compresslevel=self.__level, mtime=0),
+            deflate=lambda data: zlib.compress(data, self.__level),
+        )
+        if brotli_compress is not None:
+            # Brotli levels are 0-11, the middle one is fast enough for replies made on the fly.
+            self.__encoders['br'] = lambda data: brotli_compress(data, quality=min(self.__level, 11))
+        if not section.get('enabled', True):
+            self.__encoders.clear()
+        self.__cache: OrderedDict[Hashable, bytes] = OrderedDict()
+        log.debug('Replies are encoded by %s, compressed by %s.', 'orjson' if fast_json_dumps else 'json', list(self.__encoders))
+
+    def is_enabled(self) -> bool:
+        return bool(self.__encoders)
+
+    def get_encoding(self, request: Request, size: int) -> str | None:
+        """ Returns the best encoding accepted by the client or None if the body should be sent as is. """
+        if size < self.__min_size or not self.__encoders:
+            return None
+        accepted = _get_accepted(request)
+        wildcard = accepted.get('*', 0.0)
+        best_encoding, best_quality = None, 0.0
+        for encoding in _ENCODINGS:
+            quality = accepted.get(encoding, wildcard)
+            if encoding in self.__encoders and quality > best_quality:
+                best_encoding, best_quality = encoding, quality
+        return best_encoding
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        return self.__encoders[encoding](body)
+
+    def get_cached(self, key: Hashable, build: Callable[[], Any]) -> bytes:
+        """ Returns the serialized reply built by the function, it's called when the key is not seen yet. """
+        body = self.__cache.get(key)
+        if body is None:
+            body = self.__cache[key] = json_dumps(build())
+            if len(self.__cache) > _CACHE_SIZE:
+                self.__cache.popitem(last=False)
+        else:
+            self.__cache.move_to_end(key)
+        return body
+
+    def reply(self, request: Request, key: Hashable, build: Callable[[], Any]) -> Response:
+        """ Returns the cached reply, small ones are not compressed. """
+        body = self.get_cached(key, build)
+        if (encoding := self.get_encoding(request, len(body))) is not None:
+            body = self.compress(body, encoding)
+        return json_reply(body, encoding=encoding)
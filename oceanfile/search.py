@@ -0,0 +1,310 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import sqlite3
+from asyncio import CancelledError, Task, create_task, get_running_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from dataclasses import dataclass
+from fcntl import LOCK_EX, LOCK_NB, flock
+from os import O_CLOEXEC, O_CREAT, O_RDWR, close as os_close, open as os_open, scandir
+from pathlib import Path
+from time import monotonic
+from typing import Any, Dict, List, Set, Tuple
+
+from oceanfile.workers import WorkersLink
+
+log = logging.getLogger(__name__)
+
+# Changed directories are collected for this time, in seconds, to be indexed at once.
+_REFRESH_DELAY = 2
+# Number of matches counted for the total of search results.
+MAX_TOTAL = 10000
+# Shorter queries have no trigrams to be matched by the index.
+MIN_QUERY_LENGTH = 3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    UNIQUE (parent, name)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5(name, content='entries', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO names (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    INSERT INTO names (names, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+'''
+
+# Type flag, size and mtime of the entry.
+_EntryInfo = Tuple[int, int, int]
+
+
+@dataclass(frozen=True)
+class SearchResult:
+    path: str
+    name: str
+    is_dir: bool
+    size: int
+    mtime: int
+
+
+def _join(parent: str, name: str) -> str:
+    return f'{parent}/{name}' if parent else name
+
+
+def _get_subtree_range(parent: str) -> Tuple[str, str]:
+    """ Returns bounds of the parent column for entries under the directory, '0' goes right after '/'. """
+    return f'{parent}/', f'{parent}0'
+
+
+def _scan_dir(dir_path: Path) -> Dict[str, _EntryInfo] | None:
+    entries = dict()
+    try:
+        with scandir(dir_path) as dir_entries:
+            for entry in dir_entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        is_dir = 1
+                    elif entry.is_file():
+                        is_dir = 0
+                    else:
+                        continue
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries[entry.name] = (is_dir, 0 if is_dir else info.st_size, int(info.st_mtime))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return entries
+
+
+class SearchIndex:
+    """
+    Index of names of all files and directories of the share in SQLite database with FTS5 table
+    using trigram tokenizer, so any part of a name is found. The index is built in background,
+    then changed directories reported by the share watcher are indexed again, and the whole share
+    is reconciled with the index periodically. With several workers the index is updated by the
+    primary one, which gets the changes made by all of them, the others only search. Updates and
+    searches are made in their own threads with their own connections, so searches are not blocked
+    by indexing.
+    """
+
+    def __init__(self, root: Path, settings: Dict[str, Any], link: WorkersLink | None = None):
+        section: Dict[str, Any] | None = settings.get('search')
+        self.__root = root
+        self.__enabled = section is not None
+        if section is None:
+            section = dict()
+        self.__path = Path(section.get('index', './search.db')).resolve()
+        self.__reconcile_interval: int = section.get('reconcile-interval', 3600)
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='search-index')
+        self.__search_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='search')
+        self.__db: sqlite3.Connection | None = None
+        self.__search_db: sqlite3.Connection | None = None
+        self.__lock_fd: int | None = None
+        self.__changed: Set[str] = set()
+        self.__rescan = True
+        self.__tasks: List[Task] = []
+        self.__refresh_task: Task | None = None
+        self.__link = link
+
+    def is_enabled(self) -> bool:
+        return self.__enabled
+
+    async def start(self):
+        if not self.__enabled:
+            return
+        loop = get_running_loop()
+        is_writer = await loop.run_in_executor(self.__executor, self.__open)
+        await loop.run_in_executor(self.__search_executor, self.__open_search)
+        if is_writer:
+            self.__tasks = [create_task(self.__reconcile_loop())]
+            self.__refresh_task = create_task(self.__refresh())
+
+    async def close(self):
+        for task in [*self.__tasks, self.__refresh_task]:
+            if task is None:
+                continue
+            task.cancel()
+            with suppress(CancelledError):
+                await task
+        if self.__enabled:
+            loop = get_running_loop()
+            await loop.run_in_executor(self.__executor, self.__close)
+            await loop.run_in_executor(self.__search_executor, self.__close_search)
+        self.__executor.shutdown()
+        self.__search_executor.shutdown()
+
+    def __open(self) -> bool:
+        self.__path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if self.__link is not None and not self.__link.is_primary:
+            is_writer = False
+        else:
+            # Index can be shared with another server too.
+            self.__lock_fd = os_open(self.__path.with_name(f'{self.__path.name}.lock'), O_RDWR | O_CREAT | O_CLOEXEC, 0o600)
+            try:
+                flock(self.__lock_fd, LOCK_EX | LOCK_NB)
+            except BlockingIOError:
+                is_writer = False
+            else:
+                is_writer = True
+        self.__db = sqlite3.connect(self.__path, timeout=30, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        if is_writer:
+            self.__db.execute('PRAGMA synchronous=NORMAL')
+            self.__db.executescript(_SCHEMA)
+        log.info("Using search index '%s'%s.", self.__path, '' if is_writer else ' updated by another process')
+        return is_writer
+
+    def __open_search(self):
+        self.__search_db = sqlite3.connect(self.__path, timeout=30, check_same_thread=False)
+
+    def __close(self):
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+        if self.__lock_fd is not None:
+            os_close(self.__lock_fd)
+            self.__lock_fd = None
+
+    def __close_search(self):
+        if self.__search_db is not None:
+            self.__search_db.close()
+            self.__search_db = None
+
+    def __get_parent(self, dir_path: Path) -> str:
+        return '' if dir_path == self.__root else str(dir_path.relative_to(self.__root))
+
+    def changed(self, dir_path: Path | None):
+        if not self.__tasks:
+            # Index is disabled or updated by another process.
+            return
+        if dir_path is None:
+            self.__rescan = True
+        elif dir_path == self.__root or self.__root in dir_path.parents:
+            self.__changed.add(self.__get_parent(dir_path))
+        if self.__refresh_task is None or self.__refresh_task.done():
+            self.__refresh_task = create_task(self.__refresh())
+
+    async def __reconcile_loop(self):
+        while True:
+            await sleep(self.__reconcile_interval)
+            self.changed(None)
+
+    async def __refresh(self):
+        loop = get_running_loop()
+        while self.__rescan or self.__changed:
+            if self.__rescan:
+                self.__rescan = False
+                self.__changed.clear()
+                start_time = monotonic()
+                count = await self.__index_tree('', True)
+                log.info('Search index reconciled with %d directories in %.1fs.', count, monotonic() - start_time)
+            else:
+                await sleep(_REFRESH_DELAY)
+                changed, self.__changed = self.__changed, set()
+                for parent in sorted(changed):
+                    await self.__index_tree(parent, False)
+                log.debug('Search index updated after %d directories changed.', len(changed))
+
+    async def __index_tree(self, parent: str, recursive: bool) -> int:
+        """ Indexes the directory and its new subdirectories, or all subdirectories if recursive. """
+        loop = get_running_loop()
+        count = 0
+        pending = [parent]
+        while pending:
+            dir_name = pending.pop()
+            try:
+                pending.extend(await loop.run_in_executor(self.__executor, self.__index_dir, dir_name, recursive))
+            except sqlite3.Error:
+                log.exception("Unable to index directory '%s'.", dir_name)
+            count += 1
+        return count
+
+    def __index_dir(self, parent: str, recursive: bool) -> List[str]:
+        """ Makes the index of the directory entries match them, returns subdirectories to index. """
+        actual = _scan_dir(self.__root / parent)
+        with self.__db:
+            if actual is None:
+                self.__remove_tree(parent)
+                return []
+            rows = self.__db.execute('SELECT name, is_dir, size, mtime FROM entries WHERE parent = ?', (parent,))
+            indexed: Dict[str, _EntryInfo] = {name: (is_dir, size, mtime) for name, is_dir, size, mtime in rows}
+            subdirs = []
+            for name, entry_info in indexed.items():
+                if name not in actual or actual[name][0] != entry_info[0]:
+                    self.__db.execute('DELETE FROM entries WHERE parent = ? AND name = ?', (parent, name))
+                    if entry_info[0]:
+                        self.__remove_tree(_join(parent, name))
+            for name, entry_info in actual.items():
+                prev_info = indexed.get(name)
+                if prev_info is None or prev_info[0] != entry_info[0]:
+                    self.__db.execute('INSERT INTO entries (parent, name, is_dir, size, mtime) VALUES (?, ?, ?, ?, ?)', (parent, name, *entry_info))
+                    if entry_info[0]:
+                        subdirs.append(_join(parent, name))
+                    continue
+                if prev_info != entry_info:
+                    self.__db.execute('UPDATE entries SET size = ?, mtime = ? WHERE parent = ? AND name = ?', (*entry_info[1:], parent, name))
+                if recursive and entry_info[0]:
+                    subdirs.append(_join(parent, name))
+        return subdirs
+
+    def __remove_tree(self, parent: str):
+        low, high = _get_subtree_range(parent)
+        self.__db.execute('DELETE FROM entries WHERE parent = ? OR (parent >= ? AND parent < ?)', (parent, low, high))
+
+    def __search(self, query: str, parent: str, offset: int, limit: int) -> Tuple[List[SearchResult], int]:
+        low, high = _get_subtree_range(parent)
+        # Any part of a name is matched by the phrase of its trigrams.
+        source = 'entries JOIN names ON names.rowid = entries.id WHERE names MATCH ?'
+        pattern = '"' + query.replace('"', '""') + '"'
+        if parent:
+            source += ' AND (entries.parent = ? OR (entries.parent >= ? AND entries.parent < ?))'
+            params = (pattern, parent, low, high)
+        else:
+            params = (pattern,)
+        try:
+            rows = self.__search_db.execute(f'SELECT entries.parent, entries.name, is_dir, size, mtime FROM {source} ORDER BY entries.id LIMIT ? OFFSET ?', (*params, limit, offset))
+            results = [
+                SearchResult(path=_join(row_parent, name), name=name, is_dir=bool(is_dir), size=size, mtime=mtime)
+                for row_parent, name, is_dir, size, mtime in rows
+            ]
+            total, = self.__search_db.execute(f'SELECT COUNT(*) FROM (SELECT 1 FROM {source} LIMIT ?)', (*params, MAX_TOTAL)).fetchone()
+        except sqlite3.OperationalError as error:
+            # Index is not created yet by the process updating it.
+            log.warning('Unable to search %r: %s.', query, error)
+            return [], 0
+        return results, total
+
+    async def search(self, query: str, dir_path: Path, offset: int, limit: int) -> Tuple[List[SearchResult], int]:
+        """
+        Returns entries of the directory tree with names containing the query, case insensitive,
+        and the number of all matches (at most 10000). Query must have at least 3 characters.
+        """
+        parent = self.__get_parent(dir_path)
+        start_time = monotonic()
+        results, total = await get_running_loop().run_in_executor(self.__search_executor, self.__search, query, parent, offset, limit)
+        log.debug('Search %r in %r found %d entries in %.3fs.', query, parent, total, monotonic() - start_time)
+        return results, total
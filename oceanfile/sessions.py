@@ -14,57 +14,376 @@
 """
 
 import logging
-from json import dump as json_dump, load as json_load
+from asyncio import CancelledError, Event, Future, Task, create_task, get_running_loop, shield, sleep
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from fcntl import LOCK_EX, flock
+from json import dumps as json_dumps, loads as json_loads
+from os import O_APPEND, O_CLOEXEC, O_CREAT, O_RDWR, O_WRONLY, close as os_close, fdatasync, fstat, open as os_open, write as os_write
 from pathlib import Path
-from time import ctime, time
-from typing import Any, Dict
+from time import ctime, monotonic, time
+from typing import Any, BinaryIO, Dict, Iterable, List, Tuple
 from uuid import uuid4
 
 from oceanfile.atomic import atomic_save
 from oceanfile.errors import SessionNotFound
+from oceanfile.metrics import Histogram
+from oceanfile.tokens import TokenClaims, TokenSigner, load_key
 
 log = logging.getLogger(__name__)
 
+# Log is compacted when it has this number of records more than the number of sessions.
+_COMPACT_THRESHOLD = 1000
+# Interval between purges of expired sessions, in seconds.
+_PURGE_INTERVAL = 3600
+# Interval between reads of records appended by other processes, in seconds.
+_FOLLOW_INTERVAL = 1
+
+_sync_duration = Histogram('oceanfile_sessions_sync_seconds', 'Time of saving records to sessions cache.')
+
+
+def _make_record(token: str, session: Dict[str, Any]) -> str:
+    return json_dumps(dict(token=token, **session)) + '\n'
+
+
+def _make_signed_record(jti: str, state: Dict[str, Any]) -> str:
+    return json_dumps(dict(jti=jti, **state)) + '\n'
+
+
+def _apply_records(lines: Iterable[str | bytes], sessions: Dict[str, Dict[str, Any]], signed: Dict[str, Dict[str, Any]]) -> int:
+    """ Applies records to sessions and to states of signed tokens, revoked token is never extended. """
+    cur_time = time()
+    count = 0
+    for line in lines:
+        try:
+            record: Dict[str, Any] = json_loads(line)
+        except ValueError:
+            # Last record may be incomplete after crash.
+            log.warning('Skipping broken record in sessions cache.')
+            continue
+        count += 1
+        if 'jti' in record:
+            jti = record.pop('jti')
+            prev_state = signed.get(jti)
+            if prev_state is not None and prev_state.get('revoked'):
+                record['revoked'] = True
+                record['deadline'] = max(record['deadline'], prev_state['deadline'])
+            if record['deadline'] > cur_time:
+                signed[jti] = record
+            else:
+                signed.pop(jti, None)
+            continue
+        # Cache written by the old versions is a single mapping.
+        records = {record.pop('token'): record} if 'token' in record else record
+        for token, session in records.items():
+            if session['deadline'] > cur_time:
+                sessions[token] = session
+            else:
+                sessions.pop(token, None)
+    return count
+
+
+@contextmanager
+def _locked(lock_path: Path):
+    lock_fd = os_open(lock_path, O_RDWR | O_CREAT | O_CLOEXEC, 0o600)
+    try:
+        flock(lock_fd, LOCK_EX)
+        yield
+    finally:
+        os_close(lock_fd)
+
 
 class AuthSessions:
-    def __init__(self, settings: Dict[str, Any]):
+    """
+    Sessions are kept in memory and persisted to the append-only log of JSON records.
+    Records are written by batches in a separate thread and the log is compacted from time to time.
+    When the log is shared by several server processes they follow the records written by each other.
+    Signed tokens are checked by their signature, only their extended deadlines and revocations
+    are kept as records, and the deadline is extended when a half of the TTL is left. Checks of
+    signed tokens never touch the log, revocations made by other processes are seen by them
+    in a second when the log is followed.
+    """
+
+    def __init__(self, settings: Dict[str, Any], *, shared: bool = False):
         section: Dict[str, Any] = settings['sessions']
         self.__ttl: int = section['ttl']
         self.__path = Path(section['cache'])
+        self.__lock_path = self.__path.with_name(f'{self.__path.name}.lock')
+        # Records are collected for this time, in seconds, to be written at once.
+        self.__sync_delay: float = section.get('sync-delay', 0.05)
+        self.__shared = shared
+        self.__sessions: Dict[str, Dict[str, Any]] = dict()
+        # States of signed tokens by their IDs.
+        self.__signed: Dict[str, Dict[str, Any]] = dict()
+        self.__key_path = Path(section['key']) if section.get('signed', False) else None
+        self.__signer: TokenSigner | None = None
+        self.__records_count = 0
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sessions')
+        self.__log_fd = -1
+        self.__tail_file: BinaryIO | None = None
+        self.__tail_offset = 0
+        # Read of the log tail in progress and the one waiting for it.
+        self.__cur_follow: Task | None = None
+        self.__next_follow: Task | None = None
+        self.__pending: List[str] = []
+        self.__batch: Future | None = None
+        self.__wakeup = Event()
+        self.__tasks: List[Task] = []
+
+    async def start(self):
+        loop = get_running_loop()
+        if self.__key_path is not None:
+            self.__signer = TokenSigner(await loop.run_in_executor(self.__executor, load_key, self.__key_path))
+        self.__sessions, self.__signed = await loop.run_in_executor(self.__executor, self.__compact)
+        self.__batch = loop.create_future()
+        self.__tasks = [create_task(self.__sync_loop()), create_task(self.__purge_loop())]
+        if self.__shared:
+            self.__tasks.append(create_task(self.__follow_loop()))
+
+    async def close(self):
+        for task in self.__tasks:
+            task.cancel()
+            with suppress(CancelledError):
+                await task
+        for task in (self.__next_follow, self.__cur_follow):
+            if task is not None:
+                with suppress(Exception):
+                    await task
+        await self.__sync()
+        await get_running_loop().run_in_executor(self.__executor, self.__close_log)
+        self.__executor.shutdown()
+        if self.__tail_file is not None:
+            self.__tail_file.close()
+
+    def __close_log(self):
+        if self.__log_fd >= 0:
+            os_close(self.__log_fd)
+            self.__log_fd = -1
+
+    def __open_log(self):
+        self.__close_log()
+        self.__log_fd = os_open(self.__path, O_WRONLY | O_APPEND | O_CREAT | O_CLOEXEC, 0o600)
+
+    def __compact(self) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+        # Log is read again because other processes could write to it.
+        sessions = dict()
+        signed = dict()
+        with _locked(self.__lock_path):
+            try:
+                with self.__path.open(mode='rb') as sessions_file:
+                    _apply_records(sessions_file, sessions, signed)
+            except FileNotFoundError:
+                pass
+            with atomic_save(self.__path, perms=0o600) as sessions_file:
+                sessions_file.writelines(_make_record(token, session) for token, session in sessions.items())
+                sessions_file.writelines(_make_signed_record(jti, state) for jti, state in signed.items())
+            self.__open_log()
+        self.__records_count = len(sessions) + len(signed)
+        log.debug('Sessions cache compacted, %d sessions, %d signed tokens states.', len(sessions), len(signed))
+        return sessions, signed
+
+    def __append(self, data: bytes, need_compact: bool):
+        with _locked(self.__lock_path):
+            if self.__shared and fstat(self.__log_fd).st_ino != self.__path.stat().st_ino:
+                # Log is compacted by another process.
+                self.__open_log()
+            # Records are written at once so they are not mixed with records of other processes.
+            while data:
+                data = data[os_write(self.__log_fd, data):]
+            fdatasync(self.__log_fd)
+        if need_compact:
+            self.__compact()
+
+    async def __sync(self):
+        if not self.__pending:
+            return
+        records, self.__pending = self.__pending, []
+        batch, self.__batch = self.__batch, get_running_loop().create_future()
+        self.__records_count += len(records)
+        need_compact = self.__records_count > len(self.__sessions) + len(self.__signed) + _COMPACT_THRESHOLD
+        start_time = monotonic()
         try:
-            with self.__path.open(mode='rt') as sessions_file:
-                sessions = json_load(sessions_file)
-        except FileNotFoundError:
-            sessions = dict()
+            await get_running_loop().run_in_executor(self.__executor, self.__append, ''.join(records).encode(), need_compact)
+        except Exception as error:
+            log.exception('Unable to save %d records to sessions cache.', len(records))
+            batch.set_result(error)
+        else:
+            batch.set_result(None)
+        _sync_duration.observe(monotonic() - start_time)
+
+    async def __sync_loop(self):
+        while True:
+            await self.__wakeup.wait()
+            await sleep(self.__sync_delay)
+            self.__wakeup.clear()
+            await self.__sync()
+
+    def __purge(self):
         cur_time = time()
-        self.__sessions = {token: session for token, session in sessions.items() if session['deadline'] > cur_time}
+        for token in [token for token, session in self.__sessions.items() if session['deadline'] <= cur_time]:
+            del self.__sessions[token]
+        for jti in [jti for jti, state in self.__signed.items() if state['deadline'] <= cur_time]:
+            del self.__signed[jti]
 
-    def __sync(self, sessions: Dict[str, float]):
-        with atomic_save(self.__path, perms=0o600) as sessions_file:
-            json_dump(sessions, sessions_file)
-        self.__sessions = sessions
+    async def __purge_loop(self):
+        while True:
+            await sleep(_PURGE_INTERVAL)
+            count = len(self.__sessions)
+            self.__purge()
+            log.debug('%d expired sessions purged.', count - len(self.__sessions))
 
-    def add(self, user: str) -> str:
+    def __read_tail(self) -> List[bytes]:
+        """ Reads records appended to the log by other processes since the last call. """
+        try:
+            info = self.__path.stat()
+        except FileNotFoundError:
+            return []
+        if self.__tail_file is None or fstat(self.__tail_file.fileno()).st_ino != info.st_ino:
+            if self.__tail_file is not None:
+                self.__tail_file.close()
+            # Log is compacted, new one contains all sessions so it's read from the start.
+            self.__tail_file = self.__path.open(mode='rb')
+            self.__tail_offset = 0
+        elif info.st_size <= self.__tail_offset:
+            return []
+        self.__tail_file.seek(self.__tail_offset)
+        data = self.__tail_file.read()
+        # Last record can be not written completely yet.
+        size = data.rfind(b'\n') + 1
+        self.__tail_offset += size
+        return data[:size].splitlines()
+
+    async def __follow_next(self, current: Task | None):
+        if current is not None:
+            # Read in progress could start before the record looked for was written.
+            with suppress(Exception):
+                await current
+        self.__cur_follow, self.__next_follow = self.__next_follow, None
+        try:
+            lines = await get_running_loop().run_in_executor(None, self.__read_tail)
+        except OSError as error:
+            log.error('Unable to read sessions cache: %s.', error)
+            return
+        finally:
+            self.__cur_follow = None
+        count = _apply_records(lines, self.__sessions, self.__signed)
+        log.debug('%d records read from sessions cache.', count)
+
+    async def __follow(self):
+        """ Reads the log at least once after the call, concurrent calls share the same read. """
+        if self.__next_follow is None:
+            self.__next_follow = create_task(self.__follow_next(self.__cur_follow))
+        await shield(self.__next_follow)
+
+    async def __follow_loop(self):
+        while True:
+            await sleep(_FOLLOW_INTERVAL)
+            await self.__follow()
+
+    async def __find_session(self, token: str) -> Dict[str, Any] | None:
+        session = self.__sessions.get(token)
+        if session is None and self.__shared:
+            # Token could be just given by another process.
+            await self.__follow()
+            session = self.__sessions.get(token)
+        return session
+
+    def __put(self, token: str, user: str, deadline: float) -> Future:
+        session = dict(user=user, deadline=deadline)
+        self.__sessions[token] = session
+        self.__pending.append(_make_record(token, session))
+        self.__wakeup.set()
+        return self.__batch
+
+    def __put_state(self, jti: str, state: Dict[str, Any]) -> Future:
+        self.__signed[jti] = state
+        self.__pending.append(_make_signed_record(jti, state))
+        self.__wakeup.set()
+        return self.__batch
+
+    def __get_claims(self, token: str) -> Tuple[TokenClaims, float] | None:
+        """ Returns claims of the valid signed token and its current deadline. """
+        claims = self.__signer.verify(token)
+        if claims is None:
+            log.debug('Token %r has invalid signature.', token)
+            return None
+        # Revocations made by other processes are seen after they are followed in background.
+        state = self.__signed.get(claims.jti)
+        if state is None:
+            return claims, claims.expires
+        if state.get('revoked'):
+            log.debug('Token %r (user=%r) is revoked.', claims.jti, claims.user)
+            return None
+        return claims, max(claims.expires, state['deadline'])
+
+    async def add(self, user: str) -> str:
+        if self.__signer is not None:
+            # Signed token is not saved at all, it's checked by the signature.
+            claims = TokenClaims(user=user, jti=uuid4().hex, expires=int(time()) + self.__ttl)
+            log.info('New signed token %r (user=%r) issued, deadline=%r.', claims.jti, user, ctime(claims.expires))
+            return self.__signer.sign(claims)
         token = str(uuid4())
         deadline = time() + self.__ttl
-        self.__sync({**self.__sessions, token: dict(user=user, deadline=deadline)})
+        # New session must be saved before the token is given to the client.
+        if (error := await self.__put(token, user, deadline)) is not None:
+            raise error
         log.info('New token %r (user=%r) added, deadline=%r.', token, user, ctime(deadline))
         return token
 
-    def get_user(self, token: str) -> str:
-        session = self.__sessions.get(token)
+    async def authorize(self, token: str) -> str | None:
+        """ Checks the token and extends its deadline, returns the user or None if the token is not valid. """
+        if self.__signer is not None and self.__signer.is_signed(token):
+            found = self.__get_claims(token)
+            if found is None:
+                return None
+            claims, deadline = found
+            cur_time = time()
+            if cur_time >= deadline:
+                log.debug('Token %r (user=%r) is expired.', claims.jti, claims.user)
+                return None
+            if deadline - cur_time < self.__ttl / 2:
+                new_deadline = int(cur_time) + self.__ttl
+                self.__put_state(claims.jti, dict(user=claims.user, deadline=new_deadline))
+                log.debug('Token %r (user=%r) extended, new deadline %r.', claims.jti, claims.user, ctime(new_deadline))
+            return claims.user
+        session = await self.__find_session(token)
         if session is None:
-            raise SessionNotFound()
+            log.debug('Token %r is not found in sessions.', token)
+            return None
+        if time() >= session['deadline']:
+            log.debug('Token %r (user=%r) is expired.', token, session['user'])
+            return None
+        self.update(token)
         return session['user']
 
-    def check(self, token: str) -> bool:
+    def revoke(self, token: str) -> bool:
+        """ Revokes the token before its deadline, returns False if the token is not valid. """
+        if self.__signer is not None and self.__signer.is_signed(token):
+            found = self.__get_claims(token)
+            if found is None:
+                return False
+            claims, deadline = found
+            # Revocation is kept until the token expires by itself.
+            self.__put_state(claims.jti, dict(user=claims.user, deadline=deadline, revoked=True))
+            log.info('Token %r (user=%r) revoked.', claims.jti, claims.user)
+            return True
         session = self.__sessions.get(token)
         if session is None:
-            log.debug('Token %r is not found in sessions.', token)
             return False
-        is_valid = time() < session['deadline']
-        log.debug('Token %r (user=%r) is valid? %s.', token, session['user'], is_valid)
-        return is_valid
+        self.__put(token, session['user'], 0)
+        del self.__sessions[token]
+        log.info('Token %r (user=%r) revoked.', token, session['user'])
+        return True
+
+    def get_user(self, token: str) -> str:
+        if self.__signer is not None and self.__signer.is_signed(token):
+            if (found := self.__get_claims(token)) is None:
+                raise SessionNotFound()
+            return found[0].user
+        session = self.__sessions.get(token)
+        if session is None:
+            raise SessionNotFound()
+        return session['user']
 
     def update(self, token: str):
         session = self.__sessions[token]
@@ -74,5 +393,5 @@ class AuthSessions:
             # Do not change file if deadline is not near.
             return
         user = session['user']
-        self.__sync({**self.__sessions, token: dict(user=user, deadline=new_deadline)})
+        self.__put(token, user, new_deadline)
         log.debug('Token %r (user=%r) updated, new deadline %r.', token, user, ctime(new_deadline))
@@ -15,9 +15,8 @@
 
 from dataclasses import dataclass
 from hashlib import md5
-from os import statvfs
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Tuple
 
 
 @dataclass(frozen=True)
@@ -36,25 +35,37 @@ class ServerSettings:
         )
 
 
+@dataclass(frozen=True)
+class MetricsSettings:
+    enabled: bool
+    allow: Tuple[str, ...]
+
+    @classmethod
+    def load(cls, settings: Dict[str, Any]):
+        section = settings.get('metrics')
+        if section is None:
+            return cls(enabled=False, allow=())
+        return cls(
+            enabled=True,
+            allow=tuple(section.get('allow', ['127.0.0.1', '::1'])),
+        )
+
+
 @dataclass(frozen=True)
 class ShareSettings:
     id: str
     name: str
     path: Path
-    max_size: int
 
     @classmethod
     def load(cls, settings: Dict[str, Any]):
         section = settings['share']
         name = section['name']
-        path = Path(section['path'])
+        path = Path(section['path']).resolve()
         # In fact it can be any value but I think it's good idea to use MD5 of the name.
         sid = md5(name.encode(encoding='utf-8', errors='replace')).hexdigest()
-        info = statvfs(path)
-        max_size = info.f_bsize * info.f_bavail
         return cls(
             id=sid,
             name=name,
             path=path,
-            max_size=max_size,
         )
@@ -0,0 +1,196 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import Future, Task, create_task, get_running_loop
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from multiprocessing import get_context
+from os import stat_result
+from pathlib import Path
+from typing import Any, Dict, List, Set, Tuple
+
+from oceanfile.atomic import atomic_save
+from oceanfile.workers import WorkersLink
+
+log = logging.getLogger(__name__)
+
+# Thumbnails are made only for files with these extensions.
+_IMAGE_SUFFIXES = frozenset(('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp'))
+
+
+def _render(src_path: Path, dst_path: Path, size: int):
+    """ Runs in the worker process. """
+    from PIL import Image, ImageOps
+
+    with Image.open(src_path) as image:
+        image.draft('RGB', (size, size))
+        thumbnail = ImageOps.exif_transpose(image)
+        thumbnail.thumbnail((size, size))
+        if thumbnail.mode not in ('L', 'RGB'):
+            thumbnail = thumbnail.convert('RGB')
+        dst_path.parent.mkdir(exist_ok=True)
+        with atomic_save(dst_path, text=False) as dst_file:
+            thumbnail.save(dst_file, format='JPEG', quality=85)
+
+
+def _load_cache(cache_path: Path) -> List[Tuple[Path, int]]:
+    """ Returns cached thumbnails and their sizes, least recently used go first. """
+    cache_path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    entries = [(path, path.stat()) for path in cache_path.glob('*/*.jpg')]
+    entries.sort(key=lambda entry: entry[1].st_atime)
+    return [(path, info.st_size) for path, info in entries]
+
+
+def _remove_files(paths: List[Path]):
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+
+class Thumbnails:
+    """
+    Thumbnails of images are made by the pool of processes and kept in the cache directory.
+    Cached files are named by the hash of the image path, modification time, size and thumbnail size
+    and removed when the total size of the cache is over the limit, least recently used first.
+    With several workers the cache is indexed and evicted by the primary one only, other ones
+    find the thumbnails in the cache directory and report their use to it.
+    """
+
+    def __init__(self, root: Path, settings: Dict[str, Any], link: WorkersLink | None = None):
+        section: Dict[str, Any] | None = settings.get('thumbnails')
+        self.__root = root
+        self.__enabled = section is not None
+        if section is None:
+            section = dict()
+        self.__cache_path = Path(section.get('cache', './thumbnails')).resolve()
+        self.__max_size: int = section.get('cache-size', 1024 * 1024 * 1024)
+        self.__workers: int = section.get('workers', 2)
+        self.__prewarm_sizes: List[int] = section.get('prewarm-sizes', [])
+        self.__entries: OrderedDict[Path, int] = OrderedDict()
+        self.__size = 0
+        self.__executor: ProcessPoolExecutor | None = None
+        self.__pending: Dict[Path, Future] = dict()
+        self.__tasks: Set[Task] = set()
+        self.__link = link
+        if link is not None:
+            link.add_handler('thumbnail', self.__used_by_worker)
+
+    def __is_primary(self) -> bool:
+        return self.__link is None or self.__link.is_primary
+
+    def is_enabled(self) -> bool:
+        return self.__enabled
+
+    async def start(self):
+        if not self.__enabled:
+            return
+        try:
+            # This dependency is optional.
+            import PIL
+        except ImportError:
+            log.warning('Pillow module is not installed, thumbnails are disabled.')
+            self.__enabled = False
+            return
+        loop = get_running_loop()
+        if self.__is_primary():
+            for path, size in await loop.run_in_executor(None, _load_cache, self.__cache_path):
+                self.__entries[path] = size
+                self.__size += size
+        # Forking of the running server is not safe because of its threads.
+        self.__executor = ProcessPoolExecutor(max_workers=self.__workers, mp_context=get_context('forkserver'))
+        log.info("Using thumbnails cache '%s', %d files, %d bytes.", self.__cache_path, len(self.__entries), self.__size)
+
+    async def close(self):
+        for task in list(self.__tasks):
+            task.cancel()
+        if self.__executor is not None:
+            self.__executor.shutdown(cancel_futures=True)
+            self.__executor = None
+
+    def __get_thumb_path(self, path: Path, info: stat_result, size: int) -> Path:
+        key = f'{path.relative_to(self.__root)}\0{info.st_mtime_ns}\0{info.st_size}\0{size}'
+        name = sha256(key.encode(encoding='utf-8', errors='surrogateescape')).hexdigest()
+        return self.__cache_path / name[:2] / f'{name}.jpg'
+
+    async def get(self, path: Path, info: stat_result, size: int) -> Path | None:
+        """ Returns path of the thumbnail or None if the file is not an image. """
+        if path.suffix.lower() not in _IMAGE_SUFFIXES:
+            return None
+
+        thumb_path = self.__get_thumb_path(path, info, size)
+        if self.__is_primary():
+            if thumb_path in self.__entries:
+                self.__entries.move_to_end(thumb_path)
+                return thumb_path
+        else:
+            try:
+                thumb_size = (await get_running_loop().run_in_executor(None, thumb_path.stat)).st_size
+            except FileNotFoundError:
+                pass
+            else:
+                self.__link.send('thumbnail', [str(thumb_path), thumb_size])
+                return thumb_path
+
+        # The same thumbnail can be requested many times until it's ready.
+        if (future := self.__pending.get(thumb_path)) is None:
+            future = get_running_loop().run_in_executor(self.__executor, _render, path, thumb_path, size)
+            self.__pending[thumb_path] = future
+            future.add_done_callback(lambda _: self.__pending.pop(thumb_path, None))
+        try:
+            await future
+        except Exception as error:
+            log.error("Unable to make thumbnail of '%s': %s.", path, error)
+            return None
+
+        if thumb_path not in self.__entries:
+            thumb_size = (await get_running_loop().run_in_executor(None, thumb_path.stat)).st_size
+            if self.__is_primary():
+                self.__add_entry(thumb_path, thumb_size)
+            else:
+                self.__link.send('thumbnail', [str(thumb_path), thumb_size])
+            log.debug("Thumbnail '%s' of '%s' made, size %d.", thumb_path, path, thumb_size)
+        return thumb_path
+
+    def __used_by_worker(self, data: List[Any]):
+        thumb_path, thumb_size = Path(data[0]), data[1]
+        if thumb_path in self.__entries:
+            self.__entries.move_to_end(thumb_path)
+        else:
+            self.__add_entry(thumb_path, thumb_size)
+
+    def __add_entry(self, thumb_path: Path, thumb_size: int):
+        self.__entries[thumb_path] = thumb_size
+        self.__size += thumb_size
+        evicted = []
+        while self.__size > self.__max_size and len(self.__entries) > 1:
+            evicted_path, evicted_size = self.__entries.popitem(last=False)
+            self.__size -= evicted_size
+            evicted.append(evicted_path)
+        if evicted:
+            get_running_loop().run_in_executor(None, _remove_files, evicted)
+
+    def prewarm(self, path: Path):
+        """ Makes thumbnails of the commonly used sizes for the new file in background. """
+        if not self.__enabled or not self.__prewarm_sizes or path.suffix.lower() not in _IMAGE_SUFFIXES:
+            return
+        task = create_task(self.__prewarm(path))
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __prewarm(self, path: Path):
+        info = await get_running_loop().run_in_executor(None, path.stat)
+        for size in self.__prewarm_sizes:
+            await self.get(path, info, size)
@@ -0,0 +1,144 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from dataclasses import dataclass
+from hashlib import sha256
+from hmac import compare_digest, new as hmac_new
+from json import dumps as json_dumps, loads as json_loads
+from os import O_CLOEXEC, O_CREAT, O_EXCL, O_WRONLY, close as os_close, fsync, link, open as os_open, write as os_write
+from pathlib import Path
+from secrets import token_bytes, token_hex
+from time import time
+from typing import Any, Dict
+
+log = logging.getLogger(__name__)
+
+_PREFIX = 'v1.'
+_KEY_SIZE = 32
+# Signature is truncated to this number of bytes.
+_SIGNATURE_SIZE = 16
+
+
+@dataclass(frozen=True)
+class TokenClaims:
+    user: str
+    jti: str
+    expires: int
+
+
+def _encode(data: bytes) -> str:
+    return urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def _decode(text: str) -> bytes:
+    return urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def load_key(path: Path) -> bytes:
+    """ Returns the key from the file, the file is created with a new key if it does not exist. """
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        pass
+    # Key is written to a temporary file and linked to the path, so other processes
+    # creating the key at the same time see either nothing or the whole key.
+    tmp_path = path.with_name(f'.{path.name}.{token_hex(8)}')
+    tmp_fd = os_open(tmp_path, O_WRONLY | O_CREAT | O_EXCL | O_CLOEXEC, 0o600)
+    try:
+        os_write(tmp_fd, token_bytes(_KEY_SIZE))
+        fsync(tmp_fd)
+    finally:
+        os_close(tmp_fd)
+    try:
+        link(tmp_path, path)
+        log.info("New tokens key saved to '%s'.", path)
+    except FileExistsError:
+        pass
+    finally:
+        tmp_path.unlink()
+    return path.read_bytes()
+
+
+class TokenSigner:
+    """
+    Tokens carrying the user, the token ID and the expiration time signed by HMAC-SHA256,
+    so they are checked without any lookup. Format: v1.<payload>.<signature> in base64url.
+    """
+
+    def __init__(self, key: bytes):
+        self.__key = key
+
+    def __sign(self, payload: str) -> str:
+        return _encode(hmac_new(self.__key, f'{_PREFIX}{payload}'.encode(), sha256).digest()[:_SIGNATURE_SIZE])
+
+    def sign(self, claims: TokenClaims) -> str:
+        payload = _encode(json_dumps(dict(u=claims.user, j=claims.jti, e=claims.expires), separators=(',', ':')).encode())
+        return f'{_PREFIX}{payload}.{self.__sign(payload)}'
+
+    @staticmethod
+    def is_signed(token: str) -> bool:
+        return token.startswith(_PREFIX)
+
+    def verify(self, token: str) -> TokenClaims | None:
+        """ Returns claims of the token if its signature is valid, expiration time is not checked. """
+        if not token.isascii():
+            # Valid tokens are base64, other input can be not even encodable.
+            return None
+        payload, _, signature = token.removeprefix(_PREFIX).partition('.')
+        if not compare_digest(signature, self.__sign(payload)):
+            return None
+        try:
+            data = json_loads(_decode(payload))
+            return TokenClaims(user=data['u'], jti=data['j'], expires=data['e'])
+        except (BinasciiError, KeyError, TypeError, ValueError):
+            return None
+
+
+class TicketSigner:
+    """
+    Short-lived tickets for requests made later without the session token, like downloads
+    of archives. Ticket carries the request data and its expiration time signed by HMAC-SHA256,
+    it does not carry any credentials. Format: <payload>.<signature> in base64url.
+    """
+
+    def __init__(self, key: bytes, ttl: int):
+        self.__key = key
+        self.__ttl = ttl
+
+    def __sign(self, payload: str) -> str:
+        return _encode(hmac_new(self.__key, payload.encode(), sha256).digest()[:_SIGNATURE_SIZE])
+
+    def sign(self, data: Dict[str, Any]) -> str:
+        payload = _encode(json_dumps(dict(d=data, e=int(time()) + self.__ttl), separators=(',', ':')).encode())
+        return f'{payload}.{self.__sign(payload)}'
+
+    def verify(self, ticket: str) -> Dict[str, Any] | None:
+        """ Returns data of the ticket if its signature is valid and it's not expired. """
+        if not ticket.isascii():
+            # Valid tickets are base64, other input can be not even encodable.
+            return None
+        payload, _, signature = ticket.partition('.')
+        if not compare_digest(signature, self.__sign(payload)):
+            return None
+        try:
+            data = json_loads(_decode(payload))
+            if time() >= data['e']:
+                return None
+            return data['d']
+        except (BinasciiError, KeyError, TypeError, ValueError):
+            return None
@@ -0,0 +1,163 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import re
+from asyncio import CancelledError, Task, create_task, get_running_loop, sleep
+from contextlib import suppress
+from fcntl import LOCK_EX, LOCK_NB, flock
+from hashlib import sha256
+from os import O_CLOEXEC, O_CREAT, O_RDONLY, O_WRONLY, close as os_close, fdatasync, fstat, open as os_open, scandir
+from pathlib import Path
+from time import time
+from typing import Any, BinaryIO, Dict, List
+
+from oceanfile.atomic import atomic_replace
+from oceanfile.errors import UploadInProgress, UploadOffsetMismatch
+from oceanfile.workers import WorkersLink
+
+log = logging.getLogger(__name__)
+
+_PART_NAME_RE = re.compile(r'\..+\.[0-9a-f]{32}\.part')
+
+
+def _lock_part(fd: int) -> bool:
+    try:
+        flock(fd, LOCK_EX | LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+class PartialUpload:
+    """
+    File which is uploaded by chunks. Received data is kept in a hidden file next to the target one
+    so it survives server restart and can be renamed into place when the last chunk is received.
+    The part file is locked while a chunk is written to it, so chunks sent at once are not mixed.
+    All methods are blocking so run them in executor when called from coroutines.
+    """
+
+    def __init__(self, path: Path, user: str):
+        self.path = path
+        # Uploads of the same file by different users must not mix, sessions of one user share them.
+        key = sha256(f'{user}\0{path}'.encode(encoding='utf-8', errors='replace')).hexdigest()[:32]
+        self.__part_path = path.with_name(f'.{path.name}.{key}.part')
+        self.__file: BinaryIO | None = None
+
+    def get_size(self) -> int:
+        try:
+            return self.__part_path.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def open(self, offset: int):
+        fd = os_open(self.__part_path, O_WRONLY | O_CREAT | O_CLOEXEC, 0o644)
+        self.__file = open(fd, mode='wb')
+        if not _lock_part(fd):
+            self.close()
+            raise UploadInProgress()
+        size = fstat(fd).st_size
+        if offset > size:
+            self.close()
+            raise UploadOffsetMismatch(size)
+        # Chunk can be sent again if the client has not received the reply.
+        self.__file.truncate(offset)
+        self.__file.seek(offset)
+
+    def write(self, data: bytes) -> int:
+        return self.__file.write(data)
+
+    def close(self):
+        if self.__file is None:
+            return
+        try:
+            self.__file.flush()
+            fdatasync(self.__file.fileno())
+        finally:
+            self.__file.close()
+            self.__file = None
+
+    def commit(self):
+        """ Renames the part file into place, it's called before close to keep the lock. """
+        self.__file.flush()
+        atomic_replace(self.__part_path, self.path)
+
+
+def _sweep_dir(dir_path: Path, deadline: float) -> int:
+    """ Removes abandoned part files in the tree, returns their number. """
+    count = 0
+    try:
+        with scandir(dir_path) as dir_entries:
+            entries = list(dir_entries)
+    except OSError as error:
+        log.error("Directory '%s' can not be swept: %s.", dir_path, error)
+        return 0
+    for entry in entries:
+        try:
+            if entry.name.startswith('.'):
+                if _PART_NAME_RE.fullmatch(entry.name) and entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < deadline:
+                    count += _remove_part(Path(entry.path))
+            elif entry.is_dir(follow_symlinks=False):
+                count += _sweep_dir(Path(entry.path), deadline)
+        except FileNotFoundError:
+            continue
+        except OSError as error:
+            log.error("Part file '%s' can not be removed: %s.", entry.path, error)
+    return count
+
+
+def _remove_part(path: Path) -> int:
+    fd = os_open(path, O_RDONLY | O_CLOEXEC)
+    try:
+        # Chunk is written to it right now.
+        if not _lock_part(fd):
+            return 0
+        path.unlink()
+    finally:
+        os_close(fd)
+    log.info("Abandoned part file '%s' removed.", path)
+    return 1
+
+
+class PartUploadsSweeper:
+    """
+    Removes part files of uploads which are not continued for the configured time.
+    With several workers the share is swept by the primary one only.
+    """
+
+    def __init__(self, root: Path, settings: Dict[str, Any], link: WorkersLink | None = None):
+        section: Dict[str, Any] = settings.get('uploads', {})
+        self.__root = root
+        self.__ttl: int = section.get('part-ttl', 86400)
+        self.__interval: int = section.get('sweep-interval', 3600)
+        self.__link = link
+        self.__tasks: List[Task] = []
+
+    async def start(self):
+        if self.__link is None or self.__link.is_primary:
+            self.__tasks = [create_task(self.__sweep_loop())]
+
+    async def close(self):
+        for task in self.__tasks:
+            task.cancel()
+            with suppress(CancelledError):
+                await task
+
+    async def __sweep_loop(self):
+        loop = get_running_loop()
+        while True:
+            await sleep(self.__interval)
+            count = await loop.run_in_executor(None, _sweep_dir, self.__root, time() - self.__ttl)
+            log.debug('%d abandoned part files removed.', count)
@@ -0,0 +1,207 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import CancelledError, Task, create_task, get_running_loop, sleep
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import suppress
+from dataclasses import dataclass
+from os import scandir, statvfs
+from pathlib import Path
+from time import monotonic
+from typing import Any, Dict, List, Set, Tuple
+
+from oceanfile.workers import WorkersLink
+
+log = logging.getLogger(__name__)
+
+# Changed directories are collected for this time, in seconds, to be rescanned at once.
+_REFRESH_DELAY = 2
+
+
+@dataclass(frozen=True)
+class _DirUsage:
+    files_size: int
+    subdirs: Tuple[str, ...]
+
+
+def _scan_dir(dir_path: Path) -> _DirUsage | None:
+    files_size = 0
+    subdirs = []
+    try:
+        with scandir(dir_path) as dir_entries:
+            for entry in dir_entries:
+                if entry.name.startswith('.'):
+                    # Hidden entries are not listed, like part files of uploads.
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        files_size += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    continue
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    except PermissionError:
+        # Files of unreadable directory are not listed, so they are not counted.
+        log.debug("Directory '%s' is not readable.", dir_path)
+        return None
+    return _DirUsage(files_size=files_size, subdirs=tuple(subdirs))
+
+
+def _scan_tree(root: Path, workers: int) -> Dict[Path, _DirUsage]:
+    """ Scans directories of the tree in parallel, returns usage of every directory. """
+    dirs = dict()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='usage') as executor:
+        futures: Dict[Future, Path] = {executor.submit(_scan_dir, root): root}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_path = futures.pop(future)
+                if (dir_usage := future.result()) is None:
+                    continue
+                dirs[dir_path] = dir_usage
+                for name in dir_usage.subdirs:
+                    futures[executor.submit(_scan_dir, dir_path / name)] = dir_path / name
+    return dirs
+
+
+class DiskUsage:
+    """
+    Total size of files in the share and free space on its filesystem.
+    The size is calculated once in background and then kept up to date by rescanning
+    only the changed directories reported by the share watcher, hidden entries are not counted.
+    With several workers the size is calculated by the primary one only and published to other ones.
+    """
+
+    def __init__(self, root: Path, settings: Dict[str, Any], link: WorkersLink | None = None):
+        section: Dict[str, Any] = settings.get('usage', {})
+        self.__root = root
+        self.__scan_workers: int = section.get('scan-workers', 4)
+        self.__refresh_interval: int = section.get('refresh-interval', 30)
+        self.__dirs: Dict[Path, _DirUsage] = dict()
+        # It's unknown until the share is scanned.
+        self.__usage: int | None = None
+        self.__free = 0
+        self.__changed: Set[Path] = set()
+        self.__rescan = True
+        self.__tasks: List[Task] = []
+        self.__refresh_task: Task | None = None
+        self.__link = link
+
+    def __is_primary(self) -> bool:
+        return self.__link is None or self.__link.is_primary
+
+    def __publish(self):
+        if self.__link is not None:
+            self.__link.set('usage', self.__usage)
+
+    def get_usage(self) -> int | None:
+        """ Returns None until the share is scanned for the first time. """
+        if self.__link is not None:
+            # Restarted primary worker shows the usage found by the previous one while scanning.
+            usage = self.__link.get('usage')
+            return None if usage < 0 else usage
+        return self.__usage
+
+    def get_free(self) -> int:
+        return self.__free
+
+    def changed(self, dir_path: Path | None):
+        if not self.__is_primary():
+            # Changes are passed to the primary worker by the watcher.
+            return
+        if dir_path is None:
+            self.__rescan = True
+        else:
+            self.__changed.add(dir_path)
+        if self.__refresh_task is None or self.__refresh_task.done():
+            self.__refresh_task = create_task(self.__refresh())
+
+    async def start(self):
+        self.__update_free()
+        self.__tasks = [create_task(self.__update_free_loop())]
+        if self.__refresh_task is None and self.__is_primary():
+            self.__refresh_task = create_task(self.__refresh())
+
+    async def close(self):
+        for task in [*self.__tasks, self.__refresh_task]:
+            if task is None:
+                continue
+            task.cancel()
+            with suppress(CancelledError):
+                await task
+
+    def __update_free(self):
+        info = statvfs(self.__root)
+        self.__free = info.f_frsize * info.f_bavail
+
+    async def __update_free_loop(self):
+        while True:
+            await sleep(self.__refresh_interval)
+            await get_running_loop().run_in_executor(None, self.__update_free)
+
+    def __set_dir(self, dir_path: Path, dir_usage: _DirUsage):
+        if (prev_usage := self.__dirs.get(dir_path)) is not None:
+            self.__usage -= prev_usage.files_size
+        self.__dirs[dir_path] = dir_usage
+        self.__usage += dir_usage.files_size
+
+    def __remove_tree(self, root: Path):
+        for dir_path in [path for path in self.__dirs if path == root or root in path.parents]:
+            self.__usage -= self.__dirs.pop(dir_path).files_size
+
+    async def __refresh(self):
+        loop = get_running_loop()
+        if self.__rescan:
+            self.__rescan = False
+            self.__changed.clear()
+            start_time = monotonic()
+            dirs = await loop.run_in_executor(None, _scan_tree, self.__root, self.__scan_workers)
+            self.__dirs = dirs
+            self.__usage = sum(dir_usage.files_size for dir_usage in dirs.values())
+            self.__publish()
+            log.info('Share usage %d bytes in %d directories found in %.1fs.', self.__usage, len(dirs), monotonic() - start_time)
+
+        while self.__changed or self.__rescan:
+            await sleep(_REFRESH_DELAY)
+            if self.__rescan:
+                # Changes are unknown so everything is scanned again.
+                await self.__refresh()
+                return
+            changed, self.__changed = self.__changed, set()
+            for dir_path in sorted(changed):
+                await self.__refresh_dir(dir_path)
+            self.__publish()
+            log.debug('Share usage %d bytes after %d directories changed.', self.__usage, len(changed))
+
+    async def __refresh_dir(self, dir_path: Path):
+        loop = get_running_loop()
+        prev_usage = self.__dirs.get(dir_path)
+        if (dir_usage := await loop.run_in_executor(None, _scan_dir, dir_path)) is None:
+            self.__remove_tree(dir_path)
+            return
+        self.__set_dir(dir_path, dir_usage)
+        prev_subdirs = set() if prev_usage is None else set(prev_usage.subdirs)
+        for name in prev_subdirs - set(dir_usage.subdirs):
+            self.__remove_tree(dir_path / name)
+        for name in set(dir_usage.subdirs) - prev_subdirs:
+            subdir_path = dir_path / name
+            dirs = await loop.run_in_executor(None, _scan_tree, subdir_path, self.__scan_workers)
+            # Some of directories could be already known by their own changes.
+            self.__remove_tree(subdir_path)
+            for path, subdir_usage in dirs.items():
+                self.__set_dir(path, subdir_usage)
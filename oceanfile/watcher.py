@@ -0,0 +1,277 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import CancelledError, Task, create_task, get_running_loop, sleep
+from contextlib import suppress
+from ctypes import CDLL, c_char_p, c_int, c_uint32, get_errno
+from ctypes.util import find_library
+from os import O_CLOEXEC, O_NONBLOCK, close as os_close, fsdecode, fsencode, read as os_read, scandir, strerror
+from pathlib import Path
+from struct import Struct
+from time import time
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple
+
+from oceanfile.workers import WorkersLink
+
+log = logging.getLogger(__name__)
+
+# See inotify(7).
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+
+_WATCH_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR
+_EVENT = Struct('iIII')
+
+# Listener gets the changed directory or None if anything could be changed.
+Listener = Callable[[Path | None], None]
+
+
+def _scan_dirs(root: Path) -> Dict[Path, int]:
+    """ Returns modification times of all non-hidden directories in the tree. """
+    dirs = dict()
+    stack = [root]
+    while stack:
+        dir_path = stack.pop()
+        try:
+            dirs[dir_path] = dir_path.stat().st_mtime_ns
+            with scandir(dir_path) as dir_entries:
+                stack.extend(
+                    Path(entry.path) for entry in dir_entries
+                    if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False)
+                )
+        except (FileNotFoundError, NotADirectoryError):
+            # Removed while scanning.
+            dirs.pop(dir_path, None)
+        except PermissionError:
+            # Unreadable directory is not listed, so its subdirectories are not tracked.
+            continue
+    return dirs
+
+
+class _Inotify:
+    def __init__(self):
+        libc = CDLL(find_library('c'), use_errno=True)
+        self.__add_watch = libc.inotify_add_watch
+        self.__add_watch.argtypes = (c_int, c_char_p, c_uint32)
+        self.__rm_watch = libc.inotify_rm_watch
+        self.__rm_watch.argtypes = (c_int, c_int)
+        if (fd := libc.inotify_init1(O_NONBLOCK | O_CLOEXEC)) < 0:
+            errno = get_errno()
+            raise OSError(errno, strerror(errno))
+        self.fd: int = fd
+
+    def close(self):
+        os_close(self.fd)
+
+    def add_watch(self, path: Path) -> int:
+        if (wd := self.__add_watch(self.fd, fsencode(path), _WATCH_MASK)) < 0:
+            errno = get_errno()
+            raise OSError(errno, strerror(errno), str(path))
+        return wd
+
+    def rm_watch(self, wd: int):
+        # Watch can already be removed by kernel together with the directory.
+        self.__rm_watch(self.fd, wd)
+
+    def read(self) -> Iterator[Tuple[int, int, str]]:
+        try:
+            data = os_read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield wd, mask, name
+
+
+class ShareWatcher:
+    """
+    Tracks changes of the share directories made both using the API and outside of it.
+    Changes are found by inotify or, if it's not available, by periodic polling of directories
+    modification times, and are passed to the listeners like directory listings cache.
+    With several workers only the primary one watches the share, other ones pass the changes
+    made by them to it, get all the changes published by it and read the modification time
+    of the share published by it.
+    """
+
+    def __init__(self, root: Path, settings: Dict[str, Any], link: WorkersLink | None = None):
+        section: Dict[str, Any] = settings.get('watcher', {})
+        self.__root = root
+        # One of: inotify, poll, off.
+        self.__mode: str = section.get('mode', 'inotify')
+        self.__poll_interval: int = section.get('poll-interval', 60)
+        self.__mtime: float | None = None
+        self.__listeners: List[Listener] = []
+        self.__inotify: _Inotify | None = None
+        self.__watches: Dict[int, Path] = dict()
+        self.__tasks: Set[Task] = set()
+        self.__link = link
+        if link is not None:
+            link.add_handler('changed', self.__changed_in_worker)
+
+    def add_listener(self, listener: Listener):
+        self.__listeners.append(listener)
+
+    def get_mtime(self) -> int:
+        if self.__link is not None and not self.__link.is_primary:
+            mtime = self.__link.get('mtime') or None
+        else:
+            mtime = self.__mtime
+        if mtime is None:
+            # Changes are not tracked so the share is always shown as modified.
+            return int(time() - 60)
+        return int(mtime)
+
+    def __set_mtime(self, mtime: float):
+        self.__mtime = mtime
+        if self.__link is not None:
+            self.__link.set('mtime', int(mtime))
+
+    def changed(self, dir_path: Path | None):
+        dir_name = None if dir_path is None else str(dir_path)
+        if self.__link is not None and not self.__link.is_primary:
+            self.__link.send('changed', dir_name)
+        else:
+            if self.__mtime is not None:
+                self.__set_mtime(max(self.__mtime, time()))
+            if self.__link is not None:
+                # Other workers have their own listeners like listings caches.
+                self.__link.publish('changed', dir_name)
+        self.__notify(dir_path)
+
+    def __notify(self, dir_path: Path | None):
+        for listener in self.__listeners:
+            listener(dir_path)
+
+    def __changed_in_worker(self, dir_name: str | None):
+        dir_path = None if dir_name is None else Path(dir_name)
+        if self.__link.is_primary:
+            self.changed(dir_path)
+        else:
+            # Change is published by the primary worker, it knows about it already.
+            self.__notify(dir_path)
+
+    async def start(self):
+        if self.__link is not None and not self.__link.is_primary:
+            return
+        if self.__mode != 'off':
+            # Scanning of a large share takes time so it's done in background.
+            self.__spawn(self.__run())
+
+    async def close(self):
+        for task in list(self.__tasks):
+            task.cancel()
+            with suppress(CancelledError):
+                await task
+        if self.__inotify is not None:
+            get_running_loop().remove_reader(self.__inotify.fd)
+            self.__inotify.close()
+            self.__inotify = None
+
+    def __spawn(self, coro):
+        task = create_task(coro)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __run(self):
+        loop = get_running_loop()
+        if self.__mode == 'inotify':
+            try:
+                self.__inotify = _Inotify()
+                watches, dirs = await loop.run_in_executor(None, self.__watch_tree, self.__root)
+            except OSError as error:
+                log.warning('Unable to watch share using inotify, using polling: %s.', error)
+                if self.__inotify is not None:
+                    self.__inotify.close()
+                    self.__inotify = None
+            else:
+                self.__watches.update(watches)
+                self.__set_mtime(max(dirs.values(), default=0) / 1e9)
+                loop.add_reader(self.__inotify.fd, self.__read_events)
+                log.info('Watching %d directories of share using inotify.', len(watches))
+                return
+
+        dirs = await loop.run_in_executor(None, _scan_dirs, self.__root)
+        self.__set_mtime(max(dirs.values(), default=0) / 1e9)
+        log.info('Watching %d directories of share using polling.', len(dirs))
+        while True:
+            await sleep(self.__poll_interval)
+            prev_dirs, dirs = dirs, await loop.run_in_executor(None, _scan_dirs, self.__root)
+            for dir_path in prev_dirs.keys() | dirs.keys():
+                if prev_dirs.get(dir_path) != dirs.get(dir_path):
+                    log.debug("Directory '%s' is changed.", dir_path)
+                    self.changed(dir_path)
+
+    def __watch_tree(self, root: Path) -> Tuple[Dict[int, Path], Dict[Path, int]]:
+        dirs = _scan_dirs(root)
+        watches = dict()
+        for dir_path in dirs:
+            try:
+                watches[self.__inotify.add_watch(dir_path)] = dir_path
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+        return watches, dirs
+
+    async def __watch_new_tree(self, root: Path):
+        try:
+            watches, _ = await get_running_loop().run_in_executor(None, self.__watch_tree, root)
+        except OSError as error:
+            log.error("Unable to watch directory '%s': %s.", root, error)
+            return
+        self.__watches.update(watches)
+        log.debug("Watching %d new directories in '%s'.", len(watches), root)
+        # Files could be created before the watches are added.
+        self.changed(root)
+
+    def __unwatch_tree(self, root: Path):
+        for wd, dir_path in list(self.__watches.items()):
+            if dir_path == root or root in dir_path.parents:
+                self.__inotify.rm_watch(wd)
+                del self.__watches[wd]
+
+    def __read_events(self):
+        changed_dirs = set()
+        for wd, mask, name in self.__inotify.read():
+            if mask & _IN_Q_OVERFLOW:
+                log.warning('Some of inotify events are lost.')
+                self.changed(None)
+                continue
+            if mask & _IN_IGNORED:
+                self.__watches.pop(wd, None)
+                continue
+            if (dir_path := self.__watches.get(wd)) is None or name.startswith('.'):
+                continue
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self.__spawn(self.__watch_new_tree(dir_path / name))
+                elif mask & _IN_MOVED_FROM:
+                    self.__unwatch_tree(dir_path / name)
+            changed_dirs.add(dir_path)
+        for dir_path in changed_dirs:
+            log.debug("Directory '%s' is changed.", dir_path)
+            self.changed(dir_path)
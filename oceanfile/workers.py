@@ -0,0 +1,184 @@
+"""
+    This file is part of oceanfile.
+
+    oceanfile is free software: you can redistribute it and/or modify it under the terms
+    of the GNU General Public License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    oceanfile is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+    without even the implied warranty     of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+    PURPOSE. See the GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License along with oceanfile.
+    If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from asyncio import get_running_loop
+from json import dumps as json_dumps, loads as json_loads
+from mmap import mmap
+from os import WNOHANG, _exit, close as os_close, fork, kill, pipe, read as os_read, waitpid, waitstatus_to_exitcode, write as os_write
+from select import select
+from signal import SIG_DFL, SIGINT, SIGTERM, signal
+from socket import AF_UNIX, SOCK_DGRAM, socketpair
+from struct import Struct
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Tuple
+
+from oceanfile.notify import notify_start
+
+log = logging.getLogger(__name__)
+
+# Worker which dies earlier than this time after start, in seconds, is restarted with a delay.
+_MIN_UPTIME = 5
+
+# Worker is given its index and the function to call when it's ready to serve.
+Worker = Callable[[int, Callable[[], None]], None]
+
+_VALUE = Struct('q')
+
+
+class WorkersLink:
+    """
+    Link between the forked workers, it's made before forking. The primary worker does the work
+    which is needed once for the share, like watching it and calculating its usage. Other workers
+    send it messages by topics and read the values it publishes in the shared memory, and it
+    publishes messages to all of them. Messages are sent as datagrams, so they are never mixed,
+    and ones sent while a worker is restarted wait for it in the socket buffer.
+    """
+
+    def __init__(self, values: Dict[str, int], count: int):
+        self.__offsets = {name: index * _VALUE.size for index, name in enumerate(values)}
+        # Anonymous mapping is shared with the forked processes.
+        self.__memory = mmap(-1, max(len(self.__offsets), 1) * _VALUE.size)
+        for name, value in values.items():
+            self.set(name, value)
+        # Receiving and sending sockets of each worker, the first ones are of the primary worker.
+        self.__socks = [socketpair(AF_UNIX, SOCK_DGRAM) for _ in range(count)]
+        for pair in self.__socks:
+            for sock in pair:
+                sock.setblocking(False)
+        self.__handlers: Dict[str, Callable[[Any], None]] = dict()
+        self.index = 0
+        self.is_primary = True
+
+    def set_worker(self, index: int):
+        """ Called by the forked worker, the first one is the primary. """
+        self.index = index
+        self.is_primary = index == 0
+        for other, (recv_sock, send_sock) in enumerate(self.__socks):
+            if other != index:
+                recv_sock.close()
+            if other != 0 and not self.is_primary:
+                send_sock.close()
+
+    def get(self, name: str) -> int:
+        return _VALUE.unpack_from(self.__memory, self.__offsets[name])[0]
+
+    def set(self, name: str, value: int):
+        _VALUE.pack_into(self.__memory, self.__offsets[name], value)
+
+    def add_handler(self, topic: str, handler: Callable[[Any], None]):
+        """ Adds the handler of messages of the topic received by this worker. """
+        self.__handlers[topic] = handler
+
+    def __send_to(self, index: int, topic: str, data: Any):
+        try:
+            self.__socks[index][1].send(json_dumps([topic, data]).encode())
+        except BlockingIOError:
+            log.warning('Message %r is dropped, worker %d does not read them.', topic, index)
+
+    def send(self, topic: str, data: Any):
+        """ Sends the message to the primary worker, it's handled at once by the primary worker itself. """
+        if self.is_primary:
+            self.__handlers[topic](data)
+        else:
+            self.__send_to(0, topic, data)
+
+    def publish(self, topic: str, data: Any):
+        """ Sends the message from the primary worker to all other workers. """
+        for index in range(1, len(self.__socks)):
+            self.__send_to(index, topic, data)
+
+    def __receive(self):
+        while True:
+            try:
+                message = self.__socks[self.index][0].recv(65536)
+            except BlockingIOError:
+                return
+            topic, data = json_loads(message)
+            if (handler := self.__handlers.get(topic)) is None:
+                log.warning('Unknown message %r.', topic)
+                continue
+            handler(data)
+
+    async def start(self):
+        get_running_loop().add_reader(self.__socks[self.index][0].fileno(), self.__receive)
+
+    async def close(self):
+        get_running_loop().remove_reader(self.__socks[self.index][0].fileno())
+
+
+def _spawn(run_worker: Worker, index: int, ready_fd: int, read_fd: int) -> int:
+    if pid := fork():
+        return pid
+    os_close(read_fd)
+    signal(SIGTERM, SIG_DFL)
+    signal(SIGINT, SIG_DFL)
+    exit_code = 0
+    try:
+        run_worker(index, lambda: os_write(ready_fd, b'.'))
+    except BaseException:
+        log.exception('Worker failed.')
+        exit_code = 1
+    finally:
+        # Parent cleanup handlers must not run in the worker.
+        _exit(exit_code)
+
+
+def run_workers(count: int, run_worker: Worker):
+    """
+    Runs the number of forked workers which share the listening port using SO_REUSEPORT.
+    The first worker is the primary one, it's restarted as the primary one too.
+    Died workers are restarted, termination signals are passed to them
+    and systemd is notified when all of them are ready.
+    """
+    read_fd, ready_fd = pipe()
+    workers: Dict[int, Tuple[int, float]] = dict()
+    stopping = False
+
+    def stop(signum, unused_frame):
+        nonlocal stopping
+        stopping = True
+        log.info('Stopping %d workers.', len(workers))
+        for pid in workers:
+            kill(pid, SIGTERM)
+
+    signal(SIGTERM, stop)
+    signal(SIGINT, stop)
+
+    for index in range(count):
+        workers[_spawn(run_worker, index, ready_fd, read_fd)] = index, monotonic()
+    log.info('%d workers started.', count)
+
+    ready_count = 0
+    while workers:
+        if select([read_fd], [], [], 1)[0]:
+            ready_count += len(os_read(read_fd, 1024))
+            if ready_count == count:
+                log.info('All workers are ready.')
+                notify_start()
+
+        while workers and (status := waitpid(-1, WNOHANG))[0]:
+            pid, exit_status = status
+            index, start_time = workers.pop(pid)
+            log.log(logging.INFO if stopping else logging.ERROR, 'Worker %d (pid %d) exited with code %d.', index, pid, waitstatus_to_exitcode(exit_status))
+            if stopping:
+                continue
+            if monotonic() - start_time < _MIN_UPTIME:
+                sleep(1)
+            workers[_spawn(run_worker, index, ready_fd, read_fd)] = index, monotonic()
+            log.info('Worker %d restarted.', index)
+
+    os_close(read_fd)
+    os_close(ready_fd)